@@ -0,0 +1,173 @@
+"""
+Micro-benchmarks for the FlowView load path, run on synthetic Trinity messages:
+
+% python -m flowview.benchmark extractor --events=10000
+% python -m flowview.benchmark formatter --events=1000000
+% python -m flowview.benchmark parse --events=500000
+"""
+from datetime import datetime
+from optparse import OptionParser
+import multiprocessing
+import random
+import time
+import uuid
+from flowview import event_extractor
+from flowview import row_formatter
+from flowview import parse_stage
+
+
+def synthetic_messages(count,seed=0,payload_size=2000):
+    """
+    Generates Trinity-like JSON messages, one per line. Most messages carry event_id
+    before server_timestamp; a few have them reversed or lack server_timestamp.
+    :param count: Number of messages
+    :param seed: Random seed, so runs are comparable
+    :param payload_size: Approximate size in bytes of the body of each message
+    :return: List of lines
+    """
+    rng = random.Random(seed)
+    base_ms = 1439999999000
+    lines = []
+    for i in range(count):
+        event_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        server_ts = base_ms + rng.randint(0,3600000)
+        payload = "".join(rng.choice('abcdefghijklmnopqrstuvwxyz ":,') for _ in range(payload_size // 10)) * 10
+        kind = i % 50
+        if kind == 0:
+            header = '"server_timestamp":%d,"event_id":"%s"' %(server_ts,event_id)
+        elif kind == 1:
+            header = '"event_id":"%s"' %event_id
+        else:
+            header = '"event_id":"%s","topic":"thrive_test","server_timestamp":%d' %(event_id,server_ts)
+        lines.append('{"header":{%s},"body":{"payload":"%s"}}\n' %(header,payload.replace('"',"'")))
+    return lines
+
+
+def timed(func,*args):
+    start = time.time()
+    result = func(*args)
+    return result,time.time() - start
+
+
+def legacy_extract(lines):
+    # Same call retrieve_hdfs_ts made before the extractor: findall over the whole output
+    return event_extractor.LEGACY_PATTERN.findall("".join(lines))
+
+
+def extractor_extract(lines):
+    return list(event_extractor.iter_events(lines))
+
+
+def bench_extractor(events):
+    """
+    Compares the legacy regex with event_extractor and prints events/second for both
+    :param events: Number of synthetic messages
+    :return: None
+    """
+    lines = synthetic_messages(events)
+    legacy,legacy_secs = timed(legacy_extract,lines)
+    fast,fast_secs = timed(extractor_extract,lines)
+
+    print "messages:              %d" %len(lines)
+    print "legacy regex:          %d events in %.3fs, %.0f events/s" %(len(legacy),legacy_secs,len(lines)/legacy_secs)
+    print "event_extractor:       %d events in %.3fs, %.0f events/s" %(len(fast),fast_secs,len(lines)/fast_secs)
+    print "speedup:               %.1fx" %(legacy_secs/fast_secs)
+    # The extractor also recovers messages whose fields are reversed, so it may find more events
+    print "same in-order results: %s" %(set(legacy) <= set(fast))
+
+
+def synthetic_events(count,seed=0):
+    """
+    :return: List of (event_id, server_timestamp) as produced by event_extractor, spread over one hour
+    """
+    rng = random.Random(seed)
+    base_ms = 1439999999000
+    return [(str(uuid.UUID(int=rng.getrandbits(128))),str(base_ms + rng.randint(0,3600000)))
+            for _ in range(count)]
+
+
+def legacy_format(events,hdfs_ts):
+    # Per-event formatting retrieve_hdfs_ts did before row_formatter
+    rows = []
+    for event_id,server_unix_ts in events:
+        server_ts = datetime.fromtimestamp(int(server_unix_ts)/1000).strftime("%Y-%m-%d %H:%M:%S")
+        rows.append('\x01'.join((event_id,server_ts,hdfs_ts+":00\n")))
+    return "".join(rows)
+
+
+def batch_format(events,hdfs_ts,batch_size=20000):
+    cache = row_formatter.TimestampCache()
+    last_field = row_formatter.hdfs_ts_field(hdfs_ts)
+    return "".join(row_formatter.format_rows(events[i:i + batch_size],last_field,cache)
+                   for i in range(0,len(events),batch_size))
+
+
+def bench_formatter(events):
+    """
+    Compares per-event timestamp formatting with row_formatter batches and prints rows/second for both
+    :param events: Number of synthetic events
+    :return: None
+    """
+    parsed = synthetic_events(events)
+    legacy,legacy_secs = timed(legacy_format,parsed,"2015-08-19 10:12")
+    batched,batch_secs = timed(batch_format,parsed,"2015-08-19 10:12")
+
+    print "events:          %d" %len(parsed)
+    print "per-event:       %.3fs, %.0f rows/s" %(legacy_secs,len(parsed)/legacy_secs)
+    print "row_formatter:   %.3fs, %.0f rows/s" %(batch_secs,len(parsed)/batch_secs)
+    print "speedup:         %.1fx" %(legacy_secs/batch_secs)
+    print "identical bytes: %s" %(legacy == batched)
+
+
+def parse_with_stage(chunks,processes):
+    stage = parse_stage.ParseStage(processes)
+    try:
+        last_field = row_formatter.hdfs_ts_field("2015-08-19 10:12")
+        results = [stage.submit(chunk,last_field) for chunk in chunks]
+        return sum(result.get()[1] for result in results)
+    finally:
+        stage.close()
+
+
+def bench_parse(events):
+    """
+    Parses synthetic chunks with 1, 2, 4... parser processes up to the number of cores
+    and prints events/second and the scaling against a single process
+    :param events: Number of synthetic messages
+    :return: None
+    """
+    lines = synthetic_messages(events,payload_size=200)
+    chunks = []
+    for i in range(0,len(lines),5000):
+        chunks.append("".join(lines[i:i + 5000]))
+
+    cores = multiprocessing.cpu_count()
+    process_counts = [1]
+    while process_counts[-1] * 2 <= cores:
+        process_counts.append(process_counts[-1] * 2)
+    if process_counts[-1] != cores:
+        process_counts.append(cores)
+
+    print "messages: %d in %d chunks" %(len(lines),len(chunks))
+    single = None
+    for processes in process_counts:
+        parsed,secs = timed(parse_with_stage,chunks,processes)
+        single = single or secs
+        print "%3d processes: %d events in %.3fs, %.0f events/s, %.1fx" \
+              %(processes,parsed,secs,parsed/secs,single/secs)
+
+
+BENCHMARKS = {
+    "extractor": bench_extractor,
+    "formatter": bench_formatter,
+    "parse": bench_parse,
+}
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] " + "|".join(sorted(BENCHMARKS)))
+    parser.add_option("--events",dest="events",type="int",default=10000)
+    (options,args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("Choose one benchmark: %s" %", ".join(sorted(BENCHMARKS)))
+    BENCHMARKS[args[0]](options.events)
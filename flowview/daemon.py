@@ -0,0 +1,80 @@
+import logging
+import signal
+import threading
+import time
+from flowview.load_handler import LoadHandler
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the starts of two loads unless configured otherwise
+DEFAULT_POLL_SECONDS = 300
+# Seconds without modification after which the newest directory is loaded unless configured otherwise
+DEFAULT_DIR_CLOSE_SECONDS = 600
+# Seconds after the end of its hour after which the newest hive partition is loaded unless configured otherwise
+DEFAULT_PTN_CLOSE_SECONDS = 600
+
+
+class LoadDaemon(object):
+    """
+    Runs the loads of a dataset from one long-running process, in place of an hourly
+    scheduled LoadHandler. A single LoadHandler is kept for the whole run, so the metadata
+    and HiveServer2 connections, the directory index and the checkpoints stay in memory
+    between loads. Directories and partitions are loaded as soon as they are closed
+    instead of once a newer one exists, so each load is small and loss shows within minutes.
+    The ratio of an hour is only computed once the hive partitions of its whole window are pulled,
+    which is after its directories are loaded; its counts wait in memory until then.
+    SIGTERM and SIGINT stop the daemon once the running load is complete.
+    """
+    def __init__(self,config_file):
+        """
+        :param config_file: Dataset config file
+        :return:
+        """
+        self.handler = LoadHandler(config_file)
+        self.poll_seconds = int(self.handler.get_config("daemon_poll_seconds",DEFAULT_POLL_SECONDS))
+        self.handler.dir_close_seconds = int(self.handler.get_config("daemon_dir_close_seconds",
+                                                                     DEFAULT_DIR_CLOSE_SECONDS))
+        self.handler.ptn_close_seconds = int(self.handler.get_config("daemon_ptn_close_seconds",
+                                                                     DEFAULT_PTN_CLOSE_SECONDS))
+        self.handler.defer_ratios = True
+        self.stopping = threading.Event()
+
+    def stop(self,signum=None,frame=None):
+        logger.info("Stopping after the running load (signal %s)" %signum)
+        self.stopping.set()
+
+    def run_once(self,reload_checkpoints=False):
+        """
+        Runs one load, if anything is pending
+        :param reload_checkpoints: Read the checkpoints from the metadata again
+        :return: True if the load succeeded or there was nothing to load
+        """
+        try:
+            self.handler.reset(reload_checkpoints)
+            if self.handler.discover():
+                self.handler.load()
+            else:
+                logger.info("No partitions or directories to proceed")
+            return True
+        except Exception:
+            logger.exception("Load of %s failed, retrying in %s seconds" %(self.handler.topic,self.poll_seconds))
+            # The connection may be what failed; the next load reconnects
+            self.handler.metadata_mgr.close()
+            return False
+
+    def execute(self):
+        signal.signal(signal.SIGTERM,self.stop)
+        signal.signal(signal.SIGINT,self.stop)
+        logger.info("Loading %s every %s seconds" %(self.handler.topic,self.poll_seconds))
+        succeeded = True
+        while not self.stopping.is_set():
+            start = time.time()
+            # After a failure, the metadata holds the last checkpoints actually committed
+            succeeded = self.run_once(reload_checkpoints=not succeeded)
+            self.stopping.wait(max(0,self.poll_seconds - (time.time() - start)))
+        if self.handler.deferred_ptns:
+            logger.warning("Stopping before the hive windows of partitions %s are pulled: their ratios are not recorded"
+                           %sorted(self.handler.deferred_ptns))
+        self.handler.metadata_mgr.close()
+        self.handler.hive_exec.close()
+        logger.info("Stopped loading %s" %self.handler.topic)
@@ -0,0 +1,178 @@
+import bisect
+import errno
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from flowview.shell_executor import ShellException
+
+logger = logging.getLogger(__name__)
+
+# Listing line: permissions, replication, owner, group, size, 2015-08-19 10:12 /path/d_20150819-1710
+DENTRY_PATTERN = ".*([0-9]{4}\-[0-9]{2}\-[0-9]{2} [0-9]{2}:[0-9]{2}) (.*)"
+# Directory names starting with a date, e.g. d_20150819-1710
+DATED_NAME_PATTERN = re.compile("^(.*?)([0-9]{8})")
+# Longer gaps since the newest indexed directory are caught up with a full listing
+MAX_GLOB_DAYS = 62
+HDFS_TS_PATTERN = re.compile("^[0-9]{4}\-[0-9]{2}\-[0-9]{2} [0-9]{2}:[0-9]{2}$")
+
+
+def parse_listing(output):
+    """
+    :param output: Output of `hadoop fs -ls`
+    :return: List of (hdfs timestamp, path), e.g. (2015-08-19 10:12, /data/ds_ctg/trinity/thrive_test/d_20150819-1710)
+    """
+    return re.findall(DENTRY_PATTERN,output)
+
+
+def dir_key(path):
+    """
+    Sort key of a directory. Date is obtained from dirname (e.g. 'd_20150311-1610')
+    by retaining only the numeric parts of the string and converting to int (e.g. 201503111610)
+    :param path: HDFS path of the directory
+    :return: int
+    """
+    return int(re.sub("[^0-9]","",os.path.basename(path)) or 0)
+
+
+class DirIndex(object):
+    """
+    Sorted index of the directories of a Trinity topic, kept in a local JSON file between
+    loads. The first load lists the whole topic; later loads only list the directories of
+    the days since the newest one indexed, so discovery does not grow with the retention.
+    """
+    def __init__(self,index_path):
+        """
+        :param index_path: Local file holding the index
+        :return:
+        """
+        self.index_path = index_path
+        self.hdfs_path = None
+        self.keys = []
+        self.entries = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        except ValueError:
+            logger.warning("Ignoring unreadable directory index %s" %self.index_path)
+            return
+        self.hdfs_path = index["hdfs_path"]
+        self.entries = [tuple(entry) for entry in index["entries"]]
+        self.keys = [dir_key(path) for _,path in self.entries]
+
+    def save(self):
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Written aside and renamed, so an interrupted load never leaves a truncated index
+        with open(self.index_path + ".tmp","w") as index_file:
+            json.dump({"hdfs_path":self.hdfs_path,"entries":self.entries},index_file)
+        os.rename(self.index_path + ".tmp",self.index_path)
+
+    def merge(self,dir_info):
+        """
+        Adds listed directories, replacing the entries of directories listed before
+        :param dir_info: List of (hdfs timestamp, path)
+        :return: None
+        """
+        for hdfs_ts,path in dir_info:
+            key = dir_key(path)
+            i = bisect.bisect_left(self.keys,key)
+            if i < len(self.keys) and self.keys[i] == key:
+                self.entries[i] = (hdfs_ts,path)
+            else:
+                self.keys.insert(i,key)
+                self.entries.insert(i,(hdfs_ts,path))
+
+    def day_glob(self,hdfs_path,now=None):
+        """
+        :return: Glob matching the directories of every day from the newest indexed one until
+                 tomorrow, None if the directory names do not start with a date or the
+                 newest indexed directory is more than MAX_GLOB_DAYS old
+        """
+        match = DATED_NAME_PATTERN.match(os.path.basename(self.entries[-1][1]))
+        if match is None:
+            return None
+        prefix,newest_day = match.groups()
+        try:
+            day = datetime.strptime(newest_day,"%Y%m%d")
+        except ValueError:
+            return None
+        # Tomorrow is included in case directories are named after a timezone ahead of ours
+        last_day = (now or datetime.now()) + timedelta(days=1)
+        days = []
+        while day.date() <= last_day.date():
+            days.append(day.strftime("%Y%m%d"))
+            day += timedelta(days=1)
+        if len(days) > MAX_GLOB_DAYS:
+            return None
+        return "%s/%s{%s}*" %(hdfs_path,prefix,",".join(days))
+
+    def refresh(self,shell_exec,hdfs_path):
+        """
+        Adds the directories created since the last refresh
+        :param shell_exec: ShellExecutor
+        :param hdfs_path: HDFS path of the topic
+        :return: None
+        """
+        glob = self.day_glob(hdfs_path) if self.entries and self.hdfs_path == hdfs_path else None
+        if glob is None:
+            logger.info("Building directory index of %s from a full listing" %hdfs_path)
+            self.hdfs_path = hdfs_path
+            self.keys = []
+            self.entries = []
+            output = shell_exec.safe_execute("hadoop fs -ls %s" %hdfs_path).output
+        else:
+            result = shell_exec.execute("hadoop fs -ls -d %s" %glob)
+            output = result.output
+            if result.retcode != 0:
+                # A glob matching nothing is an error for hadoop fs -ls
+                if "No such file or directory" not in result.error:
+                    logger.error("Listing %s failed: %s" %(glob,result.error))
+                    raise ShellException(result.error)
+                output = ""
+        listed = parse_listing(output)
+        self.merge(listed)
+        self.save()
+        logger.info("Listed %s directories, %s in directory index" %(len(listed),len(self.entries)))
+
+    def position(self,proceed_dir):
+        """
+        :param proceed_dir: Path of a directory, or its hdfs timestamp in checkpoints of older loads
+        :return: Position of the directory in the index, -1 if it is not indexed
+        """
+        if HDFS_TS_PATTERN.match(proceed_dir):
+            # Several directories may share a minute: the oldest one is taken, so none of the
+            # directories after the checkpoint is skipped
+            for i,(hdfs_ts,_) in enumerate(self.entries):
+                if hdfs_ts == proceed_dir:
+                    return i
+            return -1
+        key = dir_key(proceed_dir)
+        i = bisect.bisect_left(self.keys,key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def prune(self,position):
+        """
+        Drops the entries before a position, once they are processed
+        :param position: Position of the oldest entry kept
+        :return: None
+        """
+        if position > 0:
+            del self.entries[:position]
+            del self.keys[:position]
+            self.save()
@@ -0,0 +1,56 @@
+import re
+
+EVENT_ID_KEY = '"event_id":"'
+SERVER_TS_KEY = '"server_timestamp":'
+
+# Pattern FlowView has always used. Kept as the reference for lines the fast path does not handle.
+LEGACY_PATTERN = re.compile('.*"event_id":"(.*?)".*?"server_timestamp":([0-9]+)')
+EVENT_ID_PATTERN = re.compile('"event_id":"([^"\n]*)"')
+SERVER_TS_PATTERN = re.compile('"server_timestamp":([0-9]+)')
+DIGITS_PATTERN = re.compile('[0-9]+')
+
+
+def extract_event(line):
+    """
+    Extracts event_id and server_timestamp from one Trinity message.
+    The fast path handles the common layout (event_id followed by server_timestamp)
+    with plain string searches and an anchored match on the timestamp digits, and
+    returns the same fields as LEGACY_PATTERN. Other lines go through the legacy
+    pattern, then through independent searches so that messages with the two
+    fields in reverse order are still extracted.
+    :param line: One line of `hadoop fs -text` output
+    :return: (event_id, server_timestamp in milliseconds as a string), or None if a field is missing
+    """
+    start = line.rfind(EVENT_ID_KEY)
+    if start != -1:
+        start += len(EVENT_ID_KEY)
+        end = line.find('"',start)
+        if end != -1:
+            ts_start = line.find(SERVER_TS_KEY,end + 1)
+            if ts_start != -1:
+                digits = DIGITS_PATTERN.match(line,ts_start + len(SERVER_TS_KEY))
+                if digits is not None:
+                    return line[start:end],digits.group()
+    return _extract_fallback(line)
+
+
+def _extract_fallback(line):
+    match = LEGACY_PATTERN.match(line)
+    if match is not None:
+        return match.groups()
+    event_id = EVENT_ID_PATTERN.search(line)
+    server_ts = SERVER_TS_PATTERN.search(line)
+    if event_id is None or server_ts is None:
+        return None
+    return event_id.group(1),server_ts.group(1)
+
+
+def iter_events(lines):
+    """
+    :param lines: Iterable over Trinity messages, one per line
+    :return: Generator over (event_id, server_timestamp) of the messages holding both fields
+    """
+    for line in lines:
+        event = extract_event(line)
+        if event is not None:
+            yield event
@@ -5,11 +5,15 @@ from flowview.metadata_manager import MetadataManager
 from flowview.hive_manager import HiveManager
 from flowview.hdfs_manager import hdfsManager
 from flowview.shell_executor import ShellExecutor
+from flowview.hive_executor import get_hive_executor, DEFAULT_POOL_SIZE, DEFAULT_HIVESERVER2_PORT
 from ConfigParser import SafeConfigParser
 
 class FlowviewHandlerException(Exception):
     pass
 
+# Marks get_config calls made without a default value
+_NO_DEFAULT = object()
+
 class FlowviewHandler(object):
     """
     Base handler class for cleanup, setup, and load actions.
@@ -32,17 +36,30 @@ class FlowviewHandler(object):
         self.table = self.get_config("table_name")
         self.connection_info = self.get_config("connection_info")
         self.metadata_mgr = MetadataManager(self.connection_info,self.table,self.topic)
-        self.hdfs_mgr = hdfsManager(self.topic)
-        self.hive_mng = HiveManager(self.database,self.table)
+        # Backend for all Hive statements: the hive CLI or pooled HiveServer2 sessions
+        self.hive_exec = get_hive_executor(self.get_config("hive_backend","cli"),
+                                           self.get_config("hive_host",None),
+                                           int(self.get_config("hive_port",DEFAULT_HIVESERVER2_PORT)),
+                                           self.get_config("hive_user",None),
+                                           int(self.get_config("hive_pool_size",DEFAULT_POOL_SIZE)))
+        self.hdfs_mgr = hdfsManager(self.topic,hive_exec=self.hive_exec)
+        # Test mode: verify the partition pruning of every row count query before running it
+        self.hive_mng = HiveManager(self.database,self.table,self.hive_exec,
+                                    self.get_config("hive_check_pruning","false").lower() == "true")
         self.shell_exec = ShellExecutor()
         self.loadts = datetime.now()
 
         self.hdfs_topic = "idea-flowview"
 
-    def get_config(self,config):
+    def get_config(self,config,default=_NO_DEFAULT):
         """
         Returns value of requested "config" using ConfigParser
         :param config:
+        :param default: value returned when "config" is missing or empty.
+                        If not given, a missing "config" raises an error.
         :return: value of configuration parameter "config"
         """
-        return self.parser.get("main", config)
\ No newline at end of file
+        if default is not _NO_DEFAULT:
+            if not self.parser.has_option("main", config) or self.parser.get("main", config) == "":
+                return default
+        return self.parser.get("main", config)
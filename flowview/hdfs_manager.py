@@ -1,9 +1,18 @@
 # Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
 
-from shell_executor import ShellExecutor, ShellException
-from datetime import datetime
+from shell_executor import ShellExecutor, ShellException, DEFAULT_STREAM_BUFSIZE
+from flowview.record_reader import ShellRecordReader
+from flowview.hive_executor import HiveCliExecutor
+from flowview.load_summary import PartitionSummary, server_ts_range
+from flowview.hll import HyperLogLog
+from flowview.sampling import sample_events
+from flowview.dir_index import parse_listing, dir_key
+from flowview import hiveql
+from flowview.event_extractor import iter_events
+from flowview import row_formatter
+import collections
 import logging
-import re
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -11,8 +20,31 @@ class hdfsManager(object):
     """
     Manager class for HDFS directory operations.
     """
-    def __init__(self,topic):
+    def __init__(self,topic,buffer_size=DEFAULT_STREAM_BUFSIZE,record_reader=None,parse_stage=None,
+                 hive_exec=None,sketch_precision=None,sample_threshold=None):
+        """
+        :param topic: Dataset's Trinity topic name
+        :param buffer_size: Size in bytes of the buffers used when streaming HDFS content.
+                            Bounds the memory held per directory being read.
+        :param record_reader: Reader decoding the records of an HDFS directory.
+                              Defaults to reading through `hadoop fs -text`.
+        :param parse_stage: ParseStage doing the parsing in separate processes.
+                            Without it, messages are parsed in the calling thread.
+        :param hive_exec: Hive backend running partition DDL. Defaults to the hive CLI.
+        :param sketch_precision: Precision of the event id sketches of the directories read.
+                                 None to build no sketches.
+        :param sample_threshold: Sample of the events written, as returned by sampling.sample_threshold.
+                                 None to write every event.
+        :return:
+        """
         self.topic = topic
+        self.buffer_size = buffer_size
+        self.record_reader = record_reader if record_reader is not None else ShellRecordReader(buffer_size)
+        self.ts_cache = row_formatter.TimestampCache()
+        self.parse_stage = parse_stage
+        self.hive_exec = hive_exec if hive_exec is not None else HiveCliExecutor()
+        self.sketch_precision = sketch_precision
+        self.sample_threshold = sample_threshold
         self.shell_exec = ShellExecutor()
 
     def makedir(self, dir_path):
@@ -28,6 +60,21 @@ class hdfsManager(object):
             logger.error("HDFS makedir failed. %s" % dir_path)
             raise
 
+    def makedirs(self, dir_paths):
+        """
+        Makes several HDFS directories with a single command
+        :param dir_paths: List of HDFS paths
+        :return: None
+        """
+        if not dir_paths:
+            return
+        try:
+            self.shell_exec.safe_execute("hadoop fs -mkdir -p %s" % " ".join(dir_paths))
+            logger.info("Created %s HDFS directories" % len(dir_paths))
+        except ShellException:
+            logger.error("HDFS makedirs failed. %s" % dir_paths)
+            raise
+
     def rmdir(self, dir_path):
         """
         Removes HDFS directory at dir_path
@@ -69,64 +116,94 @@ class hdfsManager(object):
             logger.error("HDFS force putfile failed. %s %s" % (local_path, hdfs_path))
             raise
 
+    def force_put_ptns(self,local_root,ptns,hdfs_root):
+        """
+        Copies the local partition directories of ptns to the same layout under hdfs_root
+        with a single command, overwriting existing files. Top level (year) directories are
+        copied as a whole and merged into the existing HDFS directories, so local_root
+        must hold nothing but the partitions to upload.
+        :param local_root: Local root of the partition directories
+        :param ptns: Partitions in the format of YYYY/MM/DD/HH
+        :param hdfs_root: HDFS destination root
+        :return: None
+        """
+        top_dirs = sorted(set("%s/%s" %(local_root,ptn.split("/")[0]) for ptn in ptns))
+        top_dirs = [top_dir for top_dir in top_dirs if os.path.isdir(top_dir)]
+        if not top_dirs:
+            return
+        self.force_putfile(" ".join(top_dirs),hdfs_root)
+
     def get_start_dir(self,last_dir,start_dir):
         """
 
-        :param last_dir:
+        :param last_dir: Path of the last processed directory, or its hdfs timestamp in checkpoints of older loads
         :param start_dir:
         :return:
         """
         if start_dir is None:
             return last_dir
         else:
-            last_dir_int = re.sub("[^0-9]", "",str(last_dir))
-            start_dir_int = re.sub("[^0-9]", "",str(start_dir))
+            # Only the name of a path is compared, digits of the parent directories are not part of the date
+            last_dir_int = dir_key(str(last_dir))
+            start_dir_int = dir_key(str(start_dir))
             if (last_dir_int < start_dir_int):
                 return start_dir
             else:
                 return last_dir
 
-    def get_new_dirs(self,last_dir,start_dir,hdfs_path):
+    def get_new_dirs(self,last_dir,start_dir,hdfs_path,dir_index=None,closed_before=None):
         """
-        :param last_dir: Last processed hdfs directory
+        :param last_dir: Path of the last processed hdfs directory
+        :param dir_index: DirIndex of the topic. Without it, the whole topic is listed and sorted.
+        :param closed_before: hdfs timestamp (YYYY-MM-DD HH:MM). The newest directory counts as closed
+                              if it was last modified before. None to always leave the newest directory.
         :return: A list of hdfs directories pending processing.
                 Expected format is a list of the following:
                 (2015-08-19 10:12, /data/ds_ctg/trinity/thrive_test/d_20150819-1710)
         """
-        # path and command to trinity topic for the dataset
-        cmd = "hadoop fs -ls %s" % hdfs_path
-        result = self.shell_exec.safe_execute(cmd)
-        output = result.output
-        # stores snappy file list in output
-        # sample output:
-        # drwxr-xr-x   - sys_bio_ctgdq bio_hadoop_ds          0 2015-08-19 10:12 /data/ds_ctg/trinity/thrive_test/d_20150819-1710
-
-        # Compile pattern containing
-        # (1) hdfs processing timestamp e.g: 2015-08-19 10:12
-        # (2) path leading to the snappy file e.g: /data/ds_ctg/trinity/thrive_test/d_20150819-1710
-        dentry_pattern = ".*([0-9]{4}\-[0-9]{2}\-[0-9]{2} [0-9]{2}:[0-9]{2}) (.*)"
-        all_dirs = re.findall(dentry_pattern, output)
-
-        # Sort dirs according to date. Date is obtained from dirname
-        # (e.g. 'd_20150311-1610') by retaining only the numeric parts of
-        # the string and converting to int (e.g. 201503111610)
-        all_dirs.sort(key=lambda  s: int(re.sub("[^0-9]", "", s[1])))
-
         proceed_dir = self.get_start_dir(last_dir,start_dir)
-        try:
-            # If last directory is None, indicating the current load is the first load,
-            # process all directories found
-            if proceed_dir is None:
-                pending_dir_info = all_dirs
-            # Else, index the last directories' position in all directories
+        if dir_index is not None:
+            # Only the directories created since the previous load are listed
+            dir_index.refresh(self.shell_exec,hdfs_path)
+            all_dirs = dir_index.entries
+            lastindex = dir_index.position(proceed_dir) if proceed_dir is not None else -1
+        else:
+            # path and command to trinity topic for the dataset
+            cmd = "hadoop fs -ls %s" % hdfs_path
+            result = self.shell_exec.safe_execute(cmd)
+            # stores snappy file list in output
+            # sample output:
+            # drwxr-xr-x   - sys_bio_ctgdq bio_hadoop_ds          0 2015-08-19 10:12 /data/ds_ctg/trinity/thrive_test/d_20150819-1710
+            # Parsed into
+            # (1) hdfs processing timestamp e.g: 2015-08-19 10:12
+            # (2) path leading to the snappy file e.g: /data/ds_ctg/trinity/thrive_test/d_20150819-1710
+            all_dirs = parse_listing(result.output)
+
+            # Sort dirs according to date. Date is obtained from dirname
+            # (e.g. 'd_20150311-1610') by retaining only the numeric parts of
+            # the string and converting to int (e.g. 201503111610)
+            all_dirs.sort(key=lambda  s: dir_key(s[1]))
             # Because dir_info contains both timestamp and path info in a list,
             # need to go into sublist to index proceed_dir
-            else:
-                lastindex = next((i for i, sublist in enumerate(all_dirs) if proceed_dir in sublist), -1)
-                pending_dir_info = all_dirs[lastindex +1: -1]
-        except ValueError:
-            logger.error("Last processed directory %s not found in topic location %s" %(proceed_dir,hdfs_path))
-            raise
+            lastindex = next((i for i, sublist in enumerate(all_dirs) if proceed_dir in sublist), -1)
+
+        # If last directory is None, indicating the current load is the first load,
+        # process all directories found
+        if proceed_dir is None:
+            pending_dir_info = list(all_dirs)
+        # Else, take the directories after the last directory's position in all directories
+        else:
+            if lastindex < 0:
+                logger.warning("Last processed directory %s not found in topic location %s"
+                               %(proceed_dir,hdfs_path))
+            pending_dir_info = all_dirs[lastindex +1:]
+            # Omit the very last directory since Trinity may still be writing to it,
+            # unless it has not been modified for long enough to be closed
+            if pending_dir_info and (closed_before is None or pending_dir_info[-1][0] >= closed_before):
+                pending_dir_info = pending_dir_info[:-1]
+            if dir_index is not None:
+                # Directories before the last processed one are never looked up again
+                dir_index.prune(lastindex)
 
         pending_dir = []
         for item in pending_dir_info:
@@ -141,34 +218,105 @@ class hdfsManager(object):
     def retrieve_hdfs_ts(self,dir_info,outfile):
         """
         Retrieve server & hdfs timestamp. Note that this method is called in a loop in hdfs_thread_manager
+        Messages are parsed as they are streamed out of HDFS. Parsed events are formatted
+        and written out in one batch whenever buffer_size bytes of output have accumulated,
+        so memory use does not grow with the size of the directory.
         :param dir_info: HDFS timestamp and path to message fetched from snappy file header
         :param outfile: File to write the line of output to
-        :return:
+        :return: PartitionSummary of the rows written
         """
-        try:
-            hdfs_ts, path = dir_info
-            cmd = "hadoop fs -text %s/*" %path
-            result = self.shell_exec.safe_execute(cmd)
-            # Fetches individual messages
-            msg = result.output
-            # Compile regular expression pattern to fetch event_id and server_timestamp
-            pattern = re.compile('.*"event_id":"(.*?)".*?"server_timestamp":([0-9]+)')
-            # Store parsed data
-            event_data = re.findall(pattern,msg)
-
-            # Loop through individual message event data
-            for item in event_data:
-                event_id,server_unix_ts = item
-                # Convert UNIX timestamp in milliseconds to standard timestamp
-                server_ts = datetime.fromtimestamp(int(server_unix_ts)/1000).strftime("%Y-%m-%d %H:%M:%S")
-                # Create output. Add seconds to hdfs_ts so that it is recognizable by Hive timestamp format
-                output = (event_id,server_ts,hdfs_ts+":00\n")
-                # Separate fields with ControlA
-                ctrl_A = '\x01'
-                outfile.write(ctrl_A.join(output))
-
-        except Exception:
-            raise
+        if self.parse_stage is not None:
+            return self.retrieve_hdfs_ts_in_stage(dir_info,outfile)
+
+        hdfs_ts, path = dir_info
+        last_field = row_formatter.hdfs_ts_field(hdfs_ts)
+        summary = PartitionSummary(self.sketch_precision)
+        events = []
+        rows_size = 0
+
+        # Fetches event_id and server_timestamp of individual messages
+        # Sampled on the event id hash, so that Hive keeps the same events
+        for event in sample_events(iter_events(self.record_reader.read(path)),self.sample_threshold):
+            events.append(event)
+            rows_size += row_formatter.row_size(event[0],last_field)
+            if rows_size >= self.buffer_size:
+                self.write_events(events,outfile,summary,hdfs_ts,last_field)
+                events = []
+                rows_size = 0
+
+        if events:
+            self.write_events(events,outfile,summary,hdfs_ts,last_field)
+        return summary
+
+    def write_events(self,events,outfile,summary,hdfs_ts,last_field):
+        """
+        Formats and writes a batch of parsed events
+        :param events: List of (event_id, server_timestamp)
+        :param outfile: File to write the rows to
+        :param summary: PartitionSummary the rows are counted in
+        :param hdfs_ts: HDFS timestamp of the directory the events come from
+        :param last_field: Last field of the rows
+        :return: None
+        """
+        # Convert UNIX timestamps in milliseconds to standard timestamps for the whole batch
+        outfile.write(row_formatter.format_rows(events,last_field,self.ts_cache))
+        min_server_ts,max_server_ts = server_ts_range(events)
+        summary.add(len(events),min_server_ts,max_server_ts,hdfs_ts)
+        if summary.sketch is not None:
+            summary.sketch.update(event_id for event_id,_ in events)
+
+    def retrieve_hdfs_ts_in_stage(self,dir_info,outfile):
+        """
+        Retrieve server & hdfs timestamp, leaving parsing to the parser processes of parse_stage.
+        Raw messages are sent off in chunks of parse_stage.chunk_size bytes while the next
+        chunk is read; rows come back in order and are written as soon as they are ready.
+        :param dir_info: HDFS timestamp and path to message fetched from snappy file header
+        :param outfile: File to write the line of output to
+        :return: PartitionSummary of the rows written
+        """
+        hdfs_ts, path = dir_info
+        last_field = row_formatter.hdfs_ts_field(hdfs_ts)
+        summary = PartitionSummary(self.sketch_precision)
+        pending = collections.deque()
+        lines = []
+        chunk_size = 0
+
+        for line in self.record_reader.read(path):
+            # The last line of a file may lack its newline; keep it apart from the next file's first line
+            if not line.endswith("\n"):
+                line += "\n"
+            lines.append(line)
+            chunk_size += len(line)
+            if chunk_size >= self.parse_stage.chunk_size:
+                pending.append(self.parse_stage.submit("".join(lines),last_field,self.sketch_precision,
+                                                       self.sample_threshold))
+                lines = []
+                chunk_size = 0
+                if len(pending) >= self.parse_stage.in_flight:
+                    self.write_parsed(pending.popleft(),outfile,summary,hdfs_ts)
+
+        if lines:
+            pending.append(self.parse_stage.submit("".join(lines),last_field,self.sketch_precision,
+                                                   self.sample_threshold))
+        while pending:
+            self.write_parsed(pending.popleft(),outfile,summary,hdfs_ts)
+        return summary
+
+    def write_parsed(self,result,outfile,summary,hdfs_ts):
+        """
+        Waits for a chunk submitted to the parse stage and writes its rows
+        :param result: AsyncResult of ParseStage.submit
+        :param outfile: File to write the rows to
+        :param summary: PartitionSummary the rows are counted in
+        :param hdfs_ts: HDFS timestamp of the directory the rows come from
+        :return: None
+        """
+        rows,row_count,min_server_ts,max_server_ts,sketch = result.get()
+        if row_count:
+            outfile.write(rows)
+            summary.add(row_count,min_server_ts,max_server_ts,hdfs_ts)
+            if sketch is not None:
+                summary.sketch.merge(HyperLogLog.deserialize(sketch))
 
     def create_hdfs_ts_ptn(self,partition,table,hive_hdfs_ts_path):
         """
@@ -177,16 +325,24 @@ class hdfsManager(object):
         :param table:
         :return:
         """
-        ptn_year,ptn_month,ptn_day,ptn_hour = partition.split("/")
+        self.create_hdfs_ts_ptns([partition],table,hive_hdfs_ts_path)
+
+    def create_hdfs_ts_ptns(self,partitions,table,hive_hdfs_ts_path):
+        """
+        Adds partitions to the server & hdfs timestamp Hive table in a single
+        Hive session and a single multi-partition statement
+        :param partitions: The partitions to be created. Expected format: YYYY/MM/DD/HH
+        :param table:
+        :return:
+        """
+        if not partitions:
+            return
+        ptn_specs = [hiveql.ptn_spec(partition,"%s/%s" %(hive_hdfs_ts_path,partition)) for partition in partitions]
 
-        create_ptn_cmd = '''
-        hive -e "use flowview;
-        alter table %s_hdfs add if not exists partition (year = %s, month = %s, day = %s, hour = %s)
-        location '%s/%s/%s/%s/%s'";
-        ''' %(table, ptn_year,ptn_month,ptn_day,ptn_hour,
-              hive_hdfs_ts_path, ptn_year,ptn_month,ptn_day,ptn_hour)
+        create_ptn_stmts = ["use flowview",
+                            "alter table %s_hdfs add if not exists\n        %s" %(table,"\n        ".join(ptn_specs))]
         try:
-            self.shell_exec.safe_execute(create_ptn_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(create_ptn_stmts)
         except ShellException:
             logger.error("Error in creating hive table to store server and hdfs timestamp")
             raise
\ No newline at end of file
@@ -1,82 +1,145 @@
-import Queue
+import collections
+import errno
+import os
+import sys
 import threading
 import logging
-import os
-import errno
 from flowview import utils
-from flowview.shell_executor import ShellExecutor, ShellException
+from flowview.shell_executor import ShellExecutor, ShellException, DEFAULT_STREAM_BUFSIZE
 from flowview.hdfs_manager import hdfsManager
+from flowview.worker_pool import WorkerPool
+from flowview.partition_writer import PartitionWriter, DEFAULT_WRITER_COUNT, dir_file_name
+from flowview.parse_stage import ParseStage
+from flowview.load_summary import LoadSummary
+from flowview.upload_stage import UploadStage, DEFAULT_UPLOAD_WORKERS
 logger = logging.getLogger(__name__)
 
-exitFlag = 0
+# Number of directories read concurrently unless configured otherwise
+DEFAULT_WORKER_COUNT = 10
 
-class HDFS_ThreadManager(threading.Thread):
+class HDFS_ThreadManager(object):
 
-    def __init__(self,name,workQueue,topic,table,ptn_list,local_hdfs_ts_path):
+    def __init__(self,topic,table,ptn_list,writer,
+                 buffer_size=DEFAULT_STREAM_BUFSIZE,record_reader=None,parse_stage=None,load_summary=None,
+                 journal=None,upload_stage=None,dir_counts=None):
         """
         Initialization method for HDFS_TheadManager.
-        Leverages Python multithreading library to accelerate
-        HDFS file reading process.
-        :param name: Name of the thread. E.g: Thread#
-        :param workQueue: Queue storing directories to read from
+        Processes the directories handed out by the worker pool
+        of hdfs_thread_execute to accelerate HDFS file reading process.
         :param topic: Dataset's Trinity topic name
         :param table: Dataset's Thrive table name in Hive
         :param dir_list: A set list stores all of the partitions created
+        :param writer: PartitionWriter receiving the rows of each partition
+        :param buffer_size: Size in bytes of the buffers used when streaming HDFS content
+        :param record_reader: Reader decoding the records of an HDFS directory
+        :param parse_stage: ParseStage parsing messages outside of the I/O threads
+        :param load_summary: LoadSummary the rows written to each partition are counted in
+        :param journal: LoadJournal recording each directory once its rows are on disk
+        :param upload_stage: UploadStage each partition is submitted to once all of its directories are on disk
+        :param dir_counts: Dictionary from partition to the number of its directories to extract
         :return:
         """
-        threading.Thread.__init__(self)
-        self.name = name
         self.topic = topic
-        self.workQueue = workQueue
         self.table = table
-        self.hdfsMng = hdfsManager(topic)
         self.ptn_list = ptn_list
-        self.local_hdfs_ts_path = local_hdfs_ts_path
-
-    def run(self):
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.record_reader = record_reader
+        self.parse_stage = parse_stage
+        self.load_summary = load_summary if load_summary is not None else LoadSummary()
+        self.journal = journal
+        self.upload_stage = upload_stage
+        self.dir_counts = dict(dir_counts or {})
+        self.counts_lock = threading.Lock()
+        # hdfsManager keeps per-directory caches, so each worker thread gets its own
+        self.local = threading.local()
+
+    def get_hdfs_mng(self):
         """
-        Custmized run method that overrides the default multithreading run().
-        :return:
+        :return: hdfsManager of the calling worker thread
         """
-        logger.info("Starting %s" %self.name)
-        self.process_data(self.name,self.workQueue,self.ptn_list,self.local_hdfs_ts_path)
-        logger.info("Exiting %s" %self.name)
-
-    def process_data(self,threadName,workQueue,ptn_list,local_hdfs_ts_path):
+        if not hasattr(self.local,"hdfs_mng"):
+            self.local.hdfs_mng = hdfsManager(self.topic,self.buffer_size,self.record_reader,
+                                              self.parse_stage,
+                                              sketch_precision=self.load_summary.sketch_precision,
+                                              sample_threshold=self.load_summary.sample_threshold)
+        return self.local.hdfs_mng
+
+    def process_data(self,dir_info):
         """
-        Supporting method for the run method.
-        :param threadName:
-        :param workQueue:
-        :param ptn_list:
+        Retrieves the timestamps of one directory. Called by the worker pool threads.
+        :param dir_info: (HDFS timestamp, path) of the directory to be processed
         :return:
         """
-        while not exitFlag:
-            queueLock = threading.Lock()
-            # Lock the workQueue so that only one thread can read from it at a time
-            queueLock.acquire()
-            if not workQueue.empty():
-                # Retrieve the directory to be processed
-                dir_info = workQueue.get()
-                ptn_year,ptn_month,ptn_day,ptn_hour,ptn_min = utils.dir_to_ptn(dir_info[0])
-                # Add the processed directory timestamp into the directory list
-                ptn_list.add("%s/%s/%s/%s" %(ptn_year,ptn_month,ptn_day,ptn_hour))
-                # Localpath to temporarily store the timestamp files
-                local_ptn_path = "%s/%s/%s/%s/%s" \
-                            %(local_hdfs_ts_path,ptn_year,ptn_month,ptn_day,ptn_hour)
-                filepath = ("%s/hdfs_ts.txt" %local_ptn_path)
-                # Try making local file based on timestamp. Avoid error caused by race condition by ignoring
-                # error caused by directory already exist.
-                try:
-                    os.makedirs(local_ptn_path)
-                except OSError as Exception:
-                    if Exception.errno != errno.EEXIST:
-                        raise
-                with open (filepath,"a+") as outfile:
-                    self.hdfsMng.retrieve_hdfs_ts(dir_info,outfile)
-            queueLock.release()
-
-
-def hdfs_thread_execute(topic,table,hdfs_pending,ptn_list,local_hdfs_ts_path,hive_hdfs_ts_path):
+        ptn = dir_ptn(dir_info)
+        # Add the processed directory timestamp into the directory list
+        self.ptn_list.add(ptn)
+        # Rows are handed to the partition's writer, which owns the directory's local timestamp file
+        file_name = dir_file_name(dir_info[1])
+        dir_summary = self.get_hdfs_mng().retrieve_hdfs_ts(dir_info,self.writer.sink(ptn,file_name))
+        # Counted by this thread alone, merged into the load totals once the directory is done
+        self.load_summary.merge(ptn,dir_summary)
+        # Called by the writer thread once the file is synced
+        def on_disk():
+            # Journaled, so a resumed load can skip the directory
+            if self.journal is not None:
+                self.journal.dir_extracted(dir_info,ptn,dir_summary)
+            self.dir_done(ptn)
+        self.writer.finish(ptn,file_name,on_disk)
+
+    def dir_done(self,ptn):
+        """
+        Hands a partition to the upload stage once its last directory is on disk
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :return: None
+        """
+        with self.counts_lock:
+            self.dir_counts[ptn] -= 1
+            complete = self.dir_counts[ptn] == 0
+        if complete and self.upload_stage is not None:
+            self.upload_stage.submit(ptn)
+
+
+def dir_ptn(dir_info):
+    """
+    :param dir_info: (hdfs timestamp, path) of a directory
+    :return: Partition in the format of YYYY/MM/DD/HH the directory's rows are written to
+    """
+    ptn_year,ptn_month,ptn_day,ptn_hour,ptn_min = utils.dir_to_ptn(dir_info[0])
+    return "%s/%s/%s/%s" %(ptn_year,ptn_month,ptn_day,ptn_hour)
+
+
+def resume_extraction(hdfs_pending,ptn_list,local_hdfs_ts_path,journal,load_summary):
+    """
+    Restores the directories a failed load extracted, and removes the partial files of the others
+    :return: Directories still to extract
+    """
+    remaining = []
+    for dir_info in hdfs_pending:
+        extracted = journal.dirs.get(dir_info[1])
+        if extracted is not None:
+            ptn,dir_summary = extracted
+            ptn_list.add(ptn)
+            load_summary.merge(ptn,dir_summary)
+            continue
+        remaining.append(dir_info)
+        partial_path = "%s/%s/%s" %(local_hdfs_ts_path,dir_ptn(dir_info),dir_file_name(dir_info[1]))
+        try:
+            os.remove(partial_path)
+            logger.info("Removed partial file %s" %partial_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    logger.info("Resumed extraction: %s directories done, %s remaining"
+                %(len(hdfs_pending) - len(remaining),len(remaining)))
+    return remaining
+
+
+def hdfs_thread_execute(topic,table,hdfs_pending,ptn_list,local_hdfs_ts_path,hive_hdfs_ts_path,
+                        buffer_size=DEFAULT_STREAM_BUFSIZE,record_reader=None,
+                        worker_count=DEFAULT_WORKER_COUNT,task_timeout=None,
+                        writer_count=DEFAULT_WRITER_COUNT,parse_processes=0,parse_stage=None,
+                        hive_exec=None,load_summary=None,journal=None,upload_workers=DEFAULT_UPLOAD_WORKERS):
     """
     Main hdfs thread executor.
     :param topic: Dataset's Trinity topic name
@@ -84,54 +147,87 @@ def hdfs_thread_execute(topic,table,hdfs_pending,ptn_list,local_hdfs_ts_path,hiv
     :param hdfs_pending: HDFS directories pending processing.
                          Expected format is a list of the following
                          (2015-08-19 10:12, /data/ds_ctg/trinity/thrive_test/d_20150819-1710)
-    :return: The latest processed HDFS directory timestmap (e.g. 2015-08-19 10:12) after the current load
+    :param buffer_size: Size in bytes of the buffers used when streaming HDFS content
+    :param record_reader: Reader decoding the records of an HDFS directory.
+                          Defaults to reading through `hadoop fs -text`.
+    :param worker_count: Number of directories read concurrently
+    :param task_timeout: Seconds after which a directory still being read fails the load. None for no limit.
+    :param writer_count: Number of threads writing the local timestamp files
+    :param parse_processes: Number of processes parsing messages. With 0 the I/O workers
+                            parse the directories they read.
+    :param parse_stage: ParseStage shared with other loads. Takes the place of parse_processes.
+                        Must be given when the caller runs other threads, which a fork would copy
+                        mid-operation.
+    :param hive_exec: Hive backend registering the partitions. Defaults to the hive CLI.
+    :param load_summary: LoadSummary filled with the row counts and timestamp ranges of every partition written
+    :param journal: LoadJournal of the load. Work a failed load journaled is not done again.
+    :param upload_workers: Number of partition batches uploaded and registered at once, while extraction goes on
+    :return: Path of the latest processed HDFS directory
+             (e.g. /data/ds_ctg/trinity/thrive_test/d_20150819-1710) after the current load
     """
-    hdfs_mng = hdfsManager(topic)
-    hdfs_new_last_dir = hdfs_pending[-1][0]
-    threads = []
-    workQueue = Queue.Queue()
-
-    # remove previous local file, if it exists
-    rmcmd = "rm -r -f %s" %local_hdfs_ts_path
-    ShellExecutor.safe_execute(rmcmd)
-    logger.info("Removed local file containing timestamps from previous load")
-
-    threadNum = 11
-    # Lock the hdfs_pending list so that only one thread can access it
-    queueLock = threading.Lock()
-    queueLock.acquire()
-    for dir in hdfs_pending:
-        workQueue.put(dir)
-    queueLock.release()
-
-    for t in range (1,threadNum):
-        thread = HDFS_ThreadManager("thread%s"%t,workQueue,topic,table,ptn_list,local_hdfs_ts_path)
-        thread.start()
-        threads.append(thread)
-
-    while not workQueue.empty():
-        pass
-
-    global exitFlag
-    exitFlag = 1
-
-    logger.info("Retrieved server & hdfs timestamp info of %s" %topic)
-
-    # Only exit the main thread after all threads finish
-    for t in threads:
-        t.join()
-
-    # For all directories processed in the current load,
-    # (1) transfer the local files that stores the messages' timestamps
-    #     to the proper Hive warehouse location
-    # (2) create a partition that points toward that location
-    for ptn in ptn_list:
-        local_dir_path = "%s/%s/hdfs_ts.txt" %(local_hdfs_ts_path,ptn)
-        hdfs_tgt_path = "%s/%s" %(hive_hdfs_ts_path,ptn)
-
-        hdfs_mng.makedir(hdfs_tgt_path)
-        hdfs_mng.force_putfile(local_dir_path,hdfs_tgt_path)
-        hdfs_mng.create_hdfs_ts_ptn(ptn,table,hive_hdfs_ts_path)
+    hdfs_mng = hdfsManager(topic,hive_exec=hive_exec)
+    # Directories are checkpointed by path: several of them may share a modification minute
+    hdfs_new_last_dir = hdfs_pending[-1][1]
+
+    load_summary = load_summary if load_summary is not None else LoadSummary()
+    if journal is not None and journal.resumed:
+        # Files of the directories extracted by the failed load are kept
+        hdfs_pending = resume_extraction(hdfs_pending,ptn_list,local_hdfs_ts_path,journal,load_summary)
+    else:
+        # remove previous local file, if it exists
+        rmcmd = "rm -r -f %s" %local_hdfs_ts_path
+        ShellExecutor.safe_execute(rmcmd)
+        logger.info("Removed local file containing timestamps from previous load")
+    # Partitions receiving rows in this run, which have to be uploaded even if a failed load did
+    dir_counts = collections.Counter(dir_ptn(dir_info) for dir_info in hdfs_pending)
+
+    # The parser processes are forked before the I/O and writer threads start. Callers running
+    # other threads pass a parse_stage created before those threads instead.
+    own_parse_stage = parse_stage is None and parse_processes > 0
+    if own_parse_stage:
+        parse_stage = ParseStage(parse_processes)
+
+    try:
+        # For every partition whose directories are all extracted,
+        # (1) transfer the local files that stores the messages' timestamps
+        #     to the proper Hive warehouse location
+        # (2) create a partition that points toward that location
+        # while the remaining directories are extracted
+        upload_stage = UploadStage(hdfs_mng,table,local_hdfs_ts_path,hive_hdfs_ts_path,upload_workers,
+                                   journal,set(dir_counts))
+        # Partitions restored from the journal with no directory left to extract
+        for ptn in sorted(ptn_list - set(dir_counts)):
+            upload_stage.submit(ptn)
+        writer = PartitionWriter(local_hdfs_ts_path,writer_count,buffer_size)
+        thread_mng = HDFS_ThreadManager(topic,table,ptn_list,writer,buffer_size,record_reader,parse_stage,
+                                        load_summary,journal,upload_stage,dir_counts)
+        # A directory read past task_timeout has its hadoop process killed, which ends the read
+        # and frees the process slot, so that a long-running process does not leak them
+        pool = WorkerPool("hdfs",worker_count,thread_mng.process_data,task_timeout=task_timeout,
+                          on_timeout=lambda dir_info,thread: ShellExecutor.kill_thread_processes(thread.ident))
+        for dir_info in hdfs_pending:
+            pool.submit(dir_info)
+
+        try:
+            try:
+                # Blocks until every directory is processed. Raises the first error of any worker.
+                pool.join()
+            finally:
+                # Flushes and closes the local timestamp files
+                writer.close()
+        except Exception:
+            # Uploads already started are finished, so the journal is closed with nothing in flight
+            exc_info = sys.exc_info()
+            try:
+                upload_stage.join()
+            except Exception:
+                logger.error("Upload of extracted partitions failed as well")
+            raise exc_info[0],exc_info[1],exc_info[2]
+        logger.info("Retrieved server & hdfs timestamp info of %s" %topic)
+        upload_stage.join()
+    finally:
+        if own_parse_stage:
+            parse_stage.close()
 
     logger.info("Copied hdfs & server timestamp from local to hive warehouse")
     logger.info("Created hive partition for hdfs & server timestamp")
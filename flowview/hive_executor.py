@@ -0,0 +1,212 @@
+import Queue
+import logging
+import threading
+from contextlib import contextmanager
+from flowview.shell_executor import ShellExecutor, ShellException, DEFAULT_STREAM_BUFSIZE
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept open to HiveServer2 unless configured otherwise
+DEFAULT_POOL_SIZE = 4
+DEFAULT_HIVESERVER2_PORT = 10000
+
+
+class HiveException(ShellException):
+    """
+    Raised by every Hive backend. Derives from ShellException so that callers
+    handling failures of the hive CLI handle the other backends the same way.
+    """
+    pass
+
+
+def parse_rows(output):
+    """
+    Splits hive CLI output into rows
+    :param output: Standard output of the hive CLI
+    :return: List of tuples of column values
+    """
+    return [tuple(line.split("\t")) for line in output.split("\n") if line]
+
+
+class HiveCliExecutor(object):
+    """
+    Runs HiveQL statements through the hive CLI. Every call starts a new
+    `hive -e` process, with its own JVM and metastore connection.
+    """
+    def script(self,statements):
+        return "\n".join("%s;" %statement for statement in statements)
+
+    def execute(self,statements):
+        """
+        Runs statements in one Hive session
+        :param statements: List of HiveQL statements, without trailing semicolons
+        :return: Rows returned by the statements, as tuples of strings
+        """
+        cmd = 'hive -e "%s"' %self.script(statements)
+        try:
+            result = ShellExecutor.safe_execute(cmd,splitcmd=False,as_shell=True)
+        except ShellException as e:
+            raise HiveException(*e.args)
+        return parse_rows(result.output)
+
+    def close(self):
+        """
+        Nothing to close: every call runs its own process
+        :return: None
+        """
+
+    def stream(self,statements,bufsize=DEFAULT_STREAM_BUFSIZE):
+        """
+        Runs statements in one Hive session and yields rows as they are produced
+        :param statements: List of HiveQL statements, without trailing semicolons
+        :return: Generator over rows, as tuples of strings
+        """
+        cmd = 'hive -e "%s"' %self.script(statements)
+        try:
+            for line in ShellExecutor.stream_execute(cmd,bufsize=bufsize,splitcmd=False,as_shell=True):
+                line = line.rstrip("\n")
+                if line:
+                    yield tuple(line.split("\t"))
+        except ShellException as e:
+            raise HiveException(*e.args)
+
+
+def _pyhive_connect(host,port,username,database):
+    try:
+        from pyhive import hive
+    except ImportError:
+        raise HiveException("pyhive is required by the hiveserver2 Hive backend")
+    return hive.connect(host=host,port=port,username=username,database=database)
+
+
+class HiveServer2Executor(object):
+    """
+    Runs HiveQL statements over a pool of HiveServer2 sessions kept open for the
+    whole run, so statements pay neither CLI startup nor metastore connection.
+    Connections come from a DB-API connect function (pyhive by default), which
+    can be replaced to run against a stand-in server or a mocked transport.
+    Session state such as the current database survives between calls on a
+    pooled session, so every call should start with its own "use" statement.
+    """
+    def __init__(self,host,port=DEFAULT_HIVESERVER2_PORT,username=None,database="default",
+                 pool_size=DEFAULT_POOL_SIZE,connect=None):
+        """
+        :param host: HiveServer2 host
+        :param port: HiveServer2 port
+        :param username: User the sessions are opened for
+        :param database: Database the sessions start in
+        :param pool_size: Maximum number of sessions open at a time
+        :param connect: Function (host, port, username, database) returning a DB-API connection
+        :return:
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.database = database
+        self.connect = connect if connect is not None else _pyhive_connect
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.idle = Queue.LifoQueue()
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows a session from the pool, opening one if none is idle. A session whose
+        statements failed is closed instead of being returned to the pool.
+        :return: DB-API cursor
+        """
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except Queue.Empty:
+                try:
+                    connection = self.connect(self.host,self.port,self.username,self.database)
+                except HiveException:
+                    raise
+                except Exception as e:
+                    logger.error("Could not connect to HiveServer2 %s:%s" %(self.host,self.port))
+                    raise HiveException(str(e))
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            except BaseException:
+                # Also covers a streaming caller that stopped early
+                self._discard(connection)
+                raise
+            else:
+                cursor.close()
+                self.idle.put(connection)
+
+    def _discard(self,connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def execute(self,statements):
+        """
+        Runs statements in one pooled session
+        :param statements: List of HiveQL statements, without trailing semicolons
+        :return: Rows returned by the statements, as tuples, in order like the hive CLI prints them
+        """
+        try:
+            with self.session() as cursor:
+                rows = []
+                for statement in statements:
+                    cursor.execute(statement)
+                    if cursor.description:
+                        rows.extend(tuple(row) for row in cursor.fetchall())
+                return rows
+        except HiveException:
+            raise
+        except Exception as e:
+            raise HiveException(str(e))
+
+    def stream(self,statements,fetch_size=10000):
+        """
+        Runs statements in one pooled session and yields the rows of the last one as they are fetched
+        :param statements: List of HiveQL statements, without trailing semicolons
+        :param fetch_size: Rows fetched per round trip
+        :return: Generator over rows, as tuples
+        """
+        try:
+            with self.session() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+                while cursor.description:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield tuple(row)
+        except HiveException:
+            raise
+        except Exception as e:
+            raise HiveException(str(e))
+
+    def close(self):
+        """
+        Closes the idle sessions
+        :return: None
+        """
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except Queue.Empty:
+                return
+
+
+def get_hive_executor(backend="cli",host=None,port=DEFAULT_HIVESERVER2_PORT,username=None,
+                      pool_size=DEFAULT_POOL_SIZE):
+    """
+    Builds the Hive backend selected in the config file
+    :param backend: "cli" for the hive CLI, "hiveserver2" for pooled HiveServer2 sessions
+    :return: Hive executor
+    """
+    if backend == "cli":
+        return HiveCliExecutor()
+    elif backend == "hiveserver2":
+        if not host:
+            raise HiveException("hive_host is required by the hiveserver2 Hive backend")
+        return HiveServer2Executor(host,port,username,pool_size=pool_size)
+    else:
+        raise HiveException("Invalid Hive backend: %s" %backend)
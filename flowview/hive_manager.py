@@ -1,21 +1,69 @@
 # Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
-from flowview.shell_executor import ShellExecutor, ShellException
+from flowview.shell_executor import ShellException
+from flowview.hive_executor import HiveCliExecutor
+from flowview import hiveql
+from flowview.hll import HyperLogLog, estimate_overlap
+from flowview import sampling
+from flowview.worker_pool import WorkerPool
 from flowview import utils
+import bisect
 import logging
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# Partitions pulled by one multi-insert statement unless configured otherwise
+DEFAULT_PULL_BATCH_SIZE = 24
+# Hive sessions pulling partitions at once in batch mode unless configured otherwise. With 1 the
+# source table is scanned once per batch_size partitions in a single session. Above 1 the partitions
+# are spread over at least that many multi-insert statements, each a job of its own: every batch
+# pays a job launch, and source data holding the hours of several batches is read once per batch.
+DEFAULT_PULL_CONCURRENCY = 1
+# Hive sessions pulling partitions at once in partition mode unless configured otherwise.
+# Each partition is a job of its own there anyway, so pulling several at once costs no extra scan.
+DEFAULT_PTN_PULL_CONCURRENCY = 2
+
 class HiveManager(object):
 
-    def __init__(self,db,table):
+    def __init__(self,db,table,hive_exec=None,check_pruning=False,sample_threshold=None):
         """
         :param db:
         :param table:
+        :param hive_exec: Hive backend running the statements. Defaults to the hive CLI.
+        :param check_pruning: Test mode. Verifies with EXPLAIN DEPENDENCY that every row count
+                              query only reads the partitions it is meant to, before running it.
+        :param sample_threshold: Sample of the events pulled, as returned by sampling.sample_threshold.
+                                 Must match the sample of the HDFS extraction. None to pull every event.
         :return:
         """
         self.database = db
         self.table = table
-        self.shell_exec = ShellExecutor()
+        self.hive_exec = hive_exec if hive_exec is not None else HiveCliExecutor()
+        self.check_pruning = check_pruning
+        self.sample_threshold = sample_threshold
+
+    def pull_filter(self,partitions):
+        """
+        :param partitions: partitions in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+        :return: Predicate selecting the rows of the partitions pulled into FlowView
+        """
+        predicate = hiveql.ptns_predicate(partitions)
+        sample_predicate = sampling.hive_predicate(self.sample_threshold)
+        if sample_predicate is not None:
+            # Same hash as the HDFS extraction, so the sampled events still join
+            predicate = "%s and %s" %(predicate,sample_predicate)
+        return predicate
+
+    def run_count(self,count_stmts,expected):
+        """
+        Runs a row count query, after checking its partition pruning in test mode
+        :param count_stmts: Statements, ending with the count query
+        :param expected: Dictionary from table name (db@table) to the maximum number of partitions read
+        :return: Rows of the query
+        """
+        if self.check_pruning:
+            hiveql.check_pruning(self.hive_exec,count_stmts,expected)
+        return self.hive_exec.execute(count_stmts)
 
     def pull_hive_ts(self,partition,hive_hive_ts_path):
         """
@@ -26,48 +74,118 @@ class HiveManager(object):
         """
         ptn_year,ptn_month,ptn_day,ptn_hour = utils.split_ptn(partition)
 
-        pull_cmd = '''
-        hive -e "use %s;
-        insert overwrite directory '%s/%s/%s/%s/%s'
+        pull_stmts = ["use %s" %self.database,
+                      '''insert overwrite directory '%s/%s/%s/%s/%s'
         select event_id, hive_timestamp from %s
-        where year = %s and month = %s and day = %s and hour = %s;"''' \
-                   %(self.database,hive_hive_ts_path,ptn_year,ptn_month,ptn_day,ptn_hour,
-          self.table, ptn_year, ptn_month,ptn_day,ptn_hour)
+        where %s''' %(hive_hive_ts_path,ptn_year,ptn_month,ptn_day,ptn_hour,
+                      self.table,self.pull_filter([partition]))]
 
         try:
-            self.shell_exec.safe_execute(pull_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(pull_stmts)
         except Exception:
             logger.error("Error pulling data from %s hive table and writing to flowview database" %self.database)
+            raise
 
         logger.info("Wrote hive timestamp data into hive table flowview.db/%s_hive_ts" %self.table)
 
-    def get_new_ptns(self,last_ptn):
+    def pull_hive_ts_ptns(self,partitions,hive_hive_ts_path,batch_size=DEFAULT_PULL_BATCH_SIZE,on_batch=None,
+                          concurrency=1):
+        """
+        Creates the FlowView partitions for the given list of partitions and pulls their
+        hive timestamps. The pulls are Hive multi-inserts, so the source table is scanned
+        once per batch_size partitions instead of once per partition. With a concurrency
+        of 1, everything runs in a single Hive session.
+        :param partitions: partitions in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+        :param batch_size: Maximum number of partitions pulled by one multi-insert statement
+        :param on_batch: Function called with the partitions pulled, once they are all pulled,
+                         or after each batch when batches run concurrently
+        :param concurrency: Number of batches pulled at once, each in a Hive session of its own.
+                            Partitions are then spread over at least that many batches, at the
+                            cost described with DEFAULT_PULL_CONCURRENCY.
+        :return:
+        """
+        if not partitions:
+            return
+        if concurrency > 1:
+            batch_size = max(1,min(batch_size,-(-len(partitions) // concurrency)))
+        ptn_dirs = ["%s/%s" %(hive_hive_ts_path,"/".join(utils.split_ptn(partition))) for partition in partitions]
+        ptn_specs = [hiveql.ptn_spec(partition,ptn_dir) for partition,ptn_dir in zip(partitions,ptn_dirs)]
+
+        pull_stmts = ["use flowview",
+                      "alter table %s_hive add if not exists\n        %s" %(self.table,"\n        ".join(ptn_specs)),
+                      "use %s" %self.database]
+        batches = []
+        for start in range(0,len(partitions),batch_size):
+            branches = ["insert overwrite directory '%s'\n"
+                        "        select event_id, hive_timestamp\n"
+                        "        where %s" %(ptn_dir,self.pull_filter([partition]))
+                        for partition,ptn_dir in zip(partitions[start:start + batch_size],
+                                                     ptn_dirs[start:start + batch_size])]
+            batches.append((partitions[start:start + batch_size],
+                            "from %s\n        %s" %(self.table,"\n        ".join(branches))))
+
+        try:
+            if concurrency > 1 and len(batches) > 1:
+                # The partitions are created first, then the batches share them
+                self.hive_exec.execute(pull_stmts[:2])
+                def pull_batch(batch):
+                    batch_ptns,batch_stmt = batch
+                    self.hive_exec.execute(pull_stmts[2:] + [batch_stmt])
+                    if on_batch is not None:
+                        on_batch(batch_ptns)
+                pool = WorkerPool("hive",min(concurrency,len(batches)),pull_batch)
+                for batch in batches:
+                    pool.submit(batch)
+                pool.join()
+            else:
+                self.hive_exec.execute(pull_stmts + [batch_stmt for _,batch_stmt in batches])
+                if on_batch is not None:
+                    on_batch(partitions)
+        except ShellException:
+            logger.error("Error pulling data from %s hive table and writing to flowview database" %self.database)
+            raise
+
+        logger.info("Created %s hive partitions and wrote hive timestamp data into hive table flowview.db/%s_hive"
+                    %(len(partitions),self.table))
+
+    def get_new_ptns(self,last_ptn,closed_before=None):
         """
         Retrieves partitions in Hive whose timestamps have not been retrieved.
+        Only the months from the last processed partition on are listed, so the metastore
+        work does not grow with the table's history.
         :param lastptn: Last processed partition in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+        :param closed_before: datetime. The newest partition counts as closed if its hour ended before.
+                              None to always leave the newest partition.
         :return:  a list of partitions to process in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
         """
+        month_specs = hiveql.month_specs(last_ptn) if last_ptn is not None else None
+        if month_specs is None:
+            ptn_stmts = ["use %s" %self.database,
+                         "show partitions %s" %self.table]
+        else:
+            ptn_stmts = ["use %s" %self.database] + \
+                        ["show partitions %s %s" %(self.table,spec) for spec in month_specs]
         try:
-            ptn_cmd = '''
-            hive -e "use %s;
-            show partitions %s;"
-            ''' %(self.database,self.table)
-            all_ptns = self.shell_exec.safe_execute(ptn_cmd,splitcmd=False,as_shell=True).output.split()
-        except Exception:
+            all_ptns = [row[0] for row in self.hive_exec.execute(ptn_stmts)]
+        except ShellException:
+            logger.error("Error listing partitions of table %s" %self.table)
             raise
+        # Ordered by partition values, not as text
+        keyed_ptns = sorted((hiveql.ptn_key(ptn),ptn) for ptn in all_ptns)
+        all_ptns = [ptn for _,ptn in keyed_ptns]
         # If last partition is None, then the current load is the first load.
         # Process all existing partitions
-        try:
-             if last_ptn is None:
-                 new_ptns = all_ptns
-             else:
-                 lastindex = all_ptns.index(last_ptn)
-                 # Omit the very last ptn since Thrive/ETL pipeline may still be writing to it
-                 new_ptns = all_ptns[lastindex + 1: -1]
-        except ValueError:
-             logger.error("Last processed partition %s not found in table %s"
-                          %(last_ptn,self.table))
-             raise
+        if last_ptn is None:
+            new_ptns = all_ptns
+        else:
+            # The partitions after the last processed one, even if retention has dropped it since
+            lastindex = bisect.bisect_right([key for key,_ in keyed_ptns],hiveql.ptn_key(last_ptn))
+            new_ptns = all_ptns[lastindex:]
+            # Omit the very last ptn since Thrive/ETL pipeline may still be writing to it,
+            # unless its hour is over for long enough to be closed
+            if new_ptns and (closed_before is None or
+                             hiveql.ptn_hour(new_ptns[-1]) + timedelta(hours=1) > closed_before):
+                new_ptns = new_ptns[:-1]
         logger.info("Retrieved processed partition %s" % last_ptn)
         logger.info("Pending partitions %s" %new_ptns)
 
@@ -80,16 +198,13 @@ class HiveManager(object):
         :return:
         """
         ptn_year,ptn_month,ptn_day,ptn_hour = utils.split_ptn(partition)
+        ptn_dir = "%s/%s/%s/%s/%s" %(hive_hive_ts_path,ptn_year,ptn_month,ptn_day,ptn_hour)
 
-        create_ptn_cmd = '''
-        hive -e "use flowview;
-        alter table %s_hive add partition (year = %s, month = %s, day = %s, hour = %s)
-        location '%s/%s/%s/%s/%s'";
-        ''' %(self.table, ptn_year,ptn_month,ptn_day,ptn_hour,
-              hive_hive_ts_path, ptn_year,ptn_month,ptn_day,ptn_hour)
+        create_ptn_stmts = ["use flowview",
+                            "alter table %s_hive add if not exists %s" %(self.table,hiveql.ptn_spec(partition,ptn_dir))]
 
         try:
-            self.shell_exec.safe_execute(create_ptn_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(create_ptn_stmts)
         except ShellException:
             logger.error("Error in creating hive table to store hive timestamp")
             raise
@@ -98,66 +213,206 @@ class HiveManager(object):
                     %(ptn_year,ptn_month,ptn_day,ptn_hour,self.table))
 
     def count_hdfs_ptn_rows(self,ptn):
-        (ptn_year,ptn_month,ptn_day,ptn_hour) = ptn.split("/")
-        count_cmd = '''
-        hive -e "use flowview;
-        select count (*) from %s_hdfs
-        where year = %s and month = %s and day = %s and hour = %s;"
-        '''%(self.table,ptn_year,ptn_month,ptn_day,ptn_hour)
+        count_stmts = ["use flowview",
+                       '''select count (*) from %s_hdfs
+        where %s''' %(self.table,hiveql.ptns_predicate([ptn]))]
 
         try:
-            row_count = self.shell_exec.safe_execute(count_cmd,splitcmd=False,as_shell=True).output
+            row_count = self.run_count(count_stmts,{"flowview@%s_hdfs" %self.table: 1})[0][0]
             return row_count
         except ShellException:
             logger.error("Error getting row counts for hdfs_ts partition %s" %ptn)
             raise
 
     def count_hive_ptn_rows(self,ptn):
-        (ptn_year,ptn_month,ptn_day,ptn_hour) = ptn.split("/")
-        ptn_hour_latency = int(ptn_hour) + 1
-        where_clause = "%s_hdfs.year = %s and %s_hdfs.month = %s and %s_hdfs.day = %s and %s_hdfs.hour = %s " \
-                       "and %s_hive.year = %s and %s_hive.month = %s and %s_hive.day = %s and %s_hive.hour = %s " \
-                       "or %s_hive.hour = %s" \
-                       %(self.table,ptn_year,self.table,ptn_month,self.table, ptn_day, self.table, ptn_hour,
-                         self.table,ptn_year,self.table,ptn_month,self.table, ptn_day, self.table, ptn_hour,
-                         self.table,ptn_hour_latency)
-
-        count_cmd = '''
-        hive -e "use flowview;
-        select count (*) from %s_hdfs join %s_hive on (%s_hdfs.event_id = %s_hive.event_id)
-        where %s;"
-        ''' %(self.table,self.table,self.table,self.table,where_clause)
+        # hdfs rows of the partition matched by hive rows of the partition's hour or the next one
+        where_clause = "%s and %s" %(hiveql.ptns_predicate([ptn],"%s_hdfs" %self.table),
+                                     hiveql.windows_predicate([ptn],"%s_hive" %self.table))
+
+        count_stmts = ["use flowview",
+                       '''select count (*) from %s_hdfs join %s_hive on (%s_hdfs.event_id = %s_hive.event_id)
+        where %s''' %(self.table,self.table,self.table,self.table,where_clause)]
 
         try:
-            matching_row_cnt = self.shell_exec.safe_execute(count_cmd,splitcmd=False,as_shell=True).output
+            matching_row_cnt = self.run_count(count_stmts,{"flowview@%s_hdfs" %self.table: 1,
+                                                           "flowview@%s_hive" %self.table: hiveql.DEFAULT_WINDOW_HOURS})[0][0]
             return matching_row_cnt
         except ShellException:
             logger.error("Error getting row counts")
             raise
 
-    def load_ptn_transmitted_ratio(self,ptn):
+    def load_ptn_transmitted_ratio(self,ptn,hdfs_ptn_row_cnt=None):
+        """
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param hdfs_ptn_row_cnt: Rows of the partition counted during extraction. Counted in Hive if None.
+        :return: Ratio of matched rows to hdfs rows
+        """
         try:
-            hdfs_ptn_row_cnt = self.count_hdfs_ptn_rows(ptn)
+            if hdfs_ptn_row_cnt is None:
+                hdfs_ptn_row_cnt = self.count_hdfs_ptn_rows(ptn)
             hive_ptn_row_cnt = self.count_hive_ptn_rows(ptn)
-            return (int(hive_ptn_row_cnt)/int(hdfs_ptn_row_cnt))
+            return float(hive_ptn_row_cnt)/int(hdfs_ptn_row_cnt)
         except ShellException:
             logger.error("Error retrieving row counts")
             raise
 
+    def load_ptns_transmitted_ratio(self,ptns,load_summary=None):
+        """
+        Computes the transmitted ratio of every given partition with a single grouped query.
+        Each hdfs_ts row is joined to the hive_ts rows with the same event_id in the
+        partitions' hour windows, so the counts of all partitions come out of one scan of each table.
+        :param ptns: Partitions in the format of YYYY/MM/DD/HH
+        :param load_summary: LoadSummary of the HDFS extraction that wrote the partitions. Its row
+                             counts are used as the hdfs counts, and only the rows of its hdfs timestamp
+                             range are matched, so Hive only has to count the matched rows.
+        :return: Dictionary from partition to ratio of matched rows to hdfs rows.
+                 Partitions without hdfs rows are left out.
+        """
+        if not ptns:
+            return {}
+        hdfs_filter = hiveql.ptns_predicate(ptns)
+        hive_filter = hiveql.windows_predicate(ptns)
+
+        if load_summary is None:
+            count_query = '''select hdfs.year, hdfs.month, hdfs.day, hdfs.hour,
+               count(*), sum(if(hive.event_id is null, 0, 1))
+        from (select event_id, year, month, day, hour from %s_hdfs where %s) hdfs
+        left outer join (select event_id from %s_hive where %s) hive
+        on (hdfs.event_id = hive.event_id)
+        group by hdfs.year, hdfs.month, hdfs.day, hdfs.hour''' %(self.table,hdfs_filter,self.table,hive_filter)
+        else:
+            min_hdfs_ts,max_hdfs_ts = load_summary.hdfs_ts_range()
+            if min_hdfs_ts is None:
+                logger.warning("No hdfs timestamp rows in partitions %s" %ptns)
+                return {}
+            hdfs_filter = "%s and hdfs_timestamp between '%s:00' and '%s:00'" %(hdfs_filter,min_hdfs_ts,max_hdfs_ts)
+            count_query = '''select hdfs.year, hdfs.month, hdfs.day, hdfs.hour, count(*)
+        from (select event_id, year, month, day, hour from %s_hdfs where %s) hdfs
+        join (select event_id from %s_hive where %s) hive
+        on (hdfs.event_id = hive.event_id)
+        group by hdfs.year, hdfs.month, hdfs.day, hdfs.hour''' %(self.table,hdfs_filter,self.table,hive_filter)
+
+        try:
+            rows = self.run_count(["use flowview",count_query],
+                                  {"flowview@%s_hdfs" %self.table: len(ptns),
+                                   "flowview@%s_hive" %self.table: len(ptns) * hiveql.DEFAULT_WINDOW_HOURS})
+        except ShellException:
+            logger.error("Error retrieving row counts")
+            raise
+
+        # Hive returns the int partition values unpadded, map them back to the partitions
+        ptn_keys = dict((hiveql.ptn_hour(ptn),ptn) for ptn in ptns)
+        hive_row_cnts = {}
+        hdfs_row_cnts = load_summary.row_counts() if load_summary is not None else {}
+        for row in rows:
+            ptn = ptn_keys[datetime(*[int(value) for value in row[:4]])]
+            if load_summary is None:
+                hdfs_row_cnts[ptn] = int(row[4])
+            hive_row_cnts[ptn] = int(row[-1])
+
+        ratios = {}
+        for ptn in ptns:
+            if hdfs_row_cnts.get(ptn):
+                ratios[ptn] = float(hive_row_cnts.get(ptn,0))/hdfs_row_cnts[ptn]
+            else:
+                logger.warning("No hdfs timestamp rows in partition %s" %ptn)
+        return ratios
+
+    def build_hive_sketches(self,hours,precision):
+        """
+        Sketches the event ids of hive_ts partitions from a streamed projection, so the
+        event ids never have to be held in memory or joined in Hive
+        :param hours: datetimes of the partitions to sketch
+        :param precision: Precision of the sketches
+        :return: Dictionary from partition (YYYY/MM/DD/HH) to HyperLogLog, for partitions holding rows
+        """
+        if not hours:
+            return {}
+        sketch_stmts = ["use flowview",
+                        '''select event_id, year, month, day, hour from %s_hive
+        where %s''' %(self.table,hiveql.hours_predicate(hours))]
+
+        sketches = {}
+        try:
+            for event_id,ptn_year,ptn_month,ptn_day,ptn_hour in self.hive_exec.stream(sketch_stmts):
+                ptn = "%04d/%02d/%02d/%02d" %(int(ptn_year),int(ptn_month),int(ptn_day),int(ptn_hour))
+                sketch = sketches.get(ptn)
+                if sketch is None:
+                    sketch = sketches[ptn] = HyperLogLog(precision)
+                sketch.add(event_id)
+        except ShellException:
+            logger.error("Error streaming event ids of hive timestamp partitions")
+            raise
+        logger.info("Sketched event ids of %s hive timestamp partitions" %len(sketches))
+        return sketches
+
+    def load_ptns_approximate_ratio(self,ptns,hdfs_sketches,sketch_store,refresh_hours=()):
+        """
+        Estimates the transmitted ratio of every given partition from event id sketches.
+        The hdfs sketches of the load are merged into the stored ones, so late arriving
+        data is added to its partition without rescanning earlier data. Hive sketches are
+        reused from the store, and only built for the window hours that have none or
+        whose hive partition was pulled again.
+        The error depends on the sketch precision and on how many more events the hive window
+        holds than the partition: at the default precision it is about 0.25% of the ratio when
+        both hold as many, and 0.43% when the window holds twice as many (see DEFAULT_PRECISION).
+        The error returned is that of each partition's estimate.
+        :param ptns: Partitions in the format of YYYY/MM/DD/HH
+        :param hdfs_sketches: Dictionary from partition to the sketch of the event ids extracted by this load
+        :param sketch_store: SketchStore holding the sketches of previous loads
+        :param refresh_hours: datetimes of the hive partitions pulled by this load
+        :return: Dictionary from partition to (ratio, standard error of the ratio).
+                 Partitions without hdfs rows are left out.
+        """
+        hdfs_sketches = dict((ptn,sketch_store.merge("hdfs",ptn,sketch)) for ptn,sketch in hdfs_sketches.items())
+
+        refresh_hours = set(refresh_hours)
+        window_hours = set()
+        for ptn in ptns:
+            window_hours.update(hiveql.hour_window(ptn))
+        hive_sketches = {}
+        missing_hours = []
+        for hour in window_hours:
+            ptn = hour.strftime("%Y/%m/%d/%H")
+            stored = sketch_store.load("hive",ptn) if hour not in refresh_hours else None
+            if stored is not None:
+                hive_sketches[ptn] = stored
+            else:
+                missing_hours.append(hour)
+        for ptn,sketch in self.build_hive_sketches(missing_hours,sketch_store.precision).items():
+            sketch_store.save("hive",ptn,sketch)
+            hive_sketches[ptn] = sketch
+
+        ratios = {}
+        for ptn in ptns:
+            hdfs_sketch = hdfs_sketches.get(ptn) or sketch_store.load("hdfs",ptn)
+            if hdfs_sketch is None:
+                logger.warning("No hdfs timestamp sketch for partition %s" %ptn)
+                continue
+            window_sketch = HyperLogLog(sketch_store.precision)
+            for hour in hiveql.hour_window(ptn):
+                hive_sketch = hive_sketches.get(hour.strftime("%Y/%m/%d/%H"))
+                if hive_sketch is not None:
+                    window_sketch.merge(hive_sketch)
+            hdfs_cnt,matched_cnt,matched_error = estimate_overlap(hdfs_sketch,window_sketch)
+            if not hdfs_cnt:
+                logger.warning("No hdfs timestamp rows in partition %s" %ptn)
+                continue
+            ratios[ptn] = (min(1.0,matched_cnt / hdfs_cnt),matched_error / hdfs_cnt)
+        return ratios
+
     def purge(self):
         """
         Purges all existing hive table for the dataset.
         :return:
         """
-        purge_cmd = '''
-        hive -e "use flowview;
-        drop table %s_hive;
-        drop table %s_hdfs;"
-        ''' %(self.table,self.table)
+        purge_stmts = ["use flowview",
+                       "drop table %s_hive" %self.table,
+                       "drop table %s_hdfs" %self.table]
 
         try:
-            self.shell_exec.safe_execute(purge_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(purge_stmts)
             logger.info("Purged hive tables")
         except ShellException:
             logger.error("Purging hive tables failed")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,168 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from flowview.hive_executor import HiveException
+
+logger = logging.getLogger(__name__)
+
+PTN_COLUMNS = ("year","month","day","hour")
+# Partition discovery from a checkpoint older than this many months lists the whole table
+MAX_DISCOVERY_MONTHS = 36
+# Hours of hive partitions searched for the events of an hdfs partition: its own hour and the next one
+DEFAULT_WINDOW_HOURS = 2
+
+
+def ptn_hour(ptn):
+    """
+    :param ptn: Partition in the format of YYYY/MM/DD/HH or 'year=YYYY/month=MM/day=DD/hour=HH'
+    :return: datetime of the partition's hour
+    """
+    values = [item.split("=")[-1] for item in ptn.split("/")]
+    return datetime(*[int(value) for value in values])
+
+
+def hour_window(ptn,hours=DEFAULT_WINDOW_HOURS):
+    """
+    Hours starting at the partition's hour. Windows run across day, month and year boundaries,
+    so hour 23 is followed by hour 0 of the next day.
+    :param ptn: Partition in the format of YYYY/MM/DD/HH or 'year=YYYY/month=MM/day=DD/hour=HH'
+    :param hours: Number of hours in the window
+    :return: List of datetimes
+    """
+    start = ptn_hour(ptn)
+    return [start + timedelta(hours=i) for i in range(hours)]
+
+
+def column(name,alias=None):
+    return "%s.%s" %(alias,name) if alias else name
+
+
+def hours_predicate(hours,alias=None):
+    """
+    Predicate selecting exactly the partitions of the given hours. Hours of the same day
+    share one parenthesized term, and the whole predicate is parenthesized, so it can be
+    combined with any other condition without the OR leaking out.
+    :param hours: datetimes of the partitions
+    :param alias: Table alias the partition columns are qualified with
+    :return: HiveQL boolean expression
+    """
+    days = {}
+    for hour in hours:
+        days.setdefault(hour.date(),set()).add(hour.hour)
+    if not days:
+        return "(false)"
+    terms = []
+    for day in sorted(days):
+        day_hours = sorted(days[day])
+        if len(day_hours) == 1:
+            hour_term = "%s = %d" %(column("hour",alias),day_hours[0])
+        else:
+            hour_term = "%s in (%s)" %(column("hour",alias),", ".join("%d" %h for h in day_hours))
+        terms.append("(%s = %d and %s = %d and %s = %d and %s)"
+                     %(column("year",alias),day.year,column("month",alias),day.month,
+                       column("day",alias),day.day,hour_term))
+    return "(%s)" %" or ".join(terms)
+
+
+def ptns_predicate(ptns,alias=None):
+    """
+    :param ptns: Partitions in the format of YYYY/MM/DD/HH or 'year=YYYY/month=MM/day=DD/hour=HH'
+    :param alias: Table alias the partition columns are qualified with
+    :return: HiveQL boolean expression selecting exactly the given partitions
+    """
+    return hours_predicate([ptn_hour(ptn) for ptn in ptns],alias)
+
+
+def windows_predicate(ptns,alias=None,hours=DEFAULT_WINDOW_HOURS):
+    """
+    :param ptns: Partitions in the format of YYYY/MM/DD/HH or 'year=YYYY/month=MM/day=DD/hour=HH'
+    :param alias: Table alias the partition columns are qualified with
+    :param hours: Number of hours in the window of each partition
+    :return: HiveQL boolean expression selecting the partitions of the windows of all given partitions
+    """
+    window_hours = set()
+    for ptn in ptns:
+        window_hours.update(hour_window(ptn,hours))
+    return hours_predicate(window_hours,alias)
+
+
+def ptn_spec(ptn,location=None):
+    """
+    :param ptn: Partition in the format of YYYY/MM/DD/HH or 'year=YYYY/month=MM/day=DD/hour=HH'
+    :param location: Directory of the partition's data, for partition DDL
+    :return: "partition (...)" clause, followed by the location clause if given
+    """
+    hour = ptn_hour(ptn)
+    spec = "partition (year = %d, month = %d, day = %d, hour = %d)" %(hour.year,hour.month,hour.day,hour.hour)
+    if location is not None:
+        spec += " location '%s'" %location
+    return spec
+
+
+def ptn_key(partition):
+    """
+    :param partition: Partition in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+    :return: Tuple of the int partition values, ordered like the partitions
+    """
+    return tuple(int(item.split("=")[1]) for item in partition.split("/"))
+
+
+def month_specs(partition,now=None):
+    """
+    Partial partition specs of every month from the partition's one until the next month.
+    Values are formatted like the partition's, so that string partition columns match.
+    :param partition: Partition in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+    :return: List of "partition (year='YYYY', month='MM')" clauses, None if there would be
+             more than MAX_DISCOVERY_MONTHS
+    """
+    (year_col,year),(month_col,month) = [item.split("=") for item in partition.split("/")[:2]]
+    month_width = len(month)
+    year,month = int(year),int(month)
+    now = now or datetime.now()
+    # The next month is included in case partitions are named after a timezone ahead of ours
+    last_year,last_month = (now.year,now.month + 1) if now.month < 12 else (now.year + 1,1)
+    specs = []
+    while (year,month) <= (last_year,last_month):
+        specs.append("partition (%s='%d', %s='%0*d')" %(year_col,year,month_col,month_width,month))
+        year,month = (year,month + 1) if month < 12 else (year + 1,1)
+    if len(specs) > MAX_DISCOVERY_MONTHS:
+        return None
+    return specs
+
+
+def input_partitions(hive_exec,stmts):
+    """
+    Runs EXPLAIN DEPENDENCY on the last statement and reports the partitions it would read
+    :param hive_exec: Hive executor
+    :param stmts: Statements setting up the session, followed by the query to explain
+    :return: Dictionary from table name (db@table) to the number of its partitions read
+    """
+    rows = hive_exec.execute(stmts[:-1] + ["explain dependency %s" %stmts[-1]])
+    try:
+        dependency = json.loads("".join(row[0] for row in rows))
+    except ValueError:
+        raise HiveException("Could not parse explain dependency output: %s" %rows)
+    counts = {}
+    for partition in dependency.get("input_partitions",[]):
+        table = partition["partitionName"].rsplit("@",1)[0]
+        counts[table] = counts.get(table,0) + 1
+    return counts
+
+
+def check_pruning(hive_exec,stmts,expected):
+    """
+    Verifies with EXPLAIN DEPENDENCY that a query only reads the partitions it is meant to.
+    Used in test mode, before running a query whose cost must not depend on the table size.
+    :param hive_exec: Hive executor
+    :param stmts: Statements setting up the session, followed by the query to check
+    :param expected: Dictionary from table name (db@table) to the maximum number of partitions read
+    :return: None
+    """
+    counts = input_partitions(hive_exec,stmts)
+    for table,limit in expected.items():
+        if counts.get(table,0) > limit:
+            errmsg = "Query reads %s partitions of %s, at most %s expected. Partition pruning failed for: %s" \
+                     %(counts[table],table,limit,stmts[-1])
+            logger.error(errmsg)
+            raise HiveException(errmsg)
+    logger.info("Partition pruning checked, partitions read: %s" %counts)
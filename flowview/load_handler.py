@@ -1,12 +1,25 @@
 # Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
-from flowview.flowview_handler import FlowviewHandler
-from flowview.hive_manager import HiveManager
-from flowview.hdfs_thread_manager import hdfs_thread_execute
+from flowview.flowview_handler import FlowviewHandler, FlowviewHandlerException
+from flowview.hive_manager import HiveManager, DEFAULT_PULL_BATCH_SIZE, DEFAULT_PULL_CONCURRENCY, \
+    DEFAULT_PTN_PULL_CONCURRENCY
+from flowview.hdfs_thread_manager import hdfs_thread_execute, DEFAULT_WORKER_COUNT
+from flowview.upload_stage import DEFAULT_UPLOAD_WORKERS
+from flowview.partition_writer import DEFAULT_WRITER_COUNT
 from flowview.metadata_manager import MetadataException
+from flowview.shell_executor import DEFAULT_STREAM_BUFSIZE
+from flowview.record_reader import get_record_reader
+from flowview.load_summary import LoadSummary, PartitionSummary
+from flowview.hll import SketchStore, DEFAULT_PRECISION
+from flowview import hiveql
+from flowview import sampling
+from flowview.dir_index import DirIndex
+from flowview.load_journal import LoadJournal
+from flowview.parse_stage import ParseStage
+from flowview.worker_pool import WorkerPool, run_concurrently
 from flowview import utils
 import logging
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -15,26 +28,84 @@ class LoadHandler(FlowviewHandler):
     Handler for the loading phase. Should be triggered on an hourly basis by job scheduler.
     """
 
-    def __init__(self,config_file=None):
+    def __init__(self,config_file=None,parse_stage=None,own_parse_stage=True):
         """
         Initializes the FlowviewHandler superclass and instantiates manager classes
         needed to performing load-related actions
         :param topic: Dataset's Trinity topic name
         :param db: Dataset's Thrive database name in Hive
         :param table: Dataset's Thrive table name in Hive
+        :param parse_stage: ParseStage shared with the loads of other datasets.
+                            Takes the place of hdfs_parse_processes.
+        :param own_parse_stage: Create a ParseStage for hdfs_parse_processes when none is given.
+                                False when loads run in threads, which must not fork.
         :return: None
         """
         super(LoadHandler,self).__init__(config_file)
-        self.hive_mgr = HiveManager(self.topic,self.table)
+        self.parse_stage = parse_stage
+        self.own_parse_stage = own_parse_stage
+        # Events kept on both the HDFS and the Hive side, selected by event id hash
+        self.sample_threshold = sampling.sample_threshold(self.get_config("sample_rate",1))
+        self.hive_mgr = HiveManager(self.topic,self.table,self.hive_exec,sample_threshold=self.sample_threshold)
+        # "exact" joins the tables in Hive, "approximate" estimates the ratios from event id sketches
+        self.ratio_mode = self.get_config("ratio_mode","exact")
+        if self.ratio_mode not in ("exact","approximate"):
+            raise ValueError("Invalid ratio_mode %s" %self.ratio_mode)
+        self.sketch_precision = int(self.get_config("sketch_precision",DEFAULT_PRECISION))
+        # Index of the topic's directories kept between loads, so that only new directories are listed
+        self.dir_index = DirIndex(self.get_config("hdfs_dir_index",
+                                                  "%s_dirs.json" %self.get_config("local_hdfs_ts_path")))
+        # Seconds after which the newest directory and partition count as closed. None leaves them
+        # to the next load, until a newer one exists.
+        self.dir_close_seconds = None
+        self.ptn_close_seconds = None
+        # Wait for the hive checkpoint to cover the window of a partition before computing its ratio.
+        # Set by long-running handlers, which keep the summaries of the partitions waiting.
+        self.defer_ratios = False
+        # Partition to PartitionSummary of the rows loaded but not yet in a ratio, as of the last load
+        self.deferred_ptns = {}
+        # Checkpoints reached by the last load, read from the metadata once
+        self.checkpoints_loaded = False
+        self.hdfs_last_dir = None
+        self.hive_last_ptn = None
+        self.reset()
+
+    def reset(self,reload_checkpoints=False):
+        """
+        Clears the state of the previous load, so that a long-running handler can load again.
+        Checkpoints are kept in memory unless reload_checkpoints is set, e.g. after a failed load.
+        :return: None
+        """
+        if reload_checkpoints:
+            self.checkpoints_loaded = False
+        self.loadts = datetime.now()
         self.hdfs_dir_pending = None
         self.hdfs_ptn_list = set()
+        # Row counts and timestamp ranges of the partitions written by the HDFS extraction,
+        # plus event id sketches in approximate mode
+        self.load_summary = LoadSummary(self.sketch_precision if self.ratio_mode == "approximate" else None,
+                                        self.sample_threshold)
         self.hive_ptn_pending = None
+        # Partitions left waiting for their hive window by the current load, kept once it is recorded
+        self.next_deferred_ptns = {}
         self.hdfs_new_last_dir = None
+        self.hive_new_lastptn = None
         self.hive_new_last_ptn = None
         self.hdfs_proceed = False
         self.hive_proceed = False
         logger.info("Starting load of %s %s" %(self.topic,self.table))
 
+    def load_checkpoints(self):
+        """
+        Reads the last processed hdfs directory and hive partition from the metadata,
+        unless they are already known
+        :return: None
+        """
+        if not self.checkpoints_loaded:
+            self.hdfs_last_dir = self.metadata_mgr.get_hdfs_lastdir()
+            self.hive_last_ptn = self.metadata_mgr.get_hive_lastptn()
+            self.checkpoints_loaded = True
+
     def get_start_ptn(self,last_ptn, start_ptn):
         """
 
@@ -63,9 +134,18 @@ class LoadHandler(FlowviewHandler):
         :param None:
         :return: list of hive partitions pending process
         """
-        hive_old_lastptn = self.metadata_mgr.get_hive_lastptn()
+        self.load_checkpoints()
+        hive_old_lastptn = self.hive_last_ptn
         start_ptn = self.get_start_ptn(hive_old_lastptn, self.get_config("hive_start_ptn"))
-        self.hive_ptn_pending = self.hive_mgr.get_new_ptns(start_ptn)
+        closed_before = None
+        if self.ptn_close_seconds is not None:
+            closed_before = datetime.now() - timedelta(seconds=self.ptn_close_seconds)
+            if start_ptn is not None and hiveql.ptn_hour(start_ptn) + timedelta(hours=2) > closed_before:
+                # The partition after the last processed one is not closed yet: nothing to list
+                self.hive_ptn_pending = []
+                self.hive_new_lastptn = hive_old_lastptn
+                return
+        self.hive_ptn_pending = self.hive_mgr.get_new_ptns(start_ptn,closed_before)
         self.hive_new_lastptn = self.hive_ptn_pending[-1] if self.hive_ptn_pending else hive_old_lastptn
         logger.info("Starting ptn = %s, ending ptn = %s"
                     %(start_ptn,self.hive_new_lastptn))
@@ -94,11 +174,15 @@ class LoadHandler(FlowviewHandler):
         """
         try:
             # Retrieve last processed hdfs directory
-            hdfs_last_dir = self.metadata_mgr.get_hdfs_lastdir()
+            self.load_checkpoints()
+            closed_before = None
+            if self.dir_close_seconds is not None:
+                closed_before = (datetime.now() - timedelta(seconds=self.dir_close_seconds)).strftime("%Y-%m-%d %H:%M")
             # Calculate hdfs directories pending processing
-            self.hdfs_dir_pending = self.hdfs_mgr.get_new_dirs(hdfs_last_dir,
+            self.hdfs_dir_pending = self.hdfs_mgr.get_new_dirs(self.hdfs_last_dir,
                                                                self.get_config("start_dir"),
-                                                               self.get_config("hdfs_path"))
+                                                               self.get_config("hdfs_path"),
+                                                               self.dir_index,closed_before)
             if not self.hdfs_dir_pending:
                 self.hdfs_proceed = False
             else:
@@ -107,13 +191,62 @@ class LoadHandler(FlowviewHandler):
             logger.error("Error retrieving last processed hdfs directories")
             raise
 
-    def insert_ptn_ratio(self):
+    def split_ratio_ptns(self):
+        """
+        Splits the partitions written by the current load, and those deferred by earlier loads,
+        into the partitions whose hive window is covered by the hive checkpoint of the load and
+        those still waiting for it. The rows of a waiting partition are kept for later loads.
+        :return: (sorted partitions ready, LoadSummary of their rows over all loads since deferred,
+                  dictionary from waiting partition to PartitionSummary of its rows)
+        """
+        hive_last_ptn = self.hive_new_last_ptn or self.hive_new_lastptn
+        covered_until = hiveql.ptn_hour(hive_last_ptn) if hive_last_ptn else None
+        ready_summary = LoadSummary(self.load_summary.sketch_precision,self.sample_threshold)
+        ready_ptns = []
+        deferred = {}
+        for ptn in set(self.hdfs_ptn_list) | set(self.deferred_ptns):
+            summary = PartitionSummary()
+            for part in (self.deferred_ptns.get(ptn),self.load_summary.summary(ptn)):
+                if part is not None:
+                    summary.merge(part)
+            if covered_until is not None and hiveql.hour_window(ptn)[-1] <= covered_until:
+                ready_ptns.append(ptn)
+                ready_summary.merge(ptn,summary)
+            else:
+                deferred[ptn] = summary
+        if deferred:
+            logger.info("Deferring the ratios of partitions %s until hive partitions up to their windows are pulled"
+                        %sorted(deferred))
+        return sorted(ready_ptns,key=lambda  s: int(re.sub("[^0-9]", "", s))),ready_summary,deferred
 
-        ptn_list_sorted = sorted(self.hdfs_ptn_list,key=lambda  s: int(re.sub("[^0-9]", "", s)))
+    def get_ptn_ratio_records(self):
+        """
+        Computes the transmission ratios of the partitions written by the current load.
+        With defer_ratios, only the partitions whose hive window is pulled get a ratio,
+        including partitions written by earlier loads.
+        :return: List of ratio metadata records
+        """
+        if self.defer_ratios:
+            ptn_list_sorted,ratio_summary,self.next_deferred_ptns = self.split_ratio_ptns()
+        else:
+            ptn_list_sorted = sorted(self.hdfs_ptn_list,key=lambda  s: int(re.sub("[^0-9]", "", s)))
+            ratio_summary = self.load_summary
 
+        ratio_records = []
         try:
+            if self.ratio_mode == "approximate":
+                transmitted_ratios = self.approximate_ptn_ratios(ptn_list_sorted,ratio_summary)
+            else:
+                # Ratios of all partitions of the load come from one grouped Hive query
+                # The hdfs side is counted during extraction, Hive only counts the matched rows
+                transmitted_ratios = self.hive_mng.load_ptns_transmitted_ratio(ptn_list_sorted,ratio_summary)
             for ptn in ptn_list_sorted:
-                transmitted_ratio = self.hive_mng.load_ptn_transmitted_ratio(ptn)
+                if ptn not in transmitted_ratios:
+                    continue
+                if self.ratio_mode == "approximate":
+                    transmitted_ratio,ratio_error = transmitted_ratios[ptn]
+                else:
+                    transmitted_ratio,ratio_error = transmitted_ratios[ptn],None
                 load_success_data = {
                         "topic_name": self.topic,
                         "database_name": self.database,
@@ -123,14 +256,52 @@ class LoadHandler(FlowviewHandler):
                         "hdfs_partition":ptn,
                         "transmitted_ratio":transmitted_ratio
                 }
+                if ratio_error is not None:
+                    load_success_data["transmitted_ratio_error"] = ratio_error
+                if self.sample_threshold is not None:
+                    # Ratios of a hash sample need no scaling: both counts are sampled alike
+                    load_success_data["sample_rate"] = sampling.sampled_rate(self.sample_threshold)
 
                 print load_success_data
-                self.metadata_mgr.insert(load_success_data,"ratio")
+                ratio_records.append(load_success_data)
         except Exception:
             logger.error("Error creating transmission ratio metadata")
             raise
+        return ratio_records
+
 
 
+    def approximate_ptn_ratios(self,ptns,load_summary=None):
+        """
+        Estimates the transmitted ratios of the load's partitions from event id sketches
+        :param ptns: Partitions in the format of YYYY/MM/DD/HH
+        :param load_summary: LoadSummary holding the sketches of the partitions. Defaults to the load's.
+        :return: Dictionary from partition to (ratio, standard error of the ratio)
+        """
+        load_summary = load_summary if load_summary is not None else self.load_summary
+        # Sketches outlive the load, so they are kept beside the local timestamp files, which do not
+        sketch_store = SketchStore(self.get_config("sketch_path","%s_sketches" %self.get_config("local_hdfs_ts_path")),
+                                   self.load_summary.sketch_precision)
+        pulled_hours = [hiveql.ptn_hour(partition) for partition in self.hive_ptn_pending or []] \
+            if self.hive_proceed else []
+        return self.hive_mng.load_ptns_approximate_ratio(ptns,load_summary.sketches(),
+                                                         sketch_store,pulled_hours)
+
+    def discover(self):
+        """
+        Determines if there exist hdfs directories and hive partitions to process
+        :return: True if the load should proceed
+        """
+        self.hdfs_to_proceed()
+        self.hive_to_proceed()
+        return self.hdfs_proceed or self.hive_proceed
+
+    def backlog(self):
+        """
+        :return: (number of hdfs directories, number of hive partitions) pending processing,
+                 once discover() has run
+        """
+        return len(self.hdfs_dir_pending or []),len(self.hive_ptn_pending or [])
 
     def execute(self):
         # TODO [comment section (2)] based on??
@@ -144,53 +315,153 @@ class LoadHandler(FlowviewHandler):
         Year, Month, Day, Hour based on source Hive table partition
         :return: None
         """
-        # Determines if there exist hdfs directories and hive partitions to process
-        self.hdfs_to_proceed()
-        self.hive_to_proceed()
-        if not self.hive_proceed and not self.hdfs_proceed:
+        if not self.discover():
             logger.info("No partitions or directories to proceed. Ending load")
             return
+        self.load()
 
+    def load(self):
+        """
+        Processes what discover() found pending and records the load in the metadata
+        :return: None
+        """
         logger.info("Proceeding with load")
+        # Progress of the load, kept until it is recorded in the metadata. A load failing part way
+        # leaves it behind, and the next load from the same checkpoints resumes where it stopped.
+        journal = LoadJournal(self.get_config("load_journal",
+                                              "%s_journal.jsonl" %self.get_config("local_hdfs_ts_path")))
+        journal.open(self.hdfs_last_dir,self.hive_last_ptn)
+        try:
+            self.load_journaled(journal)
+        finally:
+            journal.close()
+        journal.remove()
+        logger.info("Load complete")
 
-        if self.hdfs_proceed:
-            logger.info("Proceeding with HDFS load")
-            try:
-                # Calculate the latest last processed hdfs directory after the current load
-                # hdfs_thread_manager retrieves hdfs timestamps from pending directories,
-                # write to local file system, copy files to hive warehouse,
-                # create new partitions that point toward corresponding directories
-                self.hdfs_new_last_dir = hdfs_thread_execute(self.topic,self.table,self.hdfs_dir_pending,
-                                                             self.hdfs_ptn_list,
-                                                             self.get_config("local_hdfs_ts_path"),
-                                                             self.get_config("hive_hdfs_ts_path"))
-            except Exception:
-                logger.error("Error retrieving server and hdfs timestamp")
-                raise
-        else:
-            logger.info("No new HDFS dir to process.")
+    def load_hdfs(self,journal,parse_stage=None):
+        """
+        HDFS branch of the load: extracts the pending directories, uploads and registers their partitions
+        :param journal: Opened LoadJournal
+        :param parse_stage: ParseStage parsing the messages, None to parse in the I/O threads
+        :return: None
+        """
+        logger.info("Proceeding with HDFS load")
+        try:
+            buffer_size = int(self.get_config("stream_buffer_size",DEFAULT_STREAM_BUFSIZE))
+            # Reader decoding the Trinity files, either through `hadoop fs -text` or in process
+            record_reader = get_record_reader(self.get_config("record_reader","shell"),
+                                              buffer_size,
+                                              self.get_config("hdfs_mount_root",None))
+            # Calculate the latest last processed hdfs directory after the current load
+            # hdfs_thread_manager retrieves hdfs timestamps from pending directories,
+            # write to local file system, copy files to hive warehouse,
+            # create new partitions that point toward corresponding directories
+            self.hdfs_new_last_dir = hdfs_thread_execute(self.topic,self.table,self.hdfs_dir_pending,
+                                                         self.hdfs_ptn_list,
+                                                         self.get_config("local_hdfs_ts_path"),
+                                                         self.get_config("hive_hdfs_ts_path"),
+                                                         buffer_size,record_reader,
+                                                         int(self.get_config("hdfs_worker_count",
+                                                                             DEFAULT_WORKER_COUNT)),
+                                                         int(self.get_config("hdfs_task_timeout",0)) or None,
+                                                         int(self.get_config("hdfs_writer_count",
+                                                                             DEFAULT_WRITER_COUNT)),
+                                                         parse_stage=parse_stage,
+                                                         hive_exec=self.hive_exec,
+                                                         load_summary=self.load_summary,
+                                                         journal=journal,
+                                                         upload_workers=int(self.get_config("hdfs_upload_workers",
+                                                                                            DEFAULT_UPLOAD_WORKERS)))
+            self.load_summary.log()
+        except Exception:
+            logger.error("Error retrieving server and hdfs timestamp")
+            raise
 
-        if self.hive_proceed:
-            hive_hive_ts_path = self.get_config("hive_hive_ts_path")
-            logger.info("Proceeding with Hive load")
-            try:
+    def load_hive(self,journal):
+        """
+        Hive branch of the load: creates the pending FlowView partitions and pulls their hive timestamps
+        :param journal: Opened LoadJournal
+        :return: None
+        """
+        hive_hive_ts_path = self.get_config("hive_hive_ts_path")
+        logger.info("Proceeding with Hive load")
+        batch_mode = self.get_config("hive_pull_mode","batch") == "batch"
+        # Hive sessions pulling partitions at once
+        pull_concurrency = int(self.get_config("hive_pull_concurrency",
+                                               DEFAULT_PULL_CONCURRENCY if batch_mode else DEFAULT_PTN_PULL_CONCURRENCY))
+        # Partitions a failed load already pulled are not pulled again
+        pull_ptns = [partition for partition in self.hive_ptn_pending if partition not in journal.pulled]
+        if len(pull_ptns) < len(self.hive_ptn_pending):
+            logger.info("Resumed hive load: %s partitions pulled, %s remaining"
+                        %(len(self.hive_ptn_pending) - len(pull_ptns),len(pull_ptns)))
+        try:
+            if batch_mode:
+                # create all FlowView partitions and retrieve their hive timestamp data,
+                # scanning the source table once per batch
+                self.hive_mgr.pull_hive_ts_ptns(pull_ptns,hive_hive_ts_path,
+                                                int(self.get_config("hive_pull_batch_size",
+                                                                    DEFAULT_PULL_BATCH_SIZE)),
+                                                journal.ptns_pulled,pull_concurrency)
+            else:
                 # create a FlowView partition for each Hive partition pending processing
-                for partition in self.hive_ptn_pending:
+                def pull_partition(partition):
                     # create partition
                     self.hive_mgr.create_hive_ts_ptn(partition,hive_hive_ts_path)
                     # retrieve hive timestamp data and write into the corresponding directory
                     self.hive_mgr.pull_hive_ts(partition,hive_hive_ts_path)
-                # calculate the last processed partition after the current load
-                self.hive_new_last_ptn = self.hive_ptn_pending[-1]
-            except Exception:
-                logger.error("Error creating hive partition")
-                raise
+                    journal.ptns_pulled([partition])
+                pool = WorkerPool("hive",pull_concurrency,pull_partition)
+                for partition in pull_ptns:
+                    pool.submit(partition)
+                pool.join()
+            # calculate the last processed partition after the current load
+            self.hive_new_last_ptn = self.hive_ptn_pending[-1]
+        except Exception:
+            logger.error("Error creating hive partition")
+            raise
 
-            logger.info("Created hive partition for Hive timestamp")
+        logger.info("Created hive partition for Hive timestamp")
 
+    def load_journaled(self,journal):
+        """
+        Runs the load, skipping the work a failed load recorded in the journal
+        :param journal: Opened LoadJournal
+        :return: None
+        """
+        # The parser processes are forked before the branch threads start.
+        # Loads running in threads get their parse stage from the caller instead.
+        parse_stage = self.parse_stage
+        parse_processes = int(self.get_config("hdfs_parse_processes",0)) if self.own_parse_stage else 0
+        own_parse_stage = parse_stage is None and parse_processes > 0 and self.hdfs_proceed
+        if own_parse_stage:
+            parse_stage = ParseStage(parse_processes)
+
+        branches = []
+        if self.hdfs_proceed:
+            branches.append(("HDFS load",lambda: self.load_hdfs(journal,parse_stage)))
+        else:
+            logger.info("No new HDFS dir to process.")
+        if self.hive_proceed:
+            branches.append(("Hive load",lambda: self.load_hive(journal)))
         else:
             logger.info("No new Hive partition to process")
 
+        try:
+            # The two branches share nothing until the ratios, so they run side by side.
+            # Both are waited for, so the errors of both are reported before anything is recorded.
+            failures = run_concurrently(branches)
+        finally:
+            if own_parse_stage:
+                parse_stage.close()
+        if len(failures) == 1:
+            name,(exc_type,exc_value,exc_tb) = failures[0]
+            raise exc_type,exc_value,exc_tb
+        elif failures:
+            errmsg = "Load of %s failed: %s" %(self.topic,"; ".join("%s: %r" %(name,exc_info[1])
+                                                                    for name,exc_info in failures))
+            logger.error(errmsg)
+            raise FlowviewHandlerException(errmsg)
+
         try:
             # create metadata for current load
             load_metadata = {
@@ -199,9 +470,12 @@ class LoadHandler(FlowviewHandler):
                 "table_name":self.table,
                 "load_start_time":utils.iso_format(self.loadts),
                 "load_end_time": utils.iso_format(datetime.now()),
-                "last_load_hdfs_dir": self.hdfs_new_last_dir,
-                "last_load_hive_partition": self.hive_new_last_ptn
+                # A side without anything to process keeps its previous checkpoint
+                "last_load_hdfs_dir": self.hdfs_new_last_dir or self.hdfs_last_dir,
+                "last_load_hive_partition": self.hive_new_last_ptn or self.hive_new_lastptn
             }
+            if self.sample_threshold is not None:
+                load_metadata["sample_rate"] = sampling.sampled_rate(self.sample_threshold)
             logger.info("Created load_metadata %s" %load_metadata)
         except Exception:
             logger.error("Error creating metadata")
@@ -209,17 +483,25 @@ class LoadHandler(FlowviewHandler):
         logger.info("Created hive partition for hive timestamp")
 
         try:
-            # insert metadata for current load into SQL metadata database
-            self.metadata_mgr.insert(load_metadata,"load")
-        except MetadataException:
-                logger.error("Error inserting metadata %s" %load_metadata)
-                raise
-
-        try:
-            self.insert_ptn_ratio()
+            ratio_records = self.get_ptn_ratio_records()
             logger.info("Calculated load partition data transmission ratio")
         except Exception:
             logger.error("Error in calculating load partition data transmission ratio")
             raise
 
-        logger.info("Load complete")
\ No newline at end of file
+        try:
+            # insert metadata for current load into SQL metadata database. The load record
+            # and its ratio records are committed together, so a load is recorded whole or not at all
+            with self.metadata_mgr.transaction():
+                self.metadata_mgr.insert_many([load_metadata],"load",commit=False)
+                self.metadata_mgr.insert_many(ratio_records,"ratio",commit=False)
+                # The next load resumes from the checkpoint row, not the load history
+                self.metadata_mgr.update_checkpoint(load_metadata["last_load_hdfs_dir"],
+                                                    load_metadata["last_load_hive_partition"],
+                                                    load_metadata["load_end_time"],commit=False)
+        except MetadataException:
+                logger.error("Error inserting metadata %s" %load_metadata)
+                raise
+        self.hdfs_last_dir = load_metadata["last_load_hdfs_dir"]
+        self.hive_last_ptn = load_metadata["last_load_hive_partition"]
+        self.deferred_ptns = self.next_deferred_ptns
\ No newline at end of file
@@ -0,0 +1,147 @@
+import errno
+import json
+import logging
+import os
+import threading
+from flowview.load_summary import PartitionSummary
+
+logger = logging.getLogger(__name__)
+
+
+class LoadJournal(object):
+    """
+    Progress of a load, kept in a local file of JSON lines until the load is recorded in the
+    metadata. Every line is synced to disk before the work it records is relied upon, so a
+    load failing or killed part way is resumed by the next one from the same checkpoints:
+    directories already extracted, partitions already uploaded or registered and hive
+    partitions already pulled are skipped.
+    """
+    def __init__(self,path):
+        """
+        :param path: Local journal file. Must not be under local_hdfs_ts_path, which loads remove.
+        :return:
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.resumed = False
+        # Path of each extracted directory to (partition, PartitionSummary of its rows)
+        self.dirs = {}
+        self.uploaded = set()
+        self.registered = set()
+        self.pulled = set()
+
+    def open(self,hdfs_last_dir,hive_last_ptn):
+        """
+        Reads the journal left by a failed load from the same checkpoints, or starts a new one
+        :param hdfs_last_dir: Last processed hdfs directory the load starts after
+        :param hive_last_ptn: Last processed hive partition the load starts after
+        :return: True if a failed load is resumed
+        """
+        header = {"event": "load", "hdfs_last_dir": hdfs_last_dir, "hive_last_ptn": hive_last_ptn}
+        records = self.read()
+        self.resumed = bool(records) and records[0] == header
+        if self.resumed:
+            for record in records[1:]:
+                self.replay(record)
+            logger.info("Resuming load from %s: %s directories extracted, %s partitions uploaded, "
+                        "%s registered, %s hive partitions pulled"
+                        %(self.path,len(self.dirs),len(self.uploaded),len(self.registered),len(self.pulled)))
+        elif records:
+            logger.info("Discarding journal %s of a load from other checkpoints" %self.path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.journal_file = open(self.path,"a" if self.resumed else "w")
+        if not self.resumed:
+            self.append(header)
+        return self.resumed
+
+    def read(self):
+        """
+        :return: Records of the journal file, without a last line cut short by a crash
+        """
+        try:
+            with open(self.path) as journal_file:
+                lines = journal_file.readlines()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Ignoring incomplete journal line %s" %line.strip())
+                break
+        return records
+
+    def replay(self,record):
+        event = record["event"]
+        if event == "dir":
+            self.dirs[record["path"]] = (record["ptn"],PartitionSummary.from_dict(record["summary"]))
+        elif event == "upload":
+            self.uploaded.add(record["ptn"])
+        elif event == "register":
+            self.registered.add(record["ptn"])
+        elif event == "pull":
+            self.pulled.add(record["ptn"])
+
+    def append(self,record):
+        """
+        Writes a record and syncs it to disk
+        :param record: JSON serializable dictionary
+        :return: None
+        """
+        with self.lock:
+            self.journal_file.write(json.dumps(record) + "\n")
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.replay(record)
+
+    def dir_extracted(self,dir_info,ptn,summary):
+        """
+        Records a directory whose rows are all synced to disk
+        :param dir_info: (hdfs timestamp, path) of the directory
+        :param ptn: Partition in the format of YYYY/MM/DD/HH the rows were written to
+        :param summary: PartitionSummary of the rows
+        :return: None
+        """
+        self.append({"event": "dir", "path": dir_info[1], "ptn": ptn, "summary": summary.to_dict()})
+
+    def ptns_uploaded(self,ptns):
+        for ptn in ptns:
+            self.append({"event": "upload", "ptn": ptn})
+
+    def ptns_registered(self,ptns):
+        for ptn in ptns:
+            self.append({"event": "register", "ptn": ptn})
+
+    def ptns_pulled(self,partitions):
+        """
+        :param partitions: Hive partitions in the format of 'year=YYYY/month=MM/day=DD/hour=HH'
+        """
+        for partition in partitions:
+            self.append({"event": "pull", "ptn": partition})
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def remove(self):
+        """
+        Deletes the journal once the load is recorded in the metadata
+        :return: None
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,206 @@
+import base64
+import logging
+import threading
+from datetime import datetime
+from flowview import row_formatter
+from flowview.hll import HyperLogLog
+from flowview import sampling
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionSummary(object):
+    """
+    Row count and timestamp range of the hdfs_ts rows written to one partition,
+    and optionally a sketch of their event ids
+    """
+    def __init__(self,sketch_precision=None):
+        """
+        :param sketch_precision: Precision of the event id sketch. None to keep no sketch.
+        :return:
+        """
+        self.rows = 0
+        self.sketch = HyperLogLog(sketch_precision) if sketch_precision is not None else None
+        # Server timestamps in epoch milliseconds
+        self.min_server_ts = None
+        self.max_server_ts = None
+        # HDFS directory timestamps, e.g. 2015-08-19 10:12
+        self.min_hdfs_ts = None
+        self.max_hdfs_ts = None
+
+    def add(self,rows,min_server_ts,max_server_ts,hdfs_ts):
+        """
+        :param rows: Number of rows written
+        :param min_server_ts: Lowest server timestamp of the rows, None without rows
+        :param max_server_ts: Highest server timestamp of the rows, None without rows
+        :param hdfs_ts: HDFS timestamp of the directory the rows come from
+        :return: None
+        """
+        self.rows += rows
+        if rows:
+            self.min_server_ts = min_value(self.min_server_ts,min_server_ts)
+            self.max_server_ts = max_value(self.max_server_ts,max_server_ts)
+            self.min_hdfs_ts = min_value(self.min_hdfs_ts,hdfs_ts)
+            self.max_hdfs_ts = max_value(self.max_hdfs_ts,hdfs_ts)
+
+    def merge(self,other):
+        """
+        Adds the totals and the sketch of another summary
+        :param other: PartitionSummary
+        :return: None
+        """
+        self.rows += other.rows
+        for attr,combine in (("min_server_ts",min_value),("max_server_ts",max_value),
+                             ("min_hdfs_ts",min_value),("max_hdfs_ts",max_value)):
+            setattr(self,attr,combine(getattr(self,attr),getattr(other,attr)))
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = other.sketch.copy()
+            else:
+                self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        """
+        :return: JSON serializable dictionary holding the summary
+        """
+        data = dict((attr,getattr(self,attr)) for attr in ("rows","min_server_ts","max_server_ts",
+                                                           "min_hdfs_ts","max_hdfs_ts"))
+        data["sketch"] = base64.b64encode(self.sketch.serialize()) if self.sketch is not None else None
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        """
+        :param data: Output of to_dict
+        :return: PartitionSummary
+        """
+        summary = PartitionSummary()
+        for attr in ("rows","min_server_ts","max_server_ts","min_hdfs_ts","max_hdfs_ts"):
+            setattr(summary,attr,data[attr])
+        if data.get("sketch") is not None:
+            summary.sketch = HyperLogLog.deserialize(base64.b64decode(data["sketch"]))
+        return summary
+
+    def __str__(self):
+        return "%s rows, server timestamps %s to %s, hdfs timestamps %s to %s" \
+               %(self.rows,format_ms(self.min_server_ts),format_ms(self.max_server_ts),
+                 self.min_hdfs_ts,self.max_hdfs_ts)
+
+
+def min_value(current,value):
+    return value if current is None or (value is not None and value < current) else current
+
+
+def max_value(current,value):
+    return value if current is None or (value is not None and value > current) else current
+
+
+def format_ms(ms):
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms // 1000).strftime(row_formatter.TS_FORMAT)
+
+
+def server_ts_range(events):
+    """
+    :param events: List of (event_id, server_timestamp in milliseconds as a string)
+    :return: (lowest, highest) server timestamp in milliseconds, (None, None) without events
+    """
+    if not events:
+        return None,None
+    server_ts = [int(server_unix_ts) for _,server_unix_ts in events]
+    return min(server_ts),max(server_ts)
+
+
+class LoadSummary(object):
+    """
+    Per-partition row counts and timestamp ranges of everything the HDFS extraction
+    of a load wrote. Worker threads count the rows of a directory on their own and
+    merge the totals once the directory is done.
+    """
+    def __init__(self,sketch_precision=None,sample_threshold=None):
+        """
+        :param sketch_precision: Precision of the event id sketches built during extraction.
+                                 None to build no sketches.
+        :param sample_threshold: Sample of the events extracted, as returned by sampling.sample_threshold.
+                                 None to extract every event.
+        :return:
+        """
+        self.sketch_precision = sketch_precision
+        self.sample_threshold = sample_threshold
+        self.lock = threading.Lock()
+        self.partitions = {}
+
+    def merge(self,ptn,dir_summary):
+        """
+        Merges the totals of one directory
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param dir_summary: PartitionSummary of the rows the directory contributed
+        :return: None
+        """
+        with self.lock:
+            summary = self.partitions.get(ptn)
+            if summary is None:
+                summary = self.partitions[ptn] = PartitionSummary()
+            summary.merge(dir_summary)
+
+    def summary(self,ptn):
+        """
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :return: PartitionSummary of the partition, None if nothing was written to it
+        """
+        with self.lock:
+            return self.partitions.get(ptn)
+
+    def ptns(self):
+        """
+        :return: Sorted partitions rows were written to
+        """
+        with self.lock:
+            return sorted(self.partitions)
+
+    def rows(self,ptn):
+        """
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :return: Number of rows written to the partition
+        """
+        with self.lock:
+            summary = self.partitions.get(ptn)
+            return summary.rows if summary is not None else 0
+
+    def row_counts(self):
+        """
+        :return: Dictionary from partition to number of rows written
+        """
+        with self.lock:
+            return dict((ptn,summary.rows) for ptn,summary in self.partitions.items())
+
+    def sketches(self):
+        """
+        :return: Dictionary from partition to the sketch of the event ids written
+        """
+        with self.lock:
+            return dict((ptn,summary.sketch) for ptn,summary in self.partitions.items()
+                        if summary.sketch is not None)
+
+    def hdfs_ts_range(self):
+        """
+        :return: (lowest, highest) HDFS directory timestamp of the load, (None, None) without rows
+        """
+        with self.lock:
+            summaries = [summary for summary in self.partitions.values() if summary.rows]
+            if not summaries:
+                return None,None
+            return min(summary.min_hdfs_ts for summary in summaries),\
+                   max(summary.max_hdfs_ts for summary in summaries)
+
+    def log(self):
+        sample_rate = sampling.sampled_rate(self.sample_threshold)
+        with self.lock:
+            for ptn in sorted(self.partitions):
+                summary = self.partitions[ptn]
+                if self.sample_threshold is None:
+                    logger.info("Partition %s: %s" %(ptn,summary))
+                else:
+                    logger.info("Partition %s: %s sampled at %s, about %d rows in total"
+                                %(ptn,summary,sample_rate,summary.rows / sample_rate))
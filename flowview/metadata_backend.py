@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Schema the SQLite backend creates in a new database
+DEFAULT_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   "metadata","md_schema.sql")
+# Seconds a SQLite connection waits for a lock held by another process
+DEFAULT_SQLITE_TIMEOUT = 30
+METADATA_TABLES = ("flowview_load_metadata","flowview_load_transmitted_ratio","flowview_checkpoint")
+
+
+class MetadataException(Exception):
+    pass
+
+
+class MetadataBackend(object):
+    """
+    Database holding the FlowView metadata. Backends open DB-API connections using the
+    qmark ("?") parameter style, and expose the Error and IntegrityError classes of
+    their driver, so MetadataManager runs the same queries against any of them.
+    """
+    Error = Exception
+    IntegrityError = Exception
+
+    def connect(self):
+        """
+        :return: New DB-API connection to the metadata database
+        """
+        raise NotImplementedError
+
+    def describe(self):
+        """
+        :return: Description of the database for log messages, without credentials
+        """
+        raise NotImplementedError
+
+    def checkpoint_upsert(self,topic,hdfs_dir,hive_ptn,update_time):
+        """
+        Statement inserting the checkpoint row of a topic, or updating it if the topic has one.
+        A None checkpoint keeps the stored one.
+        :return: (query, parameters)
+        """
+        raise NotImplementedError
+
+
+class OdbcBackend(MetadataBackend):
+    """
+    MySQL metadata database, reached through pyodbc
+    """
+    def __init__(self,connection_info):
+        """
+        :param connection_info: Dictionary with md_dbtype (ODBC driver), md_dbhost, md_dbport,
+                                md_dbuser, md_dbpass and md_dbname
+        :return:
+        """
+        try:
+            import pyodbc
+        except ImportError:
+            raise MetadataException("pyodbc is required by the odbc metadata backend")
+        self.pyodbc = pyodbc
+        self.Error = pyodbc.Error
+        self.IntegrityError = pyodbc.IntegrityError
+        self.connection_info = connection_info
+
+    def connect(self):
+        return self.pyodbc.connect(
+            "DRIVER={%s};SERVER=%s;PORT=%s;UID=%s;PWD=%s;DB=%s"
+            % (self.connection_info["md_dbtype"],
+               self.connection_info["md_dbhost"],
+               self.connection_info["md_dbport"],
+               self.connection_info["md_dbuser"],
+               self.connection_info["md_dbpass"],
+               self.connection_info["md_dbname"])
+        )
+
+    def describe(self):
+        return "%s@%s:%s" %(self.connection_info["md_dbname"],
+                            self.connection_info["md_dbhost"],
+                            self.connection_info["md_dbport"])
+
+    def checkpoint_upsert(self,topic,hdfs_dir,hive_ptn,update_time):
+        # An update could not tell a missing row apart: MySQL counts changed rows, not matched ones
+        qry = '''
+                 insert into flowview_checkpoint
+                 (topic_name, last_load_hdfs_dir, last_load_hive_partition, updated_time)
+                 values (?, ?, ?, ?)
+                 on duplicate key update
+                   last_load_hdfs_dir = coalesce(values(last_load_hdfs_dir), last_load_hdfs_dir),
+                   last_load_hive_partition = coalesce(values(last_load_hive_partition), last_load_hive_partition),
+                   updated_time = values(updated_time);
+              '''
+        return qry,(topic,hdfs_dir,hive_ptn,update_time)
+
+
+class SqliteBackend(MetadataBackend):
+    """
+    Embedded SQLite metadata database, for single-node deployments, benchmarks and tests.
+    The database is created with the schema of md_schema.sql on first use, and runs in
+    WAL mode so that readers do not block a running load.
+    """
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self,connection_info):
+        """
+        :param connection_info: Dictionary with md_path, the database file, and optionally
+                                md_schema, the schema file of new databases
+        :return:
+        """
+        if not connection_info.get("md_path"):
+            raise MetadataException("md_path is required by the sqlite metadata backend")
+        self.path = connection_info["md_path"]
+        self.schema_path = connection_info.get("md_schema") or DEFAULT_SCHEMA_PATH
+
+    def connect(self):
+        connection = sqlite3.connect(self.path,timeout=DEFAULT_SQLITE_TIMEOUT,check_same_thread=False)
+        connection.execute("pragma journal_mode=wal")
+        # Text comes back as str, like the varchar columns read through pyodbc
+        connection.text_factory = str
+        existing = set(row[0] for row in
+                       connection.execute("select name from sqlite_master where type = 'table'"))
+        if existing.isdisjoint(METADATA_TABLES):
+            logger.info("Creating metadata tables in %s" %self.path)
+            with open(self.schema_path) as schema_file:
+                connection.executescript(schema_file.read())
+        elif not existing.issuperset(METADATA_TABLES):
+            # The schema drops its tables first, so it is never run over existing metadata
+            connection.close()
+            raise MetadataException("Metadata database %s lacks tables %s"
+                                    %(self.path,", ".join(set(METADATA_TABLES) - existing)))
+        return connection
+
+    def describe(self):
+        return self.path
+
+    def checkpoint_upsert(self,topic,hdfs_dir,hive_ptn,update_time):
+        # Stored checkpoints are read back by subqueries, as upserts need SQLite 3.24
+        qry = '''
+                 insert or replace into flowview_checkpoint
+                 (topic_name, last_load_hdfs_dir, last_load_hive_partition, updated_time)
+                 values (?,
+                         coalesce(?, (select last_load_hdfs_dir from flowview_checkpoint where topic_name = ?)),
+                         coalesce(?, (select last_load_hive_partition from flowview_checkpoint where topic_name = ?)),
+                         ?);
+              '''
+        return qry,(topic,hdfs_dir,topic,hive_ptn,topic,update_time)
+
+
+def parse_connection_info(connection_info):
+    """
+    :param connection_info: connection_info of the config file, a JSON object
+    :return: Dictionary of connection parameters
+    """
+    if isinstance(connection_info,dict):
+        return connection_info
+    try:
+        return json.loads(connection_info)
+    except ValueError:
+        raise MetadataException("connection_info is not a JSON object: %s" %connection_info)
+
+
+def get_metadata_backend(connection_info):
+    """
+    Builds the metadata backend selected by md_backend in connection_info
+    :param connection_info: Dictionary or JSON object of connection parameters.
+                            md_backend is "odbc" (default) or "sqlite".
+    :return: MetadataBackend
+    """
+    connection_info = parse_connection_info(connection_info)
+    backend = connection_info.get("md_backend","odbc")
+    if backend == "odbc":
+        return OdbcBackend(connection_info)
+    elif backend == "sqlite":
+        return SqliteBackend(connection_info)
+    else:
+        raise MetadataException("Invalid metadata backend: %s" %backend)
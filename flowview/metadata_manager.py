@@ -1,20 +1,20 @@
 # Author Rohan Kekatpure
 # Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
 
-import pyodbc
 import logging
+from contextlib import contextmanager
+from flowview.metadata_backend import MetadataException, get_metadata_backend
 
 logger = logging.getLogger(__name__)
 
-class MetadataException(Exception):
-    pass
-
 
 class MetadataManager(object):
     """
     Class for managing metadata for the FlowView setup and load process. This is
-    really only a CRUD layer + business logic on top of the MySQL metadata
-    database.
+    really only a CRUD layer + business logic on top of the metadata database,
+    MySQL through ODBC or an embedded SQLite file (see metadata_backend).
+    The connection is opened on first use, so runs that never touch the
+    metadata do not pay for it.
 
     Primary responsibilities of this class include supplying a metadata
     manager object capable of communicating with the metadata DB and updating
@@ -22,30 +22,47 @@ class MetadataManager(object):
     """
     def __init__(self, connection_info,table,topic):
         """
-        Initializes the connection object by establishing connection with
-        the metadata DB
-        :param connection_info: parameters required for connection
+        Selects the metadata backend. No connection is made until the first query.
+        :param connection_info: parameters required for connection, as a dictionary
+                                or a JSON object (see metadata_backend.get_metadata_backend)
         :return: None
         """
-        self.connection_info = connection_info
+        self.backend = get_metadata_backend(connection_info)
         self.topic = topic
         self.table = table
-        try:
-            self.connection = pyodbc.connect(
-                "DRIVER={%s};SERVER=%s;PORT=%s;UID=%s;PWD=%s;DB=%s"
-                % (self.connection_info["md_dbtype"],
-                   self.connection_info["md_dbhost"],
-                   self.connection_info["md_dbport"],
-                   self.connection_info["md_dbuser"],
-                   self.connection_info["md_dbpass"],
-                   self.connection_info["md_dbname"])
-            )
-        except pyodbc.Error, poe:
-            errmsg = "Could not connect to database"
-            logger.error(errmsg)
-            raise MetadataException(errmsg)
+        self._connection = None
+
+    @property
+    def connection(self):
+        """
+        Connection to the metadata DB, established on first use
+        """
+        if self._connection is None:
+            try:
+                self._connection = self.backend.connect()
+            except self.backend.Error, poe:
+                errmsg = "Could not connect to database %s" % self.backend.describe()
+                logger.error(errmsg)
+                raise MetadataException(errmsg)
+        return self._connection
 
     def insert(self,data,mdtype=None):
+        """
+        Inserts one metadata record and commits it
+        :param data: Dictionary from column to value
+        :param mdtype: "load" or "ratio"
+        :return: None
+        """
+        self.insert_many([data],mdtype)
+
+    def insert_many(self,rows,mdtype=None,commit=True):
+        """
+        Inserts metadata records with one parameterized statement executed for all of them
+        :param rows: List of dictionaries from column to value, all with the same columns
+        :param mdtype: "load" or "ratio"
+        :param commit: False to leave the commit to an enclosing transaction()
+        :return: None
+        """
         if mdtype == "ratio":
             mdtable = "flowview_load_transmitted_ratio"
         elif mdtype == "load":
@@ -54,85 +71,176 @@ class MetadataManager(object):
             errmsg = "Invalid metadata type: %s" % mdtype
             logger.error(errmsg)
             raise MetadataException(errmsg)
+        if not rows:
+            return
 
-        columns = ",".join(data.keys())
-        values = ",".join("'%s'" % v for v in data.values())
+        columns = sorted(rows[0].keys())
+        if any(sorted(row.keys()) != columns for row in rows):
+            errmsg = "Metadata records of a batch must have the same columns"
+            logger.error(errmsg)
+            raise MetadataException(errmsg)
 
-        insert_qry = "insert into %s (%s) values (%s);" \
-                     % (mdtable, columns, values)
+        insert_qry = "insert into %s (%s) values (%s)" \
+                     % (mdtable, ",".join(columns), ",".join("?" for _ in columns))
 
         try:
-            self.execute(insert_qry)
-        except pyodbc.IntegrityError, ie:
+            cursor = self.connection.cursor()
+            # Sends the whole batch in one round trip where the driver supports it
+            if hasattr(cursor,"fast_executemany"):
+                cursor.fast_executemany = True
+            cursor.executemany(insert_qry,[[row[column] for column in columns] for row in rows])
+            cursor.close()
+            if commit:
+                self.connection.commit()
+        except self.backend.IntegrityError, ie:
             errmsg = "Duplicate primary key insertion"
             logger.error(errmsg)
             raise MetadataException(errmsg)
-        except pyodbc.Error, poe:
+        except self.backend.Error, poe:
             errmsg = "Could not insert data"
             logger.error(errmsg)
             raise MetadataException(errmsg)
 
+    @contextmanager
+    def transaction(self):
+        """
+        Commits the inserts of the block together, or rolls all of them back if the block fails.
+        Inserts in the block must pass commit=False.
+        :return: None
+        """
+        try:
+            yield
+            self.connection.commit()
+        except Exception:
+            try:
+                self.connection.rollback()
+            except self.backend.Error:
+                logger.error("Could not roll back metadata transaction")
+            raise
+
+    def get_checkpoint(self):
+        """
+        Returns the checkpoints of "topic" with a single primary key lookup
+        :return: (last processed hdfs directory, last processed hive partition),
+                 None if the topic has no checkpoint row yet
+        """
+        qry = '''
+                 select last_load_hdfs_dir, last_load_hive_partition
+                 from flowview_checkpoint
+                 where topic_name = ?;
+              '''
+
+        results = self.execute_return(qry,(self.topic,))
+        return tuple(results[0]) if results else None
+
+    def update_checkpoint(self,hdfs_dir,hive_ptn,update_time,commit=True):
+        """
+        Stores the checkpoints of "topic". A None checkpoint keeps the stored one.
+        :param hdfs_dir: Last processed hdfs directory
+        :param hive_ptn: Last processed hive partition
+        :param update_time: Time of the load, "yyyy-mm-dd HH:MM:SS"
+        :param commit: False to leave the commit to an enclosing transaction()
+        :return: None
+        """
+        # One statement of the backend, so that rewriting the same checkpoints never falls through to an insert
+        upsert_qry,params = self.backend.checkpoint_upsert(self.topic,hdfs_dir,hive_ptn,update_time)
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(upsert_qry,params)
+            cursor.close()
+            if commit:
+                self.connection.commit()
+        except self.backend.Error, poe:
+            errmsg = "Could not update checkpoint of %s" % self.topic
+            logger.error(errmsg)
+            raise MetadataException(errmsg)
+
+    def reset_checkpoint(self):
+        """
+        Removes the checkpoints of "topic", so that the next load starts from the beginning.
+        Left uncommitted, for an enclosing transaction().
+        :return: None
+        """
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("delete from flowview_checkpoint where topic_name = ?;",(self.topic,))
+            cursor.close()
+        except self.backend.Error, poe:
+            errmsg = "Could not reset checkpoint of %s" % self.topic
+            logger.error(errmsg)
+            raise MetadataException(errmsg)
+
     def get_hdfs_lastdir(self):
         """
-        Returns the last directory processed for "topic" by querying "table"
+        Returns the last directory processed for "topic" from the checkpoint table, or
+        by querying the load history for topics loaded before the table existed
         :param topic: dataset being loaded
         :return: results
         """
+        checkpoint = self.get_checkpoint()
+        if checkpoint is not None:
+            return checkpoint[0]
 
         qry = '''
                  select last_load_hdfs_dir
                  from flowview_load_metadata
-                 where topic_name = '%s'
+                 where topic_name = ?
                  order by load_end_time desc
                  limit 1;
-              ''' % (self.topic)
+              '''
 
-        hdfs_last_ptn = self.execute_return(qry)[0][0]
+        hdfs_last_ptn = self.execute_return(qry,(self.topic,))[0][0]
         return hdfs_last_ptn
 
     def get_hive_lastptn(self):
+        checkpoint = self.get_checkpoint()
+        if checkpoint is not None:
+            return checkpoint[1]
+
         qry = '''
                  select last_load_hive_partition
                  from flowview_load_metadata
-                 where topic_name = '%s'
+                 where topic_name = ?
                  order by load_end_time desc
                  limit 1;
-              ''' % (self.topic)
+              '''
 
-        hive_last_partition = self.execute_return(qry)[0][0]
+        hive_last_partition = self.execute_return(qry,(self.topic,))[0][0]
         return hive_last_partition
 
 
-    def execute(self, qry):
+    def execute(self, qry, params=()):
         """
         Function for executing queries which dont return results.
         Sends SQL query "qry" to metadata database.
         :param qry: SQL query string
+        :param params: Values of the query's ? parameters
         :return: None
         """
         try:
             cursor = self.connection.cursor()
-            cursor.execute(qry)
+            cursor.execute(qry, params)
             self.connection.commit()
             cursor.close()
-        except pyodbc.Error, poe:
+        except self.backend.Error, poe:
             raise poe
 
-    def execute_return(self, qry):
+    def execute_return(self, qry, params=()):
         """
         Function for executing queries which return results.
         Sends SQL query "qry" to metadata database.
         :param qry: SQL query string
+        :param params: Values of the query's ? parameters
         :return: None
         """
         try:
             cursor = self.connection.cursor()
-            cursor.execute(qry)
-            self.connection.commit()
+            cursor.execute(qry, params)
             results = cursor.fetchall()
+            self.connection.commit()
             cursor.close()
             return results
-        except pyodbc.Error, poe:
+        except self.backend.Error, poe:
             raise poe
 
     def get_dailyload(self,date):
@@ -155,7 +263,9 @@ class MetadataManager(object):
         return dailyload
 
     def close(self):
-        self.connection.close()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
 
     def purge(self):
         """
@@ -163,11 +273,12 @@ class MetadataManager(object):
         :return:
         """
         try:
-            for md_table in ("flowview_load_metadata","flowview_load_transmitted_ratio"):
+            for md_table in ("flowview_load_metadata","flowview_load_transmitted_ratio","flowview_checkpoint"):
                 purge_setup_qry = "delete from %s where topic_name = '%s';" \
                                   % (md_table, self.topic)
                 self.execute(purge_setup_qry)
             logger.info("Purged metadata tables")
-        except pyodbc.Error:
-            logger.error("Purge failed for dataset %s" % self.topic)
-            raise
\ No newline at end of file
+        except self.backend.Error:
+            errmsg = "Purge failed for dataset %s" % self.topic
+            logger.error(errmsg)
+            raise MetadataException(errmsg)
\ No newline at end of file
@@ -0,0 +1,180 @@
+import glob
+import logging
+import os
+import time
+from ConfigParser import SafeConfigParser
+from flowview.load_handler import LoadHandler
+from flowview.parse_stage import ParseStage
+from flowview.shell_executor import ShellExecutor
+from flowview.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Datasets discovered or loaded at once unless configured otherwise
+DEFAULT_DATASET_WORKERS = 4
+# hadoop and hive processes running at once across all datasets unless configured otherwise
+DEFAULT_PROCESS_LIMITS = {"hadoop": 16, "hive": 4}
+
+
+class OrchestratorException(Exception):
+    pass
+
+
+class DatasetRun(object):
+    """
+    Load of one dataset within an orchestrated run, with its timings for the report
+    """
+    def __init__(self,config_file):
+        self.config_file = config_file
+        self.name = os.path.splitext(os.path.basename(config_file))[0]
+        self.handler = None
+        self.status = "pending"
+        self.hdfs_dirs = 0
+        self.hive_ptns = 0
+        self.discover_seconds = None
+        self.load_seconds = None
+
+    def backlog(self):
+        return self.hdfs_dirs + self.hive_ptns
+
+    def parse_processes(self):
+        """
+        Reads hdfs_parse_processes before the handler exists, so the parse stage can be
+        created before any thread starts
+        :return: Number of parser processes the dataset asks for, 0 to parse in the I/O threads
+        """
+        parser = SafeConfigParser()
+        parser.read(self.config_file)
+        if not parser.has_option("main","hdfs_parse_processes") or parser.get("main","hdfs_parse_processes") == "":
+            return 0
+        return int(parser.get("main","hdfs_parse_processes"))
+
+
+class Orchestrator(object):
+    """
+    Runs the loads of every dataset config of a directory in one process, in place of one
+    scheduled process per dataset. All datasets share the parser processes, and the number
+    of hadoop and hive processes running at once is capped across all of them.
+    Pending work of every dataset is discovered first; loads then start with the largest backlog.
+    A failing dataset does not stop the others.
+    Each load keeps its own HDFS, writer and upload threads, since a WorkerPool stops at its
+    first failure; what they share is the capped number of hadoop and hive processes they
+    block on, and the parser processes.
+    """
+    def __init__(self,config_dir,dataset_workers=DEFAULT_DATASET_WORKERS,process_limits=None,
+                 parse_processes=0):
+        """
+        :param config_dir: Directory of dataset config files (*.cfg)
+        :param dataset_workers: Number of datasets discovered or loaded at once
+        :param process_limits: Dictionary from program name to the maximum number of its
+                               processes running at once. Defaults to DEFAULT_PROCESS_LIMITS.
+        :param parse_processes: Number of parser processes shared by all datasets.
+                                With 0 the datasets setting hdfs_parse_processes share as many
+                                parser processes as the largest of them asks for, and the others
+                                parse in their I/O threads.
+        :return:
+        """
+        self.config_dir = config_dir
+        self.dataset_workers = dataset_workers
+        self.process_limits = process_limits if process_limits is not None else DEFAULT_PROCESS_LIMITS
+        self.runs = [DatasetRun(config_file) for config_file in self.config_files()]
+        # Datasets using the shared parse stage
+        if parse_processes > 0:
+            self.parsing_runs = set(run.name for run in self.runs)
+        else:
+            dataset_processes = dict((run.name,run.parse_processes()) for run in self.runs)
+            self.parsing_runs = set(name for name,processes in dataset_processes.items() if processes > 0)
+            parse_processes = max(dataset_processes.values())
+        self.parse_processes = parse_processes
+        self.parse_stage = None
+
+    def config_files(self):
+        config_files = sorted(glob.glob(os.path.join(self.config_dir,"*.cfg")))
+        if not config_files:
+            raise OrchestratorException("No dataset config in %s" %self.config_dir)
+        return config_files
+
+    def discover(self,run):
+        """
+        Finds the pending work of one dataset. Called by the discovery pool threads.
+        :param run: DatasetRun
+        :return: None
+        """
+        start = time.time()
+        try:
+            # A load never creates a parse stage of its own: it would fork from a pool thread
+            # while the threads of other loads hold locks
+            run.handler = LoadHandler(run.config_file,
+                                      self.parse_stage if run.name in self.parsing_runs else None,
+                                      own_parse_stage=False)
+            proceed = run.handler.discover()
+            run.hdfs_dirs,run.hive_ptns = run.handler.backlog()
+            run.status = "pending" if proceed else "up to date"
+        except Exception:
+            logger.exception("Discovery of %s failed" %run.name)
+            run.status = "discovery failed"
+        run.discover_seconds = time.time() - start
+
+    def load(self,run):
+        """
+        Loads one dataset. Called by the load pool threads.
+        :param run: DatasetRun
+        :return: None
+        """
+        start = time.time()
+        try:
+            run.handler.load()
+            run.status = "loaded"
+        except Exception:
+            logger.exception("Load of %s failed" %run.name)
+            run.status = "load failed"
+        run.load_seconds = time.time() - start
+
+    def execute(self):
+        for program,limit in self.process_limits.items():
+            ShellExecutor.set_process_limit(program,limit)
+        logger.info("Orchestrating %s datasets of %s, process limits %s"
+                    %(len(self.runs),self.config_dir,self.process_limits))
+        # The parser processes are forked before any pool thread starts
+        if self.parsing_runs:
+            self.parse_stage = ParseStage(self.parse_processes)
+        try:
+            pool = WorkerPool("discover",self.dataset_workers,self.discover)
+            for run in self.runs:
+                pool.submit(run)
+            pool.join()
+
+            pending = sorted([run for run in self.runs if run.status == "pending"],
+                             key=lambda run: run.backlog(),reverse=True)
+            logger.info("Loading %s datasets, by backlog: %s"
+                        %(len(pending),", ".join("%s (%s)" %(run.name,run.backlog()) for run in pending)))
+            pool = WorkerPool("load",self.dataset_workers,self.load)
+            for run in pending:
+                pool.submit(run)
+            pool.join()
+        finally:
+            if self.parse_stage is not None:
+                self.parse_stage.close()
+            for run in self.runs:
+                if run.handler is not None:
+                    run.handler.metadata_mgr.close()
+                    run.handler.hive_exec.close()
+
+        for line in self.report():
+            logger.info(line)
+        failed = [run.name for run in self.runs if run.status.endswith("failed")]
+        if failed:
+            raise OrchestratorException("Loads failed for %s" %", ".join(failed))
+
+    def report(self):
+        """
+        :return: Lines of a table of every dataset's backlog, outcome and timings
+        """
+        def seconds(value):
+            return "%.1f" %value if value is not None else "-"
+        rows = [("dataset","status","hdfs dirs","hive ptns","discover s","load s")]
+        for run in sorted(self.runs,key=lambda run: run.name):
+            rows.append((run.name,run.status,str(run.hdfs_dirs),str(run.hive_ptns),
+                         seconds(run.discover_seconds),seconds(run.load_seconds)))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return ["  ".join(value.ljust(width) for value,width in zip(row,widths)).rstrip() for row in rows]
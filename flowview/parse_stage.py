@@ -0,0 +1,75 @@
+import multiprocessing
+from flowview.event_extractor import iter_events
+from flowview import row_formatter
+from flowview.load_summary import server_ts_range
+from flowview.hll import HyperLogLog
+from flowview.sampling import sample_events
+from flowview.record_reader import split_lines
+
+# Bytes of raw messages handed to a parser process at a time unless configured otherwise
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Chunks an I/O thread may have submitted before it waits for the oldest one
+DEFAULT_IN_FLIGHT = 2
+
+# Timestamp cache of the current process. Each parser process builds its own.
+_ts_cache = row_formatter.TimestampCache()
+
+
+def parse_chunk(task):
+    """
+    Parses a chunk of raw Trinity messages into hdfs_ts.txt rows.
+    Runs in the parser processes: the chunk comes in and the rows go out as
+    single strings, so nothing is pickled per event.
+    :param task: (raw messages, last field of the rows as returned by row_formatter.hdfs_ts_field,
+                  precision of the event id sketch or None, sample threshold or None)
+    :return: (rows, number of rows, lowest server timestamp, highest server timestamp,
+              serialized event id sketch or None)
+    """
+    chunk,last_field,sketch_precision,sample_threshold = task
+    # Split on "\n" alone, like the readline of the I/O threads: splitlines would also break
+    # messages on "\r", "\x0b", "\x0c", "\x1c"-"\x1e" and "\x85" bytes of their payload
+    events = list(sample_events(iter_events(split_lines([chunk])),sample_threshold))
+    min_server_ts,max_server_ts = server_ts_range(events)
+    sketch = None
+    if sketch_precision is not None:
+        hll = HyperLogLog(sketch_precision)
+        hll.update(event_id for event_id,_ in events)
+        sketch = hll.serialize()
+    return row_formatter.format_rows(events,last_field,_ts_cache),len(events),min_server_ts,max_server_ts,sketch
+
+
+class ParseStage(object):
+    """
+    CPU stage of the HDFS extraction. I/O threads read raw directory content and
+    submit it in large chunks; a multiprocessing pool does the parsing and formatting
+    outside of the GIL.
+    """
+    def __init__(self,processes,chunk_size=DEFAULT_CHUNK_SIZE,in_flight=DEFAULT_IN_FLIGHT):
+        """
+        :param processes: Number of parser processes
+        :param chunk_size: Bytes of raw messages per chunk
+        :param in_flight: Chunks each I/O thread may have submitted before it waits for the oldest.
+                          Raw data held in memory is bounded by I/O threads * in_flight * chunk_size.
+        :return:
+        """
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        # Started before any I/O thread, so the parser processes are forked from a single thread
+        self.pool = multiprocessing.Pool(processes)
+
+    def submit(self,chunk,last_field,sketch_precision=None,sample_threshold=None):
+        """
+        :param chunk: Raw messages, one per line
+        :param last_field: Last field of the rows
+        :param sketch_precision: Precision of the event id sketch of the chunk. None to build none.
+        :param sample_threshold: Sample of the events kept, as returned by sampling.sample_threshold.
+                                 None to keep every event.
+        :return: AsyncResult whose get() returns (rows, number of rows, lowest server timestamp,
+                 highest server timestamp, serialized event id sketch or None)
+        """
+        return self.pool.apply_async(parse_chunk,((chunk,last_field,sketch_precision,sample_threshold),))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,148 @@
+import errno
+import logging
+import os
+import threading
+from flowview.shell_executor import DEFAULT_STREAM_BUFSIZE
+from flowview.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Number of writer threads unless configured otherwise
+DEFAULT_WRITER_COUNT = 2
+# Batches waiting per writer before producers block
+DEFAULT_WRITER_QUEUE = 16
+HDFS_TS_FILE = "hdfs_ts.txt"
+
+
+def dir_file_name(path):
+    """
+    Name of the timestamp file of a directory's rows. Every directory has its own file, so
+    loads sharing a partition add files to it instead of replacing the earlier ones, and the
+    rows of a directory can be discarded or synced on their own.
+    :param path: HDFS path of the directory
+    :return: File name
+    """
+    return "hdfs_ts_%s.txt" %os.path.basename(path)
+
+
+class PartitionSink(object):
+    """
+    File-like front of a PartitionWriter for one timestamp file of a partition
+    """
+    def __init__(self,writer,ptn,file_name=HDFS_TS_FILE):
+        self.writer = writer
+        self.ptn = ptn
+        self.file_name = file_name
+
+    def write(self,data):
+        self.writer.write(self.ptn,data,self.file_name)
+
+
+class PartitionWriter(object):
+    """
+    Writer stage for the local timestamp files. Producers push batches of rows;
+    every partition is served by exactly one writer thread, which keeps the partition's
+    timestamp files open with a large buffer until they are finished. Batches of a partition
+    are therefore written whole and in order, whichever producer they come from.
+    """
+    def __init__(self,local_hdfs_ts_path,writer_count=DEFAULT_WRITER_COUNT,
+                 buffer_size=DEFAULT_STREAM_BUFSIZE,max_queue=DEFAULT_WRITER_QUEUE):
+        """
+        :param local_hdfs_ts_path: Local root of the partition directories
+        :param writer_count: Number of writer threads
+        :param buffer_size: Size in bytes of the buffer of each open file
+        :param max_queue: Batches queued per writer before write() blocks
+        :return:
+        """
+        self.local_hdfs_ts_path = local_hdfs_ts_path
+        self.buffer_size = buffer_size
+        self.files = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.pools = [WorkerPool("writer%s" %(i + 1),1,self._write,max_queue=max_queue)
+                      for i in range(writer_count)]
+
+    def local_path(self,ptn,file_name=HDFS_TS_FILE):
+        """
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param file_name: Name of the timestamp file
+        :return: Local path of the partition's timestamp file
+        """
+        return "%s/%s/%s" %(self.local_hdfs_ts_path,ptn,file_name)
+
+    def sink(self,ptn,file_name=HDFS_TS_FILE):
+        """
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param file_name: Name of the timestamp file
+        :return: File-like object whose writes go to the partition's file
+        """
+        return PartitionSink(self,ptn,file_name)
+
+    def write(self,ptn,data,file_name=HDFS_TS_FILE):
+        """
+        Queues a batch of rows for a partition. Blocks while the partition's writer is
+        max_queue batches behind, and raises the writer's error if it has failed.
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param data: Complete rows
+        :param file_name: Name of the timestamp file
+        :return: None
+        """
+        pool = self.pools[hash(ptn) % len(self.pools)]
+        pool.check()
+        pool.submit((ptn,file_name,data,None))
+
+    def finish(self,ptn,file_name=HDFS_TS_FILE,callback=None):
+        """
+        Queues the closing of a timestamp file after the batches already queued for it.
+        The file is synced to disk before callback is called from the writer thread.
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :param file_name: Name of the timestamp file
+        :param callback: Function called without arguments once the file is on disk
+        :return: None
+        """
+        pool = self.pools[hash(ptn) % len(self.pools)]
+        pool.check()
+        pool.submit((ptn,file_name,None,callback or (lambda: None)))
+
+    def _write(self,batch):
+        ptn,file_name,data,callback = batch
+        if callback is not None:
+            outfile = self.files.pop((ptn,file_name),None)
+            if outfile is not None:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                outfile.close()
+            callback()
+            return
+        outfile = self.files.get((ptn,file_name))
+        if outfile is None:
+            filepath = self.local_path(ptn,file_name)
+            try:
+                os.makedirs(os.path.dirname(filepath))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            outfile = open(filepath,"a",self.buffer_size)
+            self.files[(ptn,file_name)] = outfile
+        outfile.write(data)
+        # Flush on batch boundaries, so the file never ends in a partial batch
+        outfile.flush()
+        with self.lock:
+            rows,size = self.stats.get(ptn,(0,0))
+            self.stats[ptn] = (rows + data.count("\n"),size + len(data))
+
+    def close(self):
+        """
+        Waits for all queued batches to be written and closes the files
+        :return: Dictionary from partition to (rows written, bytes written)
+        """
+        try:
+            for pool in self.pools:
+                pool.join()
+        finally:
+            for outfile in self.files.values():
+                outfile.close()
+            self.files = {}
+        for ptn in sorted(self.stats):
+            logger.info("Wrote %s rows, %s bytes to partition %s" %(self.stats[ptn] + (ptn,)))
+        return dict(self.stats)
@@ -0,0 +1,430 @@
+import gzip
+import logging
+import os
+import struct
+import zlib
+from flowview.shell_executor import ShellExecutor, DEFAULT_STREAM_BUFSIZE
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_FILE_MAGIC = "SEQ"
+GZIP_MAGIC = "\x1f\x8b"
+# Bytes of a file looked at to tell plain text from binary data
+TEXT_CHECK_SIZE = 4096
+# Extensions of the codecs `hadoop fs -text` decodes but this module does not
+UNSUPPORTED_EXTENSIONS = (".bz2",".lz4",".lzo",".lzo_deflate",".zst")
+SYNC_SIZE = 16
+SYNC_ESCAPE = -1
+
+SNAPPY_CODEC = "org.apache.hadoop.io.compress.SnappyCodec"
+DEFAULT_CODEC = "org.apache.hadoop.io.compress.DefaultCodec"
+GZIP_CODEC = "org.apache.hadoop.io.compress.GzipCodec"
+
+TEXT_CLASS = "org.apache.hadoop.io.Text"
+BYTES_CLASS = "org.apache.hadoop.io.BytesWritable"
+LONG_CLASS = "org.apache.hadoop.io.LongWritable"
+INT_CLASS = "org.apache.hadoop.io.IntWritable"
+NULL_CLASS = "org.apache.hadoop.io.NullWritable"
+
+
+class RecordReaderException(Exception):
+    pass
+
+
+class ShellRecordReader(object):
+    """
+    Reads the records of an HDFS directory through `hadoop fs -text`.
+    One JVM is started for every directory read.
+    """
+    def __init__(self,buffer_size=DEFAULT_STREAM_BUFSIZE):
+        self.buffer_size = buffer_size
+
+    def read(self,path):
+        """
+        :param path: HDFS directory holding Trinity files
+        :return: Generator over the decoded records, one text line at a time
+        """
+        cmd = "hadoop fs -text %s/*" %path
+        return ShellExecutor.stream_execute(cmd,bufsize=self.buffer_size)
+
+
+class LocalRecordReader(object):
+    """
+    Reads the records of an HDFS directory in process, through a local path or a
+    FUSE/NFS mount of HDFS. SequenceFiles (uncompressed, record or block compressed)
+    Hadoop snappy/deflate/gzip streams and plain text are decoded in Python, so no JVM
+    is started. Directories holding anything else (bzip2, lz4, lzo, zstd or other binary
+    files) are handed to the fallback reader.
+    """
+    def __init__(self,mount_root,buffer_size=DEFAULT_STREAM_BUFSIZE,fallback=None):
+        """
+        :param mount_root: Local directory where the root of HDFS is mounted
+        :param buffer_size: Size in bytes of the read buffer of each file
+        :param fallback: Reader used for directories that cannot be decoded locally
+        :return:
+        """
+        self.mount_root = mount_root
+        self.buffer_size = buffer_size
+        self.fallback = fallback if fallback is not None else ShellRecordReader(buffer_size)
+
+    def local_path(self,path):
+        """
+        Maps an HDFS path to its location under the mount
+        :param path: HDFS path, e.g. /data/ds_ctg/trinity/thrive_test/d_20150819-1710
+        :return: Local path
+        """
+        return os.path.join(self.mount_root,path.lstrip("/"))
+
+    def list_files(self,path):
+        """
+        Lists the data files of a directory. As in HDFS, names starting with "_" or "."
+        (e.g. _SUCCESS) are treated as hidden.
+        :param path: HDFS directory
+        :return: Sorted list of local file paths
+        """
+        local_dir = self.local_path(path)
+        return [os.path.join(local_dir,name) for name in sorted(os.listdir(local_dir))
+                if not name.startswith("_") and not name.startswith(".")
+                and os.path.isfile(os.path.join(local_dir,name))]
+
+    def read(self,path):
+        """
+        :param path: HDFS directory holding Trinity files
+        :return: Generator over the decoded records, one text line at a time
+        """
+        try:
+            files = self.list_files(path)
+            for filepath in files:
+                with open(filepath,"rb") as f:
+                    check_decodable(f,filepath)
+        except (OSError,IOError,RecordReaderException) as e:
+            logger.warning("Cannot decode %s locally (%s), falling back to %s"
+                           %(path,e,type(self.fallback).__name__))
+            return self.fallback.read(path)
+        return self._read_files(files)
+
+    def _read_files(self,files):
+        for filepath in files:
+            with open(filepath,"rb",self.buffer_size) as f:
+                for record in decode_file(f,filepath):
+                    yield record
+
+
+def get_record_reader(name,buffer_size=DEFAULT_STREAM_BUFSIZE,mount_root=None):
+    """
+    Builds the record reader selected in the config file
+    :param name: "shell" for `hadoop fs -text`, "local" for the in-process decoder
+    :param buffer_size: Size in bytes of the read buffers
+    :param mount_root: Local mount of HDFS, required by the "local" reader
+    :return: Record reader
+    """
+    if name == "shell":
+        return ShellRecordReader(buffer_size)
+    elif name == "local":
+        if not mount_root:
+            raise RecordReaderException("hdfs_mount_root is required by the local record reader")
+        return LocalRecordReader(mount_root,buffer_size)
+    else:
+        raise RecordReaderException("Invalid record reader: %s" %name)
+
+
+def file_format(f,filepath):
+    """
+    Recognizes a file the way `hadoop fs -text` does: SequenceFiles and gzip streams by
+    their header, other compressed streams by their extension, anything else as text.
+    Raises RecordReaderException for compressed or binary files this module cannot decode,
+    instead of passing their bytes on as lines.
+    :param f: File object positioned at the start of the file. Left at the start of the file.
+    :param filepath: Name of the file
+    :return: "sequence", "gzip", "snappy", "deflate" or "text"
+    """
+    head = f.read(TEXT_CHECK_SIZE)
+    f.seek(0)
+    if head.startswith(SEQUENCE_FILE_MAGIC):
+        return "sequence"
+    elif head.startswith(GZIP_MAGIC) or filepath.endswith(".gz"):
+        return "gzip"
+    elif filepath.endswith(".snappy"):
+        return "snappy"
+    elif filepath.endswith(".deflate"):
+        return "deflate"
+    elif filepath.endswith(UNSUPPORTED_EXTENSIONS):
+        raise RecordReaderException("Unsupported compression: %s" %filepath)
+    elif "\x00" in head:
+        raise RecordReaderException("Not a text file: %s" %filepath)
+    return "text"
+
+
+def check_decodable(f,filepath):
+    """
+    Reads the header of a file and raises RecordReaderException if it cannot be decoded locally
+    :param f: File object positioned at the start of the file
+    :param filepath: Name of the file
+    :return: None
+    """
+    file_type = file_format(f,filepath)
+    if file_type == "sequence":
+        SequenceFileHeader(f)
+    elif file_type == "snappy":
+        snappy_uncompress()
+
+
+def decode_file(f,filepath):
+    """
+    Decodes a file the way `hadoop fs -text` does
+    :param f: File object positioned at the start of the file
+    :param filepath: Name of the file
+    :return: Generator over the decoded records
+    """
+    file_type = file_format(f,filepath)
+    if file_type == "sequence":
+        return read_sequence_file(f)
+    elif file_type == "snappy":
+        return split_lines(iter_blocks(f,snappy_uncompress()))
+    elif file_type == "deflate":
+        return split_lines(read_zlib_stream(f,zlib.MAX_WBITS))
+    elif file_type == "gzip":
+        return iter(gzip.GzipFile(fileobj=f))
+    else:
+        return iter(f)
+
+
+def snappy_uncompress():
+    """
+    :return: Raw snappy decompression function
+    """
+    if snappy is None:
+        raise RecordReaderException("python-snappy is not installed")
+    return snappy.uncompress
+
+
+def get_decompressor(codec):
+    """
+    :param codec: Hadoop compression codec class name
+    :return: Function decompressing one buffer produced by the codec's compressor
+    """
+    if codec == SNAPPY_CODEC:
+        uncompress = snappy_uncompress()
+        return lambda data: "".join(iter_blocks(_BufferReader(data),uncompress))
+    elif codec == DEFAULT_CODEC:
+        return zlib.decompress
+    elif codec == GZIP_CODEC:
+        return lambda data: zlib.decompress(data,16 + zlib.MAX_WBITS)
+    else:
+        raise RecordReaderException("Unsupported codec: %s" %codec)
+
+
+def read_exactly(f,size):
+    data = f.read(size)
+    if len(data) != size:
+        raise RecordReaderException("Unexpected end of file")
+    return data
+
+
+def read_int(f):
+    return struct.unpack(">i",read_exactly(f,4))[0]
+
+
+def decode_vlong(first,next_byte):
+    """
+    Decodes a Hadoop variable-length integer (WritableUtils.readVLong)
+    :param first: First byte of the encoding, as a signed value
+    :param next_byte: Function returning the following bytes as unsigned values
+    :return: Decoded integer
+    """
+    if first >= -112:
+        return first
+    negative = first < -120
+    size = (-119 - first) if negative else (-111 - first)
+    value = 0
+    for _ in range(size - 1):
+        value = (value << 8) | next_byte()
+    return ~value if negative else value
+
+
+def read_vlong(f):
+    first = struct.unpack(">b",read_exactly(f,1))[0]
+    return decode_vlong(first,lambda: ord(read_exactly(f,1)))
+
+
+def read_vlong_at(buf,pos):
+    """
+    Decodes a variable-length integer from a buffer
+    :return: (value, position after the integer)
+    """
+    first = struct.unpack_from(">b",buf,pos)[0]
+    cursor = [pos + 1]
+    def next_byte():
+        byte = ord(buf[cursor[0]])
+        cursor[0] += 1
+        return byte
+    return decode_vlong(first,next_byte),cursor[0]
+
+
+def read_text(f):
+    return read_exactly(f,read_vlong(f))
+
+
+class SequenceFileHeader(object):
+    """
+    Header of a Hadoop SequenceFile
+    """
+    def __init__(self,f):
+        if read_exactly(f,3) != SEQUENCE_FILE_MAGIC:
+            raise RecordReaderException("Not a SequenceFile")
+        self.version = ord(read_exactly(f,1))
+        if self.version < 6:
+            raise RecordReaderException("Unsupported SequenceFile version %s" %self.version)
+        self.key_class = read_text(f)
+        self.value_class = read_text(f)
+        self.compressed = read_exactly(f,1) != "\x00"
+        self.block_compressed = read_exactly(f,1) != "\x00"
+        self.decompress = None
+        if self.compressed:
+            self.decompress = get_decompressor(read_text(f))
+        self.metadata = {}
+        for _ in range(read_int(f)):
+            key = read_text(f)
+            self.metadata[key] = read_text(f)
+        self.sync = read_exactly(f,SYNC_SIZE)
+
+
+def writable_to_text(class_name,data):
+    """
+    Renders a serialized Writable as text. Text and BytesWritable give their raw content.
+    :param class_name: Writable class name from the SequenceFile header
+    :param data: Serialized Writable
+    :return: String, or None for NullWritable
+    """
+    if class_name == TEXT_CLASS:
+        length,pos = read_vlong_at(data,0)
+        return data[pos:pos + length]
+    elif class_name == BYTES_CLASS:
+        return data[4:4 + struct.unpack_from(">i",data,0)[0]]
+    elif class_name == LONG_CLASS:
+        return str(struct.unpack(">q",data)[0])
+    elif class_name == INT_CLASS:
+        return str(struct.unpack(">i",data)[0])
+    elif class_name == NULL_CLASS:
+        return None
+    else:
+        return data
+
+
+def format_record(header,key,value):
+    key_text = writable_to_text(header.key_class,key)
+    value_text = writable_to_text(header.value_class,value)
+    if key_text is None:
+        return "%s\n" %value_text
+    return "%s\t%s\n" %(key_text,value_text)
+
+
+def read_sequence_file(f):
+    """
+    Decodes all records of a SequenceFile
+    :param f: File object positioned at the start of the file
+    :return: Generator over "key<TAB>value" lines, as printed by `hadoop fs -text`
+    """
+    header = SequenceFileHeader(f)
+    if header.block_compressed:
+        return _read_block_records(f,header)
+    return _read_records(f,header)
+
+
+def _read_records(f,header):
+    while True:
+        length_bytes = f.read(4)
+        if not length_bytes:
+            return
+        if len(length_bytes) < 4:
+            raise RecordReaderException("Unexpected end of file")
+        record_length = struct.unpack(">i",length_bytes)[0]
+        if record_length == SYNC_ESCAPE:
+            if read_exactly(f,SYNC_SIZE) != header.sync:
+                raise RecordReaderException("SequenceFile sync marker mismatch")
+            continue
+        key_length = read_int(f)
+        key = read_exactly(f,key_length)
+        value = read_exactly(f,record_length - key_length)
+        if header.compressed:
+            value = header.decompress(value)
+        yield format_record(header,key,value)
+
+
+def _read_block_records(f,header):
+    while True:
+        escape = f.read(4)
+        if not escape:
+            return
+        if struct.unpack(">i",escape)[0] != SYNC_ESCAPE or read_exactly(f,SYNC_SIZE) != header.sync:
+            raise RecordReaderException("SequenceFile sync marker mismatch")
+        record_count = read_vlong(f)
+        key_lengths,keys,value_lengths,values = [header.decompress(read_text(f)) for _ in range(4)]
+        key_pos = value_pos = key_len_pos = value_len_pos = 0
+        for _ in range(record_count):
+            key_length,key_len_pos = read_vlong_at(key_lengths,key_len_pos)
+            value_length,value_len_pos = read_vlong_at(value_lengths,value_len_pos)
+            key = keys[key_pos:key_pos + key_length]
+            value = values[value_pos:value_pos + value_length]
+            key_pos += key_length
+            value_pos += value_length
+            yield format_record(header,key,value)
+
+
+def iter_blocks(f,decompress):
+    """
+    Decodes the framing of Hadoop's BlockCompressorStream (used by SnappyCodec):
+    a 4 byte uncompressed block length followed by 4 byte length-prefixed compressed chunks
+    :param f: File object
+    :param decompress: Raw decompression function
+    :return: Generator over decompressed chunks
+    """
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise RecordReaderException("Unexpected end of file")
+        block_length = struct.unpack(">I",header)[0]
+        produced = 0
+        while produced < block_length:
+            chunk = decompress(read_exactly(f,struct.unpack(">I",read_exactly(f,4))[0]))
+            produced += len(chunk)
+            yield chunk
+
+
+class _BufferReader(object):
+    def __init__(self,data):
+        self.data = data
+        self.pos = 0
+
+    def read(self,size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+def read_zlib_stream(f,wbits):
+    decompressor = zlib.decompressobj(wbits)
+    for data in iter(lambda: f.read(DEFAULT_STREAM_BUFSIZE),""):
+        yield decompressor.decompress(data)
+    yield decompressor.flush()
+
+
+def split_lines(chunks):
+    """
+    Re-splits a stream of decompressed chunks into lines
+    """
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if pending:
+        yield pending
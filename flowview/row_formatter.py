@@ -0,0 +1,68 @@
+from datetime import datetime
+
+# Separates the fields of hdfs_ts.txt rows
+CTRL_A = '\x01'
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+TS_LENGTH = 19
+
+
+class TimestampCache(object):
+    """
+    Formats epoch seconds as local "YYYY-MM-DD HH:MM:SS" strings, formatting each
+    second only once. Events of a directory fall into a few thousand distinct seconds,
+    so almost every lookup is a hit.
+    """
+    def __init__(self,max_size=100000):
+        """
+        :param max_size: Number of formatted seconds kept before the cache is emptied
+        :return:
+        """
+        self.max_size = max_size
+        self.formatted = {}
+
+    def fill(self,seconds):
+        """
+        Formats every second of a batch missing from the cache
+        :param seconds: Iterable over epoch seconds
+        :return: Dictionary from epoch second to formatted timestamp
+        """
+        formatted = self.formatted
+        missing = set(seconds).difference(formatted)
+        if len(formatted) + len(missing) > self.max_size:
+            formatted.clear()
+            missing = set(seconds)
+        for second in missing:
+            formatted[second] = datetime.fromtimestamp(second).strftime(TS_FORMAT)
+        return formatted
+
+
+def hdfs_ts_field(hdfs_ts):
+    """
+    :param hdfs_ts: HDFS directory timestamp, e.g. 2015-08-19 10:12
+    :return: Last field of the rows of that directory. Seconds are added so that
+             it is recognizable by Hive timestamp format.
+    """
+    return hdfs_ts + ":00\n"
+
+
+def row_size(event_id,last_field):
+    """
+    :return: Size in bytes of the row format_rows writes for event_id
+    """
+    return len(event_id) + TS_LENGTH + len(last_field) + 2
+
+
+def format_rows(events,last_field,cache):
+    """
+    Formats a batch of parsed events into Ctrl-A delimited hdfs_ts.txt rows.
+    Millisecond epochs are converted in one pass per batch and looked up per second.
+    :param events: List of (event_id, server_timestamp in milliseconds as a string)
+    :param last_field: Output of hdfs_ts_field for the directory the events come from
+    :param cache: TimestampCache
+    :return: String holding all rows of the batch
+    """
+    seconds = [int(server_unix_ts) // 1000 for _,server_unix_ts in events]
+    formatted = cache.fill(seconds)
+    tail = CTRL_A + last_field
+    return "".join([event_id + CTRL_A + formatted[second] + tail
+                     for (event_id,_),second in zip(events,seconds)])
@@ -0,0 +1,75 @@
+import struct
+
+# Events are hashed into this many buckets; a sample keeps the lowest buckets
+SAMPLE_BUCKETS = 10000
+
+
+class SamplingException(Exception):
+    pass
+
+
+def sample_threshold(sample_rate):
+    """
+    :param sample_rate: Fraction of events kept, between 0 (excluded) and 1
+    :return: Number of buckets kept, None when every event is kept
+    """
+    sample_rate = float(sample_rate)
+    if not 0 < sample_rate <= 1:
+        raise SamplingException("Sample rate %s out of range (0, 1]" %sample_rate)
+    threshold = int(round(sample_rate * SAMPLE_BUCKETS))
+    if threshold < 1:
+        raise SamplingException("Sample rate %s is below 1/%s" %(sample_rate,SAMPLE_BUCKETS))
+    return threshold if threshold < SAMPLE_BUCKETS else None
+
+
+def sampled_rate(threshold):
+    """
+    :param threshold: Output of sample_threshold
+    :return: Fraction of events actually kept
+    """
+    return float(threshold) / SAMPLE_BUCKETS if threshold is not None else 1.0
+
+
+def hive_string_hash(value):
+    """
+    Same value as Hive's hash() of a string: the Java hash of its UTF-8 bytes,
+    taken as signed bytes, in 32 bit signed arithmetic.
+    :param value: String
+    :return: int
+    """
+    if isinstance(value,unicode):
+        value = value.encode("utf-8")
+    h = 0
+    for byte in struct.unpack("%db" %len(value),value):
+        h = (31 * h + byte) & 0xFFFFFFFF
+    return h - 0x100000000 if h & 0x80000000 else h
+
+
+def in_sample(event_id,threshold):
+    """
+    Python's modulo is never negative, like Hive's pmod()
+    :return: True if the event belongs to the sample of the given threshold
+    """
+    return hive_string_hash(event_id) % SAMPLE_BUCKETS < threshold
+
+
+def sample_events(events,threshold):
+    """
+    :param events: Iterable over (event_id, server_timestamp)
+    :param threshold: Output of sample_threshold
+    :return: Iterable over the sampled events
+    """
+    if threshold is None:
+        return events
+    return (event for event in events if in_sample(event[0],threshold))
+
+
+def hive_predicate(threshold,column="event_id"):
+    """
+    :param threshold: Output of sample_threshold
+    :param column: Event id column, qualified if needed
+    :return: HiveQL predicate keeping the same events as in_sample, None without sampling
+    """
+    if threshold is None:
+        return None
+    return "pmod(hash(%s), %d) < %d" %(column,SAMPLE_BUCKETS,threshold)
@@ -23,7 +23,10 @@ class SetupHandler(FlowviewHandler):
                          "table_name":self.table,
                          "load_start_time":current_ts,
                          "load_end_time":current_ts}
-        self.metadata_mgr.insert(load_metadata,"load")
+        with self.metadata_mgr.transaction():
+            self.metadata_mgr.insert_many([load_metadata],"load",commit=False)
+            # A dataset set up again starts over from the beginning
+            self.metadata_mgr.reset_checkpoint()
 
         self.metadata_mgr.close()
 
@@ -36,17 +39,15 @@ class SetupHandler(FlowviewHandler):
         :param None:
         :return: None
         """
-        hdfs_ts_cmd = '''
-        hive -e "use flowview;
-        drop table if exists %s_hdfs;
-        create table %s_hdfs (event_id string, server_timestamp timestamp, hdfs_timestamp timestamp)
+        hdfs_ts_stmts = ["use flowview",
+                         "drop table if exists %s_hdfs" %self.table,
+                         '''create table %s_hdfs (event_id string, server_timestamp timestamp, hdfs_timestamp timestamp)
         partitioned by (year int, month int, day int, hour int)
         row format delimited
-        fields terminated by '\001';"
-        ''' %(self.table,self.table)
+        fields terminated by '\001' ''' %self.table]
 
         try:
-            self.shell_exec.safe_execute(hdfs_ts_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(hdfs_ts_stmts)
         except ShellException:
             logger.error("Error in creating %s server and hdfs timestamp table in Hive" %self.table)
             raise
@@ -59,18 +60,16 @@ class SetupHandler(FlowviewHandler):
         :param None
         :return: None
         """
-        hive_ts_cmd = '''
-        hive -e "use flowview;
-        drop table if exists %s_hive;
-        create table %s_hive (event_id string, hive_timestamp timestamp)
+        hive_ts_stmts = ["use flowview",
+                         "drop table if exists %s_hive" %self.table,
+                         '''create table %s_hive (event_id string, hive_timestamp timestamp)
         partitioned by (year int, month int, day int, hour int)
         row format delimited
         fields terminated by '\u0001'
-        lines terminated by '\n';"
-        ''' %(self.table,self.table)
+        lines terminated by '\n' ''' %self.table]
 
         try:
-            self.shell_exec.safe_execute(hive_ts_cmd,splitcmd=False,as_shell=True)
+            self.hive_exec.execute(hive_ts_stmts)
         except ShellException:
             logger.error("Error in creating %s hive timestamp table in Hive" %self.table)
             raise
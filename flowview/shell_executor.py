@@ -1,7 +1,20 @@
 # Author Rohan Kekatpure
 # Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
 
+import os
 import subprocess as sp
+import tempfile
+import threading
+
+# Default size in bytes of the pipe buffer used when streaming command output
+DEFAULT_STREAM_BUFSIZE = 1024 * 1024
+
+# Semaphores bounding the processes of a program (e.g. hadoop, hive) running at once,
+# shared by every thread of the process
+_process_slots = {}
+# Streaming processes of each thread, by thread ident, so that another thread can stop them
+_thread_processes = {}
+_thread_processes_lock = threading.Lock()
 
 
 class ShellException(Exception):
@@ -22,6 +35,15 @@ class ShellResult(object):
         return self.__str__()
 
 
+def program_name(cmd):
+    """
+    :param cmd: Command as a list of arguments or as a shell string
+    :return: Name of the program the command runs, e.g. hadoop
+    """
+    words = cmd if isinstance(cmd,list) else cmd.split()
+    return os.path.basename(words[0]) if words else None
+
+
 class ShellExecutor(object):
     """
     An anstraction over bash shell command layer. This class facilitates executing
@@ -29,6 +51,50 @@ class ShellExecutor(object):
     class because this class is used to set up the logger itself.
     """
 
+    @staticmethod
+    def set_process_limit(program, limit):
+        """
+        Bounds the number of processes of a program run at once by all threads.
+        Commands of a program at its limit wait for a running one to exit.
+        Meant to be called before any command runs.
+        :param program: Program name, e.g. hadoop
+        :param limit: Maximum number of processes. None or 0 for no limit.
+        :return: None
+        """
+        if limit:
+            _process_slots[program] = threading.BoundedSemaphore(limit)
+        else:
+            _process_slots.pop(program, None)
+
+    @staticmethod
+    def process_slot(cmd):
+        """
+        :param cmd: Command as a list of arguments or as a shell string
+        :return: Semaphore limiting the command's program, None if it is not limited
+        """
+        return _process_slots.get(program_name(cmd))
+
+    @staticmethod
+    def kill_thread_processes(thread_ident):
+        """
+        Kills the streaming commands started by a thread, e.g. one stuck reading a hung command.
+        The thread's generator then ends with ShellException and releases the process slot.
+        :param thread_ident: ident of the thread
+        :return: Number of processes killed
+        """
+        with _thread_processes_lock:
+            processes = list(_thread_processes.get(thread_ident, ()))
+        killed = 0
+        for process in processes:
+            if process.poll() is None:
+                try:
+                    process.kill()
+                    killed += 1
+                except OSError:
+                    # Exited in the meantime
+                    pass
+        return killed
+
     @staticmethod
     def execute(cmd_string, verbose=False, splitcmd=True, as_shell=False):
         """
@@ -45,6 +111,9 @@ class ShellExecutor(object):
         if verbose:
             print "[ShellExecutor::execute] %s" % cmd
 
+        slot = ShellExecutor.process_slot(cmd)
+        if slot is not None:
+            slot.acquire()
         try:
             result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=as_shell)
             output, error = result.communicate()
@@ -52,6 +121,9 @@ class ShellExecutor(object):
             return ShellResult(retcode, output, error)
         except OSError:
             raise ShellException
+        finally:
+            if slot is not None:
+                slot.release()
 
     @staticmethod
     def safe_execute(cmd_string, **kwargs):
@@ -66,4 +138,61 @@ class ShellExecutor(object):
         else:
             return shell_result
 
+    @staticmethod
+    def stream_execute(cmd_string, bufsize=DEFAULT_STREAM_BUFSIZE, verbose=False,
+                       splitcmd=True, as_shell=False):
+        """
+        Executes command string and yields its output line by line as it is produced,
+        so the whole output never has to be held in memory. Error output is spooled
+        to a temporary file so that a chatty stderr cannot block the command.
+        Raises exception once the output is exhausted if return code is not 0
+        :param cmd_string: Command string with arguments separated by spaces
+        :param bufsize: Size in bytes of the buffer on the output pipe
+        :return: Generator over output lines
+        """
 
+        if splitcmd:
+            cmd = cmd_string.split(" ")
+        else:
+            cmd = cmd_string
+
+        if verbose:
+            print "[ShellExecutor::stream_execute] %s" % cmd
+
+        # Held until the command has exited, however long its output takes to consume
+        slot = ShellExecutor.process_slot(cmd)
+        if slot is not None:
+            slot.acquire()
+        errfile = tempfile.TemporaryFile()
+        try:
+            result = sp.Popen(cmd, stdout=sp.PIPE, stderr=errfile, shell=as_shell, bufsize=bufsize)
+        except OSError:
+            errfile.close()
+            if slot is not None:
+                slot.release()
+            raise ShellException
+
+        thread_ident = threading.current_thread().ident
+        with _thread_processes_lock:
+            _thread_processes.setdefault(thread_ident, set()).add(result)
+        try:
+            for line in iter(result.stdout.readline, ""):
+                yield line
+            result.stdout.close()
+            retcode = result.wait()
+            if retcode != 0:
+                errfile.seek(0)
+                raise ShellException(errfile.read())
+        finally:
+            # Generator closed early by the consumer: do not leave the command running
+            if result.poll() is None:
+                result.kill()
+                result.wait()
+            with _thread_processes_lock:
+                processes = _thread_processes.get(thread_ident)
+                processes.discard(result)
+                if not processes:
+                    del _thread_processes[thread_ident]
+            errfile.close()
+            if slot is not None:
+                slot.release()
@@ -0,0 +1,108 @@
+import logging
+import os
+import shutil
+import threading
+from flowview.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Threads uploading and registering partitions unless configured otherwise
+DEFAULT_UPLOAD_WORKERS = 2
+
+
+class UploadStage(object):
+    """
+    Upload stage of the HDFS extraction. Partitions are submitted as soon as all of their
+    directories are extracted, and uploaded and registered while extraction goes on.
+    Each worker takes every partition ready at that moment as one batch, so a batch costs
+    one mkdir, one put and one Hive statement however many partitions it holds. The files
+    of a batch are hard linked into a staging directory of their own, since force_put_ptns
+    uploads whole top level directories and other partitions are still being written.
+    """
+    def __init__(self,hdfs_mng,table,local_hdfs_ts_path,hive_hdfs_ts_path,
+                 worker_count=DEFAULT_UPLOAD_WORKERS,journal=None,extracted_ptns=None):
+        """
+        :param hdfs_mng: hdfsManager running the uploads and the partition DDL
+        :param table: Dataset's Thrive table name in Hive
+        :param local_hdfs_ts_path: Local root of the partition directories
+        :param hive_hdfs_ts_path: HDFS root of the partition directories
+        :param worker_count: Number of batches uploaded at once
+        :param journal: LoadJournal the uploads and registrations are recorded in
+        :param extracted_ptns: Partitions receiving rows in this run. Other partitions the
+                               journal has uploaded are only registered if need be.
+        :return:
+        """
+        self.hdfs_mng = hdfs_mng
+        self.table = table
+        self.local_hdfs_ts_path = local_hdfs_ts_path
+        self.hive_hdfs_ts_path = hive_hdfs_ts_path
+        self.journal = journal
+        self.extracted_ptns = extracted_ptns if extracted_ptns is not None else set()
+        # Kept beside the partition directories: hard links need the same file system
+        self.staging_root = "%s_upload" %local_hdfs_ts_path.rstrip("/")
+        shutil.rmtree(self.staging_root,ignore_errors=True)
+        self.lock = threading.Lock()
+        self.ready = []
+        self.batches = 0
+        self.pool = WorkerPool("upload",worker_count,self._upload)
+
+    def submit(self,ptn):
+        """
+        Queues a partition whose directories are all extracted and synced
+        :param ptn: Partition in the format of YYYY/MM/DD/HH
+        :return: None
+        """
+        with self.lock:
+            self.ready.append(ptn)
+        self.pool.submit(ptn)
+
+    def stage(self,batch_dir,ptns):
+        """
+        Hard links the local files of ptns under batch_dir, in the layout of local_hdfs_ts_path
+        :return: None
+        """
+        for ptn in ptns:
+            ptn_dir = "%s/%s" %(self.local_hdfs_ts_path,ptn)
+            if not os.path.isdir(ptn_dir):
+                continue
+            staged_dir = "%s/%s" %(batch_dir,ptn)
+            os.makedirs(staged_dir)
+            for file_name in os.listdir(ptn_dir):
+                os.link("%s/%s" %(ptn_dir,file_name),"%s/%s" %(staged_dir,file_name))
+
+    def _upload(self,_):
+        with self.lock:
+            batch,self.ready = sorted(self.ready),[]
+            self.batches += 1
+            batch_dir = "%s/%s" %(self.staging_root,self.batches)
+        # Taken by a worker woken earlier
+        if not batch:
+            return
+        journal = self.journal
+        upload_ptns = [ptn for ptn in batch
+                       if journal is None or ptn in self.extracted_ptns or ptn not in journal.uploaded]
+        if upload_ptns:
+            try:
+                self.stage(batch_dir,upload_ptns)
+                self.hdfs_mng.makedirs(["%s/%s" %(self.hive_hdfs_ts_path,ptn) for ptn in upload_ptns])
+                self.hdfs_mng.force_put_ptns(batch_dir,upload_ptns,self.hive_hdfs_ts_path)
+            finally:
+                shutil.rmtree(batch_dir,ignore_errors=True)
+            if journal is not None:
+                journal.ptns_uploaded(upload_ptns)
+        # Registered right after the upload, so each partition is queryable as soon as possible
+        register_ptns = [ptn for ptn in batch if journal is None or ptn not in journal.registered]
+        if register_ptns:
+            self.hdfs_mng.create_hdfs_ts_ptns(register_ptns,self.table,self.hive_hdfs_ts_path)
+            if journal is not None:
+                journal.ptns_registered(register_ptns)
+        logger.info("Uploaded %s and registered %s of partitions %s" %(len(upload_ptns),len(register_ptns),batch))
+
+    def join(self):
+        """
+        Waits for every submitted partition to be uploaded and registered.
+        Raises the first upload error.
+        :return: None
+        """
+        self.pool.join()
+        shutil.rmtree(self.staging_root,ignore_errors=True)
@@ -0,0 +1,193 @@
+import Queue
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue once per worker to make it exit
+_STOP = object()
+
+
+class WorkerPoolException(Exception):
+    pass
+
+
+def run_concurrently(tasks):
+    """
+    Runs functions in threads of their own and waits for all of them, whether or not some fail
+    :param tasks: List of (name, function called without arguments)
+    :return: List of (name, exc_info) of the functions that raised, in the order of tasks
+    """
+    failures = {}
+    def run(name,function):
+        try:
+            function()
+        except Exception:
+            logger.exception("%s failed" %name)
+            failures[name] = sys.exc_info()
+    threads = [threading.Thread(target=run,args=task,name=task[0]) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # Joined with a timeout, so the main thread still receives signals
+        while thread.is_alive():
+            thread.join(1)
+    return [(name,failures[name]) for name,_ in tasks if name in failures]
+
+
+class WorkerPool(object):
+    """
+    Fixed number of worker threads calling a handler on items taken from a shared queue.
+    Workers block on the queue and exit when they receive a stop sentinel. The first
+    exception raised by the handler stops the pool from starting new items, and is
+    raised again from join() in the thread that owns the pool.
+    """
+    def __init__(self,name,worker_count,handler,max_queue=0,task_timeout=None,progress_interval=60,
+                 on_timeout=None):
+        """
+        :param name: Name of the pool, used for thread names and logging
+        :param worker_count: Number of worker threads
+        :param handler: Function called with each submitted item
+        :param max_queue: Maximum number of queued items, submit() blocks when reached. 0 for no limit.
+        :param task_timeout: Seconds after which an item still running fails the pool. None for no limit.
+        :param progress_interval: Seconds between progress log lines while joining
+        :param on_timeout: Function called with the item and the worker thread of an item running past
+                           task_timeout, to stop what it is blocked on so that the worker can exit
+        :return:
+        """
+        if worker_count < 1:
+            raise WorkerPoolException("Worker count of %s must be at least 1" %name)
+        self.name = name
+        self.handler = handler
+        self.task_timeout = task_timeout
+        self.on_timeout = on_timeout
+        self.progress_interval = progress_interval
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.running = {}
+        self.failure = None
+        self.closed = False
+        self.threads = []
+        for i in range(worker_count):
+            thread = threading.Thread(target=self._work,name="%s-%s" %(name,i + 1))
+            # A stuck worker must not keep the process alive once the pool has failed
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self,item):
+        """
+        Queues an item for processing
+        :param item: Argument for the handler
+        :return: None
+        """
+        if self.closed:
+            raise WorkerPoolException("Worker pool %s is closed" %self.name)
+        with self.lock:
+            self.submitted += 1
+        self.queue.put(item)
+
+    def queue_depth(self):
+        """
+        :return: Number of items waiting for a worker
+        """
+        return self.queue.qsize()
+
+    def progress(self):
+        """
+        :return: (completed items, submitted items)
+        """
+        with self.lock:
+            return self.completed,self.submitted
+
+    def failed(self):
+        """
+        :return: True once an item has failed
+        """
+        return self.failure is not None
+
+    def _work(self):
+        name = threading.current_thread().name
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            # Once an item has failed, the remaining ones are drained without being processed
+            if self.failure is not None:
+                continue
+            with self.lock:
+                self.running[name] = (item,time.time(),threading.current_thread())
+            try:
+                self.handler(item)
+                with self.lock:
+                    self.completed += 1
+            except Exception:
+                logger.exception("%s failed processing %s" %(name,item))
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = (item,sys.exc_info())
+            finally:
+                with self.lock:
+                    del self.running[name]
+
+    def close(self):
+        """
+        Stops accepting items. Workers exit after the items already queued.
+        :return: None
+        """
+        if not self.closed:
+            self.closed = True
+            for _ in self.threads:
+                self.queue.put(_STOP)
+
+    def check(self):
+        """
+        Raises the first handler exception, or WorkerPoolException if an item
+        has been running for longer than task_timeout
+        :return: None
+        """
+        if self.failure is not None:
+            item,(exc_type,exc_value,exc_tb) = self.failure
+            logger.error("Worker pool %s failed on %s" %(self.name,item))
+            raise exc_type,exc_value,exc_tb
+        if self.task_timeout:
+            now = time.time()
+            with self.lock:
+                running = self.running.values()
+            for item,started,thread in running:
+                if now - started > self.task_timeout:
+                    errmsg = "Worker pool %s stuck on %s for more than %s seconds" \
+                             %(self.name,item,self.task_timeout)
+                    logger.error(errmsg)
+                    # The remaining items are drained without being processed
+                    with self.lock:
+                        if self.failure is None:
+                            self.failure = (item,(WorkerPoolException,WorkerPoolException(errmsg),None))
+                    if self.on_timeout is not None:
+                        self.on_timeout(item,thread)
+                    raise WorkerPoolException(errmsg)
+
+    def join(self,poll_interval=1):
+        """
+        Closes the pool and waits for all queued items to be processed
+        :param poll_interval: Seconds between failure and timeout checks
+        :return: None
+        """
+        self.close()
+        last_report = time.time()
+        while any(thread.is_alive() for thread in self.threads):
+            self.check()
+            if time.time() - last_report >= self.progress_interval:
+                completed,submitted = self.progress()
+                logger.info("%s: %s of %s items done, %s queued"
+                            %(self.name,completed,submitted,self.queue_depth()))
+                last_report = time.time()
+            for thread in self.threads:
+                thread.join(poll_interval)
+                if thread.is_alive():
+                    break
+        self.check()
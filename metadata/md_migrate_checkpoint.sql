@@ -0,0 +1,80 @@
+-- Upgrades a metadata database created from an earlier md_schema.sql, keeping its history.
+-- Run this file from MySQL shell as
+-- "source md_migrate_checkpoint.sql;"
+-- or with "./setup_metadata.sh ./md_migrate_checkpoint.sql".
+-- Every statement checks what already exists, so the file can be run again after a partial upgrade.
+
+alter table flowview_load_metadata modify topic_name varchar(255) not null;
+alter table flowview_load_transmitted_ratio modify topic_name varchar(255) not null;
+
+-- MySQL has no "add column if not exists" nor "create index if not exists": each change is
+-- looked up in information_schema, and replaced by a no-op when already made
+set @qry = (select if(count(*) = 0,
+                      'alter table flowview_load_metadata add column sample_rate VARCHAR (500)',
+                      'do 0')
+            from information_schema.columns
+            where table_schema = database() and table_name = 'flowview_load_metadata'
+              and column_name = 'sample_rate');
+prepare migration from @qry;
+execute migration;
+deallocate prepare migration;
+
+set @qry = (select if(count(*) = 0,
+                      'create index flowview_load_metadata_topic_end on flowview_load_metadata (topic_name, load_end_time)',
+                      'do 0')
+            from information_schema.statistics
+            where table_schema = database() and table_name = 'flowview_load_metadata'
+              and index_name = 'flowview_load_metadata_topic_end');
+prepare migration from @qry;
+execute migration;
+deallocate prepare migration;
+
+set @qry = (select if(count(*) = 0,
+                      'alter table flowview_load_transmitted_ratio add column transmitted_ratio_error VARCHAR (500)',
+                      'do 0')
+            from information_schema.columns
+            where table_schema = database() and table_name = 'flowview_load_transmitted_ratio'
+              and column_name = 'transmitted_ratio_error');
+prepare migration from @qry;
+execute migration;
+deallocate prepare migration;
+
+set @qry = (select if(count(*) = 0,
+                      'alter table flowview_load_transmitted_ratio add column sample_rate VARCHAR (500)',
+                      'do 0')
+            from information_schema.columns
+            where table_schema = database() and table_name = 'flowview_load_transmitted_ratio'
+              and column_name = 'sample_rate');
+prepare migration from @qry;
+execute migration;
+deallocate prepare migration;
+
+set @qry = (select if(count(*) = 0,
+                      'create index flowview_load_transmitted_ratio_topic_end on flowview_load_transmitted_ratio (topic_name, load_end_time)',
+                      'do 0')
+            from information_schema.statistics
+            where table_schema = database() and table_name = 'flowview_load_transmitted_ratio'
+              and index_name = 'flowview_load_transmitted_ratio_topic_end');
+prepare migration from @qry;
+execute migration;
+deallocate prepare migration;
+
+create table if not exists flowview_checkpoint (
+  topic_name varchar(255) not null primary key,
+  last_load_hdfs_dir varchar (500),
+  last_load_hive_partition varchar (500),
+  updated_time timestamp
+);
+
+-- Backfill each topic's checkpoint from its latest load
+insert into flowview_checkpoint (topic_name, last_load_hdfs_dir, last_load_hive_partition, updated_time)
+select history.topic_name, history.last_load_hdfs_dir, history.last_load_hive_partition, history.load_end_time
+from flowview_load_metadata history
+join (select topic_name, max(load_end_time) as load_end_time
+      from flowview_load_metadata
+      group by topic_name) latest
+on history.topic_name = latest.topic_name and history.load_end_time = latest.load_end_time
+on duplicate key update
+  last_load_hdfs_dir = values(last_load_hdfs_dir),
+  last_load_hive_partition = values(last_load_hive_partition),
+  updated_time = values(updated_time);
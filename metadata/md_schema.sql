@@ -1,30 +1,50 @@
-
 -- Referenced from IDEA Thrive (https://github.intuit.com/idea/thrive)
 -- Author Rohan Kekatpure
 
 -- Run this file from MySQL shell as
 -- "source md_schema.sql;"
+-- Existing metadata databases are upgraded with md_migrate_checkpoint.sql
 
 drop table if exists flowview_load_metadata;
 
 create table flowview_load_metadata (
-  topic_name varchar(500) not null ,
+  topic_name varchar(255) not null ,
   database_name varchar(500) not null,
   table_name varchar(500) not null ,
   load_start_time timestamp default CURRENT_TIMESTAMP ,
   load_end_time timestamp,
   last_load_hdfs_dir varchar (500),
-  last_load_hive_partition varchar (500)
+  last_load_hive_partition varchar (500),
+  -- Fraction of events loaded when the dataset is sampled (sample_rate), null when every event is loaded
+  sample_rate VARCHAR (500)
 );
 
+create index flowview_load_metadata_topic_end on flowview_load_metadata (topic_name, load_end_time);
+
 drop table if exists flowview_load_transmitted_ratio;
 
 create table flowview_load_transmitted_ratio (
-  topic_name varchar(500) not null ,
+  topic_name varchar(255) not null ,
   database_name varchar(500) not null,
   table_name varchar(500) not null ,
   load_start_time timestamp default CURRENT_TIMESTAMP ,
   load_end_time timestamp,
   hdfs_partition varchar(500) not null,
-  transmitted_ratio VARCHAR (500) not null
+  transmitted_ratio VARCHAR (500) not null,
+  -- Standard error of transmitted_ratio, set when it is estimated from sketches (ratio_mode=approximate)
+  transmitted_ratio_error VARCHAR (500),
+  -- Fraction of events the ratio was computed on, null when it was computed on every event
+  sample_rate VARCHAR (500)
+);
+
+create index flowview_load_transmitted_ratio_topic_end on flowview_load_transmitted_ratio (topic_name, load_end_time);
+
+drop table if exists flowview_checkpoint;
+
+-- Last processed hdfs directory and hive partition of each topic, updated with every load
+create table flowview_checkpoint (
+  topic_name varchar(255) not null primary key,
+  last_load_hdfs_dir varchar (500),
+  last_load_hive_partition varchar (500),
+  updated_time timestamp
 );
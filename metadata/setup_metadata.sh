@@ -4,9 +4,10 @@
 # Author Rohan Kekatpure
 
 # Script to setup FlowView metadata tables in mysql database.
-# This script reads sql commands from ./md_schama.sql
+# This script reads sql commands from ./md_schama.sql, or from the file given as first argument
+# (e.g. ./md_migrate_checkpoint.sql to upgrade an existing metadata database)
 
-MD_SCHEMA_FILE="./md_schema.sql"
+MD_SCHEMA_FILE="${1:-./md_schema.sql}"
 
 # Exit if schema file does not exist
 if [ ! -f "$MD_SCHEMA_FILE" ]; then
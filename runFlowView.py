@@ -3,6 +3,8 @@
 from flowview.load_handler import LoadHandler
 from flowview.setup_handler import SetupHandler
 from flowview.cleanup_handler import CleanupHandler
+from flowview.daemon import LoadDaemon
+from flowview.orchestrator import Orchestrator, DEFAULT_DATASET_WORKERS, DEFAULT_PROCESS_LIMITS
 from optparse import OptionParser
 import logging
 import log
@@ -14,17 +16,41 @@ parser.add_option("--config-file", dest="config_file", action="store")
 
 parser.add_option("--phase",dest="phase",action="store")
 
+# Loads every dataset config (*.cfg) of a directory in one process
+parser.add_option("--config-dir", dest="config_dir", action="store")
+
+parser.add_option("--dataset-workers", dest="dataset_workers", action="store", type="int",
+                  default=DEFAULT_DATASET_WORKERS)
+
+parser.add_option("--max-hadoop-processes", dest="max_hadoop_processes", action="store", type="int",
+                  default=DEFAULT_PROCESS_LIMITS["hadoop"])
+
+parser.add_option("--max-hive-processes", dest="max_hive_processes", action="store", type="int",
+                  default=DEFAULT_PROCESS_LIMITS["hive"])
+
+parser.add_option("--parse-processes", dest="parse_processes", action="store", type="int", default=0)
+
 
 (options,args) = parser.parse_args()
 
+if options.config_dir and options.phase not in (None,"load"):
+    parser.error("Only the load phase runs with --config-dir")
+
 log.init_logging()
 logger = logging.getLogger(__name__)
 
 try:
-    if options.phase == "setup":
+    if options.config_dir:
+        handler = Orchestrator(options.config_dir,options.dataset_workers,
+                               {"hadoop": options.max_hadoop_processes,
+                                "hive": options.max_hive_processes},
+                               options.parse_processes)
+    elif options.phase == "setup":
         handler = SetupHandler(options.config_file)
     elif options.phase == "load":
         handler = LoadHandler(options.config_file)
+    elif options.phase == "daemon":
+        handler = LoadDaemon(options.config_file)
     elif options.phase == "cleanup":
         handler = CleanupHandler(options.config_file)
     else:
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from flowview.dir_index import DirIndex
+from flowview.hdfs_manager import hdfsManager
+
+TOPIC = "/data/ds_ctg/trinity/thrive_test"
+# d_20150819-1712 and d_20150819-1713 were last modified within the same minute
+LISTING = [("2015-08-19 10:12","%s/d_20150819-1710" %TOPIC),
+           ("2015-08-19 10:14","%s/d_20150819-1712" %TOPIC),
+           ("2015-08-19 10:14","%s/d_20150819-1713" %TOPIC),
+           ("2015-08-19 10:15","%s/d_20150819-1714" %TOPIC),
+           ("2015-08-19 10:16","%s/d_20150819-1715" %TOPIC)]
+
+
+class FakeShellExecutor(object):
+    def execute(self,cmd):
+        raise AssertionError("Unexpected listing %s" %cmd)
+
+    safe_execute = execute
+
+
+class DirIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dir_index = DirIndex(os.path.join(self.tmp_dir,"dirs.json"))
+        self.dir_index.hdfs_path = TOPIC
+        self.dir_index.merge(LISTING)
+        # The index is up to date, nothing is listed
+        self.dir_index.refresh = lambda shell_exec,hdfs_path: None
+        self.hdfs_mgr = hdfsManager("thrive_test")
+        self.hdfs_mgr.shell_exec = FakeShellExecutor()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_position_by_path(self):
+        self.assertEqual(self.dir_index.position("%s/d_20150819-1712" %TOPIC),1)
+        self.assertEqual(self.dir_index.position("%s/d_20150819-1713" %TOPIC),2)
+
+    def test_shared_minute_timestamp_takes_oldest(self):
+        self.assertEqual(self.dir_index.position("2015-08-19 10:14"),1)
+
+    def test_no_directory_skipped_after_shared_minute(self):
+        pending = self.hdfs_mgr.get_new_dirs("%s/d_20150819-1712" %TOPIC,None,TOPIC,self.dir_index)
+        self.assertEqual(pending,LISTING[2:4])
+        # Checkpoint written by an older load
+        pending = self.hdfs_mgr.get_new_dirs("2015-08-19 10:14",None,TOPIC,self.dir_index)
+        self.assertEqual(pending,LISTING[2:4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import threading
+import time
+import unittest
+from flowview.hive_executor import HiveServer2Executor, HiveException
+
+
+class FakeCursor(object):
+    def __init__(self,connection):
+        self.connection = connection
+        self.description = None
+
+    def execute(self,statement):
+        if statement == "fail":
+            raise RuntimeError("statement failed")
+        if statement == "slow":
+            time.sleep(0.05)
+        self.description = [("value",)] if statement.startswith("select") else None
+
+    def fetchall(self):
+        return [(self.connection.number,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnect(object):
+    """
+    DB-API connect function counting the connections opened and open
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = []
+        self.open = 0
+        self.max_open = 0
+
+    def __call__(self,host,port,username,database):
+        with self.lock:
+            connection = FakeConnection(self,len(self.connections) + 1)
+            self.connections.append(connection)
+            self.open += 1
+            self.max_open = max(self.max_open,self.open)
+        return connection
+
+
+class FakeConnection(object):
+    def __init__(self,connect,number):
+        self.connect = connect
+        self.number = number
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        with self.connect.lock:
+            if not self.closed:
+                self.closed = True
+                self.connect.open -= 1
+
+
+class HiveServer2ExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.connect = FakeConnect()
+        self.hive_exec = HiveServer2Executor("hiveserver2",pool_size=2,connect=self.connect)
+
+    def test_connection_reused(self):
+        self.assertEqual(self.hive_exec.execute(["use flowview","select 1"]),[(1,)])
+        self.assertEqual(self.hive_exec.execute(["select 1"]),[(1,)])
+        self.assertEqual(len(self.connect.connections),1)
+
+    def test_connection_discarded_after_error(self):
+        self.assertRaises(HiveException,self.hive_exec.execute,["fail"])
+        self.assertTrue(self.connect.connections[0].closed)
+        self.assertEqual(self.hive_exec.execute(["select 1"]),[(2,)])
+
+    def test_pool_size_bounds_connections(self):
+        threads = [threading.Thread(target=self.hive_exec.execute,args=(["slow"],)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(self.connect.max_open,2)
+        self.assertLessEqual(len(self.connect.connections),2)
+
+    def test_close_closes_pooled_connections(self):
+        threads = [threading.Thread(target=self.hive_exec.execute,args=(["slow"],)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.hive_exec.close()
+        self.assertTrue(all(connection.closed for connection in self.connect.connections))
+        self.assertEqual(self.connect.open,0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from flowview.hive_manager import HiveManager
+
+PARTITIONS = ["year=2015/month=08/day=19/hour=%02d" %hour for hour in range(6)]
+
+
+class FakeExecutor(object):
+    def __init__(self):
+        self.calls = []
+
+    def execute(self,statements):
+        self.calls.append(statements)
+        return []
+
+
+class PullHiveTsPtnsTest(unittest.TestCase):
+    def setUp(self):
+        self.hive_exec = FakeExecutor()
+        self.hive_mgr = HiveManager("thrive_test","thrive_test",self.hive_exec)
+        self.pulled = []
+
+    def scans(self):
+        return [statement for statements in self.hive_exec.calls for statement in statements
+                if statement.startswith("from ")]
+
+    def test_single_scan_in_one_session(self):
+        self.hive_mgr.pull_hive_ts_ptns(PARTITIONS,"/flowview/hive_ts",24,self.pulled.extend)
+        self.assertEqual(len(self.hive_exec.calls),1)
+        self.assertEqual(len(self.scans()),1)
+        self.assertEqual(self.scans()[0].count("insert overwrite directory"),len(PARTITIONS))
+        self.assertEqual(self.pulled,PARTITIONS)
+
+    def test_concurrent_batches(self):
+        self.hive_mgr.pull_hive_ts_ptns(PARTITIONS,"/flowview/hive_ts",24,self.pulled.extend,3)
+        self.assertEqual(len(self.scans()),3)
+        self.assertEqual(sorted(self.pulled),PARTITIONS)
+
+
+if __name__ == "__main__":
+    unittest.main()
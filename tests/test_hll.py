@@ -0,0 +1,25 @@
+import unittest
+from flowview.hll import HyperLogLog, estimate_overlap, DEFAULT_PRECISION
+
+
+class HyperLogLogTest(unittest.TestCase):
+    def test_default_precision_meets_ratio_target(self):
+        # Steady topic over the two hour window: the hive window holds twice the partition's events
+        hdfs_sketch = HyperLogLog(DEFAULT_PRECISION)
+        hdfs_sketch.update("event-%s" %i for i in range(20000))
+        hive_sketch = HyperLogLog(DEFAULT_PRECISION)
+        hive_sketch.update("event-%s" %i for i in range(40000))
+        hdfs_cnt,matched_cnt,matched_error = estimate_overlap(hdfs_sketch,hive_sketch)
+        self.assertAlmostEqual(matched_cnt / hdfs_cnt,1.0,delta=0.01)
+        self.assertLess(matched_error / hdfs_cnt,0.005)
+
+    def test_serialize_at_default_precision(self):
+        sketch = HyperLogLog(DEFAULT_PRECISION)
+        sketch.update("event-%s" %i for i in range(1000))
+        restored = HyperLogLog.deserialize(sketch.serialize())
+        self.assertEqual(restored.precision,DEFAULT_PRECISION)
+        self.assertEqual(restored.count(),sketch.count())
+
+
+if __name__ == "__main__":
+    unittest.main()
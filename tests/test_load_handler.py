@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from flowview.load_handler import LoadHandler
+from flowview.load_summary import PartitionSummary
+
+PTN = "2015/08/19/10"
+
+
+class FakeHiveManager(object):
+    def __init__(self):
+        self.row_counts = []
+
+    def load_ptns_transmitted_ratio(self,ptns,load_summary):
+        self.row_counts.append(load_summary.row_counts())
+        return dict((ptn,1.0) for ptn in ptns if load_summary.rows(ptn))
+
+
+class DeferredRatioTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        config_file = os.path.join(self.tmp_dir,"thrive_test.cfg")
+        with open(config_file,"w") as f:
+            f.write("[main]\n"
+                    "topic_name=thrive_test\n"
+                    "database_name=thrive_test\n"
+                    "table_name=thrive_test\n"
+                    "connection_info=%s\n"
+                    "local_hdfs_ts_path=%s/hdfs_ts\n"
+                    %(json.dumps({"md_backend": "sqlite","md_path": os.path.join(self.tmp_dir,"md.db")}),
+                      self.tmp_dir))
+        self.handler = LoadHandler(config_file)
+        self.handler.defer_ratios = True
+        self.handler.hive_mng = FakeHiveManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_load(self,hdfs_ptns,hive_last_ptn):
+        """
+        Runs the ratio step of a load writing 10 rows to each of hdfs_ptns, with its hive checkpoint at hive_last_ptn
+        """
+        self.handler.reset()
+        for ptn in hdfs_ptns:
+            summary = PartitionSummary()
+            summary.add(10,1439996400000,1439999999000,"2015-08-19 10:12")
+            self.handler.hdfs_ptn_list.add(ptn)
+            self.handler.load_summary.merge(ptn,summary)
+        self.handler.hive_new_lastptn = hive_last_ptn
+        records = self.handler.get_ptn_ratio_records()
+        # Kept once the load is recorded
+        self.handler.deferred_ptns = self.handler.next_deferred_ptns
+        return records
+
+    def test_ratio_waits_for_hive_window(self):
+        # Directories of hour 10 close before the hive partition of hour 11 is pulled
+        self.assertEqual(self.run_load([PTN],"year=2015/month=08/day=19/hour=10"),[])
+        self.assertEqual(sorted(self.handler.deferred_ptns),[PTN])
+        # Late rows of hour 10 join the waiting ones
+        self.assertEqual(self.run_load([PTN],"year=2015/month=08/day=19/hour=10"),[])
+        records = self.run_load([],"year=2015/month=08/day=19/hour=11")
+        self.assertEqual([record["hdfs_partition"] for record in records],[PTN])
+        self.assertEqual(self.handler.hive_mng.row_counts,[{},{},{PTN: 20}])
+        self.assertEqual(self.handler.deferred_ptns,{})
+
+    def test_ratio_not_deferred_by_default(self):
+        self.handler.defer_ratios = False
+        records = self.run_load([PTN],"year=2015/month=08/day=19/hour=10")
+        self.assertEqual([record["hdfs_partition"] for record in records],[PTN])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+import unittest
+from flowview.metadata_manager import MetadataManager
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.metadata_mgr = MetadataManager({"md_backend": "sqlite","md_path": os.path.join(self.tmp_dir,"md.db")},
+                                            "thrive_test","thrive_test")
+
+    def tearDown(self):
+        self.metadata_mgr.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_checkpoints_written_again(self):
+        dir_path = "/data/ds_ctg/trinity/thrive_test/d_20150819-1710"
+        ptn = "year=2015/month=08/day=19/hour=10"
+        for _ in range(2):
+            with self.metadata_mgr.transaction():
+                self.metadata_mgr.update_checkpoint(dir_path,ptn,"2015-08-19 11:00:00",commit=False)
+        self.assertEqual(self.metadata_mgr.get_checkpoint(),(dir_path,ptn))
+        self.assertEqual(self.metadata_mgr.execute_return("select count(*) from flowview_checkpoint")[0][0],1)
+
+    def test_none_keeps_stored_checkpoint(self):
+        dir_path = "/data/ds_ctg/trinity/thrive_test/d_20150819-1710"
+        self.metadata_mgr.update_checkpoint(dir_path,None,"2015-08-19 11:00:00")
+        self.metadata_mgr.update_checkpoint(None,"year=2015/month=08/day=19/hour=10","2015-08-19 12:00:00")
+        self.assertEqual(self.metadata_mgr.get_checkpoint(),(dir_path,"year=2015/month=08/day=19/hour=10"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from flowview.hdfs_manager import hdfsManager
+from flowview.parse_stage import ParseStage
+
+HDFS_DIR = ("2015-08-19 10:12","/data/ds_ctg/trinity/thrive_test/d_20150819-1710")
+# Payloads holding bytes str.splitlines also breaks lines on
+LINES = ['{"event_id":"e%s","payload":"a%sb","server_timestamp":1439999999%03d}\n' %(i,separator,i)
+         for i,separator in enumerate(["\r","\x0b","\x0c","\x1c","\x1d","\x1e","\x85",""])]
+
+
+class FakeRecordReader(object):
+    def read(self,path):
+        # `hadoop fs -text` output read with readline, which splits on "\n" alone
+        return iter(LINES)
+
+
+class Output(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self,data):
+        self.data.append(data)
+
+
+class ParseStageTest(unittest.TestCase):
+    def retrieve(self,parse_stage):
+        output = Output()
+        summary = hdfsManager("thrive_test",record_reader=FakeRecordReader(),parse_stage=parse_stage,
+                              sketch_precision=10).retrieve_hdfs_ts(HDFS_DIR,output)
+        return "".join(output.data),summary
+
+    def test_same_rows_in_threads_and_processes(self):
+        thread_rows,thread_summary = self.retrieve(None)
+        parse_stage = ParseStage(1)
+        try:
+            stage_rows,stage_summary = self.retrieve(parse_stage)
+        finally:
+            parse_stage.close()
+        self.assertEqual(thread_summary.rows,len(LINES))
+        self.assertEqual(stage_rows,thread_rows)
+        self.assertEqual(stage_summary.rows,thread_summary.rows)
+        self.assertEqual(stage_summary.sketch.registers,thread_summary.sketch.registers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+from flowview.record_reader import LocalRecordReader, RecordReaderException, decode_file
+
+HDFS_DIR = "/data/ds_ctg/trinity/thrive_test/d_20150819-1710"
+LINES = ["1439999999\tevent %s\n" %i for i in range(3)]
+
+
+class FakeReader(object):
+    def __init__(self):
+        self.paths = []
+
+    def read(self,path):
+        self.paths.append(path)
+        return iter(["from fallback\n"])
+
+
+class LocalRecordReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.mount_root = tempfile.mkdtemp()
+        self.local_dir = os.path.join(self.mount_root,HDFS_DIR.lstrip("/"))
+        os.makedirs(self.local_dir)
+        self.fallback = FakeReader()
+        self.reader = LocalRecordReader(self.mount_root,fallback=self.fallback)
+
+    def tearDown(self):
+        shutil.rmtree(self.mount_root)
+
+    def write(self,name,data):
+        with open(os.path.join(self.local_dir,name),"wb") as f:
+            f.write(data)
+
+    def test_plain_text_read_locally(self):
+        self.write("part-00000","".join(LINES))
+        self.assertEqual(list(self.reader.read(HDFS_DIR)),LINES)
+        self.assertEqual(self.fallback.paths,[])
+
+    def test_bz2_falls_back(self):
+        self.write("part-00000","".join(LINES))
+        self.write("part-00001.bz2",bz2.compress("".join(LINES)))
+        self.assertEqual(list(self.reader.read(HDFS_DIR)),["from fallback\n"])
+        self.assertEqual(self.fallback.paths,[HDFS_DIR])
+
+    def test_binary_without_extension_falls_back(self):
+        self.write("part-00000","\x04\x22\x4d\x18\x00\x00binary")
+        self.assertEqual(list(self.reader.read(HDFS_DIR)),["from fallback\n"])
+        self.assertEqual(self.fallback.paths,[HDFS_DIR])
+
+    def test_decode_file_rejects_bz2(self):
+        self.write("part-00000.bz2",bz2.compress("".join(LINES)))
+        filepath = os.path.join(self.local_dir,"part-00000.bz2")
+        with open(filepath,"rb") as f:
+            self.assertRaises(RecordReaderException,decode_file,f,filepath)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import time
+import unittest
+from flowview.shell_executor import ShellExecutor
+from flowview.worker_pool import WorkerPool, WorkerPoolException
+
+
+class TaskTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        ShellExecutor.set_process_limit("sleep",1)
+
+    def tearDown(self):
+        ShellExecutor.set_process_limit("sleep",None)
+
+    def test_timed_out_process_is_killed(self):
+        def read(cmd):
+            for _ in ShellExecutor.stream_execute(cmd):
+                pass
+        pool = WorkerPool("test",1,read,task_timeout=1,
+                          on_timeout=lambda cmd,thread: ShellExecutor.kill_thread_processes(thread.ident))
+        pool.submit("sleep 60")
+        # Drained without being run once the pool has failed
+        pool.submit("sleep 61")
+        start = time.time()
+        self.assertRaises(WorkerPoolException,pool.join,0.1)
+        for thread in pool.threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertLess(time.time() - start,10)
+        slot = ShellExecutor.process_slot("sleep 60")
+        self.assertTrue(slot.acquire(False))
+        slot.release()
+
+
+if __name__ == "__main__":
+    unittest.main()